@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""Measure the memory tentakel needs per host of a loaded group.
+
+Usage: python scripts/bench_hosts.py [ count ... ]
+
+For every count (10000 and 100000 by default) a group with that many
+hosts is expanded and a RemoteCollator is set up for it, as the
+interactive shell does, with the RemoteCommand objects of all hosts
+created as after a first command. The memory allocated for that is
+reported in bytes per host, host names included.
+"""
+
+import sys
+import time
+import tracemalloc
+
+from tentakel.config import ConfigBase, ConfigGroup
+from tentakel.remote import RemoteCollator
+
+
+def make_conf(count):
+    conf = ConfigBase()
+    group = ConfigGroup()
+    group["name"] = "all"
+    group["method"] = "ssh"
+    group["hosts"] = [f"node{i:06d}.example.com" for i in range(count)]
+    conf["groups"] = {"all": group}
+    return conf
+
+
+def bench(count):
+    tracemalloc.start()
+    conf = make_conf(count)
+    t1 = time.time()
+    collator = RemoteCollator(conf, "all")
+    assert len(collator.remote_objects) == count
+    duration = time.time() - t1
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{count:>8} hosts: {size / count:8.1f} bytes/host, {size / 2**20:7.1f} MiB, setup {duration:.2f}s")
+
+
+if __name__ == "__main__":
+    for count in [int(x) for x in sys.argv[1:]] or [10000, 100000]:
+        bench(count)
@@ -0,0 +1,222 @@
+#
+# Copyright (c) 2002, 2003, 2004, 2005 Sebastian Stark
+# Copyright (c) 2019-2023 Stefane Fermigier
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR SEBASTIAN STARK
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""On-disk caches for tentakel.
+
+Parsing a large configuration file and expanding its groups is slow, so
+load_config() keeps a compiled copy of every configuration file it reads
+in the user cache directory:
+
+  conf = cache.load_config("tentakel.conf")
+
+The compiled copy holds the parsed groups and settings along with the
+expanded member lists. It is keyed by the path, modification time, size
+and content hash of the configuration file and rebuilt automatically
+whenever one of those changes.
+
+TTLCache is a small persistent mapping whose entries expire, for facts
+about hosts that are slow to find out and change rarely, e.g. their
+addresses:
+
+  addresses = cache.ttl_cache("addresses")
+  addresses.put("web1", "192.0.2.1", ttl=300)
+  addresses.save()
+"""
+
+from __future__ import annotations
+
+import hashlib
+import io
+import os
+import pickle
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from . import error, tpg
+from .config import PARAMS, ConfigBase, __user_cache_dir
+from .error import Abort
+
+# bump this whenever the layout of the compiled configuration changes
+CACHE_VERSION = 10
+
+_MAGIC = b"TKC\x00"
+
+
+def load_config(path: str | Path, cache_dir: str | Path | None = None) -> ConfigBase:
+    """Return the configuration stored in path, using the compiled cache
+    in cache_dir (the user cache directory by default) when it is fresh."""
+
+    path = Path(path).resolve()
+    cache_dir = Path(cache_dir or __user_cache_dir)
+    cache_file = cache_dir / (hashlib.sha1(str(path).encode()).hexdigest() + ".conf")
+
+    try:
+        stat = path.stat()
+        data = path.read_bytes()
+    except OSError:
+        raise Abort(f"could not read from file: '{path}'")
+
+    # the defaults are compiled in too, some depend on the user
+    key = (CACHE_VERSION, tuple(PARAMS.items()), str(path), stat.st_mtime_ns, stat.st_size)
+    digest = hashlib.sha256(data).hexdigest()
+
+    conf = _read_cache(cache_file, key, digest)
+    if conf is not None:
+        return conf
+
+    conf = ConfigBase()
+    try:
+        conf.parse(data.decode())
+    except tpg.SyntacticError as excerr:  # pragma: nocover
+        error.warn(f"in {path}: {excerr.msg}")
+        return conf
+
+    _write_cache(cache_file, key, digest, conf)
+    return conf
+
+
+def _read_cache(cache_file: Path, key, digest) -> ConfigBase | None:
+    """Return the configuration compiled into cache_file, or None if it
+    is missing, unreadable or stale."""
+
+    try:
+        stream = io.BytesIO(cache_file.read_bytes())
+        if stream.read(len(_MAGIC)) != _MAGIC:
+            return None
+        if pickle.load(stream) != key or pickle.load(stream) != digest:
+            return None
+        payload = pickle.load(stream)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+
+    conf = ConfigBase()
+    conf["groups"] = payload["groups"]
+    conf["settings"] = payload["settings"]
+    conf.expansion = payload["expansion"]
+    return conf
+
+
+def _write_cache(cache_file: Path, key, digest, conf: ConfigBase):
+    """Compile conf into cache_file. Failures are silently ignored, the
+    cache is an optimization only."""
+
+    payload = {
+        "groups": conf["groups"],
+        "settings": dict(conf["settings"]),
+        "expansion": conf.expand_groups(),
+    }
+
+    _write_atomic(cache_file, key, digest, payload)
+
+
+def _write_atomic(path: Path, *objs):
+    """Replace path with the pickled objs, silently ignoring failures."""
+
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent)
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(_MAGIC)
+            for obj in objs:
+                pickle.dump(obj, tmp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_name, path)
+    except OSError:  # pragma: nocover
+        pass
+
+
+class TTLCache:
+    """A mapping stored in a file, whose entries expire after a time to
+    live given when they are put.
+
+    The file is read when the cache is created and written back by save(),
+    if anything changed. The cache can be used from several threads.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        # key -> (expiry time, value)
+        self.entries: dict = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        try:
+            stream = io.BytesIO(self.path.read_bytes())
+            if stream.read(len(_MAGIC)) == _MAGIC and pickle.load(stream) == CACHE_VERSION:
+                self.entries = pickle.load(stream)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            pass
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """Return the value of key, or default if it is missing or has
+        expired."""
+
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.time():
+            return default
+        return entry[1]
+
+    def put(self, key, value, ttl: float):
+        """Store value for key, for ttl seconds."""
+
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, value)
+            self.dirty = True
+
+    def discard(self, key):
+        """Remove key, if it is there."""
+
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.dirty = True
+
+    def clear(self):
+        """Remove all entries."""
+
+        with self.lock:
+            self.dirty = self.dirty or bool(self.entries)
+            self.entries = {}
+
+    def save(self):
+        """Write the entries that have not expired back to the file."""
+
+        with self.lock:
+            if not self.dirty:
+                return
+            now = time.time()
+            self.entries = {k: e for k, e in self.entries.items() if e[0] >= now}
+            _write_atomic(self.path, CACHE_VERSION, self.entries)
+            self.dirty = False
+
+
+def ttl_cache(name: str, cache_dir: str | Path | None = None) -> TTLCache:
+    """Return the TTLCache called name in cache_dir (the user cache
+    directory by default)."""
+
+    return TTLCache(Path(cache_dir or __user_cache_dir) / (name + ".cache"))
@@ -0,0 +1,479 @@
+#
+# Copyright (c) 2002, 2003, 2004, 2005 Sebastian Stark
+# Copyright (c) 2019-2023 Stefane Fermigier
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR SEBASTIAN STARK
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Sharing the hosts of commands between tentakels on several machines.
+
+A coordinator owns the hosts of the commands of a collator, and hands
+them out in batches to the worker tentakels connected to it, over TCP or
+a Unix socket:
+
+  tentakel --listen ctl1:7000 -g all uptime    # on the control node
+  tentakel --worker ctl1:7000                  # on each worker machine
+
+A worker asks for a batch, runs the command on it with the settings of
+the coordinator and streams the results back, then asks for another one.
+Batches get smaller as the hosts run out, so that the workers finish at
+about the same time. Once there are none left, an idle worker steals
+half of the hosts of the busiest worker that it has not started the
+command on yet. If a worker goes away, the hosts it got no result for
+are handed out again.
+
+Both directions use the frames of the relay module. The workers run
+whatever command the coordinator sends them, so only listen where no
+one but your own workers can connect.
+"""
+
+from __future__ import annotations
+
+import os
+import socket
+import stat
+import threading
+from collections import deque
+
+from . import error, relay, remote
+from .error import Abort
+
+# largest number of hosts in a batch
+BATCH = 64
+
+
+def parse_address(text: str) -> tuple[int, str | tuple[str, int]]:
+    """Return the socket family and address of text, host:port for TCP
+    or else the path of a Unix socket."""
+
+    if "/" in text or ":" not in text:
+        return socket.AF_UNIX, text
+    host, _, port_text = text.rpartition(":")
+    try:
+        port = int(port_text)
+    except ValueError:
+        raise Abort(f"invalid address: '{text}'")
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    return family, (host.strip("[]"), port)
+
+
+class Connection:
+    """A connection between a coordinator and a worker, carrying frames."""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.rfile = sock.makefile("rb")
+        self.wfile = sock.makefile("wb")
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            relay.write_frame(self.wfile, message)
+
+    def recv(self):
+        message = relay.read_frame(self.rfile)
+        if message is None:
+            raise EOFError("connection closed")
+        return message
+
+    def close(self):
+        try:
+            # wakes up the reader
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class _Worker:
+    """A worker, seen from the coordinator."""
+
+    def __init__(self, conn: Connection):
+        self.conn = conn
+        self.name = "?"
+        # the number of its batch, the run and the names of the hosts it
+        # got no result for yet
+        self.batch: tuple[int, _Run, set[str]] | None = None
+        # idle workers waiting for the hosts stolen from this one
+        self.thieves: deque[_Worker] = deque()
+        # nothing left to steal in the current batch
+        self.dry = False
+        self.most_running = 0
+
+    def send(self, message):
+        try:
+            self.conn.send(message)
+        except OSError:
+            # gone, its reader hands its hosts out again
+            pass
+
+
+class _Run:
+    """A command being run by the workers. Used by the collator like the
+    connection to a worker process."""
+
+    def __init__(self, coordinator: Coordinator, objs: list, command: str, collator):
+        self.coordinator = coordinator
+        self.command = command
+        self.collator = collator
+        # dropped by the collator if the run is left behind
+        self.results = collator._results
+        self.objs = {obj.destination: obj for obj in objs}
+        self.queue = deque(objs)
+        # hosts with no result, and batches not done yet
+        self.left = len(objs)
+        self.batches = 0
+        self.stopped = False
+        self.done = threading.Event()
+        self.check()
+
+    def result(self, result: remote.Result):
+        self.results.put(result)
+        self.left -= 1
+        self.check()
+
+    def check(self):
+        if not (self.left or self.batches):
+            self.done.set()
+
+    def send(self, message: str):
+        if message == "cancel":
+            self.coordinator.cancel(self)
+        elif message == "kill":
+            self.coordinator.kill(self)
+
+    def join(self, timeout: float | None = None):
+        self.done.wait(timeout)
+
+    def close(self):
+        pass
+
+
+class Coordinator:
+    """Hands the hosts of the commands of a collator out to the workers
+    connected to address, at most batch hosts at a time."""
+
+    def __init__(self, address: str, batch: int = BATCH):
+        family, where = parse_address(address)
+        if isinstance(where, str):
+            try:
+                if stat.S_ISSOCK(os.stat(where).st_mode):
+                    # left behind by a coordinator that went away
+                    os.unlink(where)
+            except OSError:
+                pass
+        self.server = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            if family != socket.AF_UNIX:
+                self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server.bind(where)
+            self.server.listen()
+        except OSError as exc:
+            self.server.close()
+            raise Abort(f"could not listen on {address}: {exc.strerror or exc}")
+        self.address = self.server.getsockname()
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.workers: list[_Worker] = []
+        self.idle: deque[_Worker] = deque()
+        self.run: _Run | None = None
+        self._batches = 0
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        """Stop listening and let the workers go."""
+
+        self.server.close()
+        if self.server.family == socket.AF_UNIX:
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+        with self.lock:
+            for worker in self.workers:
+                worker.conn.close()
+
+    def start(self, objs: list, command: str, collator) -> _Run:
+        """Have the workers run command on the RemoteCommand objects objs,
+        with the settings of collator, and put the results in its queue."""
+
+        with self.lock:
+            self.run = _Run(self, objs, command, collator)
+            self._dispatch()
+        return self.run
+
+    def cancel(self, run: _Run):
+        """Start run on no more hosts, and cancel it on the workers."""
+
+        with self.lock:
+            if run.stopped:
+                return
+            run.stopped = True
+            for obj in run.queue:
+                run.result(remote.Result(obj.destination, -1, "tentakel: cancelled", 0.0))
+            run.queue.clear()
+            for worker in self.workers:
+                if worker.batch and worker.batch[1] is run:
+                    worker.send(["cancel", worker.batch[0]])
+
+    def kill(self, run: _Run):
+        """Have the workers kill the processes of the cancelled run."""
+
+        with self.lock:
+            for worker in self.workers:
+                if worker.batch and worker.batch[1] is run:
+                    worker.send(["kill", worker.batch[0]])
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                # closed
+                return
+            worker = _Worker(Connection(sock))
+            with self.lock:
+                self.workers.append(worker)
+            threading.Thread(target=self._serve, args=(worker,), daemon=True).start()
+
+    def _serve(self, worker: _Worker):
+        """Reader thread of worker: take its results and hand it hosts
+        whenever it asks for them, until it goes away."""
+
+        try:
+            while True:
+                message = worker.conn.recv()
+                with self.lock:
+                    self._handle(worker, message)
+        except (EOFError, OSError, ValueError):
+            pass
+        worker.conn.close()
+        with self.lock:
+            self._gone(worker)
+
+    def _handle(self, worker: _Worker, message):
+        kind = message[0]
+        if kind == "pull":
+            worker.name = message[1]
+            self._ready(worker)
+            return
+        if worker.batch is None or worker.batch[0] != message[1]:
+            # a late answer to a steal, about a batch done since
+            return
+        _, run, dests = worker.batch
+        if kind == "result":
+            if message[2] in dests:
+                dests.discard(message[2])
+                run.result(remote.Result(*message[2:]))
+        elif kind == "stolen":
+            thief = worker.thieves.popleft()
+            stolen = [run.objs[d] for d in message[2] if d in dests]
+            dests.difference_update(message[2])
+            if not stolen:
+                worker.dry = True
+                self._ready(thief)
+            elif thief in self.workers:
+                message = f"coordinator: worker {thief.name} stole {len(stolen)} hosts from {worker.name}"
+                run.collator.metrics.log(message)
+                self._assign(thief, run, stolen)
+            else:
+                run.queue.extendleft(stolen)
+                self._dispatch()
+        elif kind == "done":
+            state = message[2]
+            # its batches ran one after the other
+            running = max(state["most_running"] - worker.most_running, 0)
+            worker.most_running = max(state["most_running"], worker.most_running)
+            with run.collator._lock:
+                run.collator.metrics.merge(dict(state, most_running=running), f"worker {worker.name}: ")
+            # stolen, but done before it could tell
+            self._requeue(run, dests)
+            run.batches -= 1
+            run.check()
+            self._ready(worker)
+
+    def _ready(self, worker: _Worker):
+        """Take note that worker waits for hosts."""
+
+        worker.batch = None
+        while worker.thieves:
+            self._ready(worker.thieves.popleft())
+        if worker in self.workers:
+            self.idle.append(worker)
+            self._dispatch()
+
+    def _gone(self, worker: _Worker):
+        """Hand the hosts of worker, which went away, out again."""
+
+        self.workers.remove(worker)
+        if worker in self.idle:
+            self.idle.remove(worker)
+        while worker.thieves:
+            self._ready(worker.thieves.popleft())
+        if worker.batch:
+            _, run, dests = worker.batch
+            worker.batch = None
+            if dests and not run.stopped:
+                message = f"coordinator: worker {worker.name} went away, {len(dests)} hosts handed out again"
+                run.collator.metrics.log(message)
+            self._requeue(run, dests)
+            run.batches -= 1
+            run.check()
+        self._dispatch()
+
+    def _requeue(self, run: _Run, dests: set[str]):
+        """Put the hosts dests of run back in its queue, or cancel them if
+        it is stopped."""
+
+        if run.stopped or run is not self.run:
+            for dest in dests:
+                run.result(remote.Result(dest, -1, "tentakel: cancelled", 0.0))
+        else:
+            run.queue.extendleft(run.objs[dest] for dest in dests)
+
+    def _dispatch(self):
+        """Hand hosts out to the idle workers, from the queue of the
+        current run, or else stolen from the busiest worker."""
+
+        run = self.run
+        while self.idle and run is not None and not run.stopped:
+            if run.queue:
+                # guided: smaller batches as the hosts run out
+                size = min(self.batch, -(-len(run.queue) // len(self.workers)))
+                self._assign(self.idle.popleft(), run, [run.queue.popleft() for _ in range(size)])
+                continue
+            victims = [
+                w
+                for w in self.workers
+                if w.batch and w.batch[1] is run and len(w.batch[2]) > 1 and not (w.dry or w.thieves)
+            ]
+            if not victims:
+                break
+            victim = max(victims, key=lambda w: len(w.batch[2]))
+            victim.thieves.append(self.idle.popleft())
+            victim.send(["steal", victim.batch[0], len(victim.batch[2]) // 2])
+
+    def _assign(self, worker: _Worker, run: _Run, objs: list):
+        self._batches += 1
+        worker.batch = (self._batches, run, {obj.destination for obj in objs})
+        run.batches += 1
+        worker.dry = False
+        # the coordinator checked the conditions of the hosts already
+        job = relay.make_job(objs, run.command, run.collator, checked=True)
+        worker.send(["work", self._batches, job])
+
+
+class _Batch:
+    """The connection of a worker to the coordinator, as seen by the
+    collator running one batch: messages carry the number of the batch."""
+
+    def __init__(self, conn: Connection, number: int):
+        self.conn = conn
+        self.number = number
+        self.inbox: deque = deque()
+        self.ready = threading.Condition()
+        self.closed = False
+
+    def send(self, message):
+        try:
+            self.conn.send([message[0], self.number, *message[1:]])
+        except OSError:
+            # the coordinator went away, the reader cancels the batch
+            pass
+
+    def put(self, message):
+        with self.ready:
+            self.inbox.append(message)
+            self.ready.notify()
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+
+    def recv(self):
+        with self.ready:
+            while not self.inbox and not self.closed:
+                self.ready.wait()
+            if not self.inbox:
+                raise EOFError("the coordinator went away")
+            return self.inbox.popleft()
+
+
+def work(address: str):
+    """The worker: run the batches handed out by the coordinator at
+    address, until it goes away."""
+
+    family, where = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect(where)
+    except OSError as exc:
+        sock.close()
+        raise Abort(f"could not connect to {address}: {exc.strerror or exc}")
+    conn = Connection(sock)
+    batches: deque[tuple[_Batch, dict] | None] = deque()
+    ready = threading.Condition()
+    threading.Thread(target=_read, args=(conn, batches, ready), daemon=True).start()
+
+    try:
+        conn.send(["pull", f"{socket.gethostname()}:{os.getpid()}"])
+    except OSError:
+        return
+    while True:
+        with ready:
+            while not batches:
+                ready.wait()
+            item = batches.popleft()
+        if item is None:
+            break
+        batch, job = item
+        collator = relay.job_collator(job)
+        objs, _, _ = collator.prepare(job["command"])
+        collator.serve(objs, job["command"], batch)
+        batch.close()
+    conn.close()
+
+
+def _read(conn: Connection, batches: deque, ready: threading.Condition):
+    """Reader thread of work(): queue the batches, pass the other messages
+    on to the batch they are about."""
+
+    batch = None
+    try:
+        while True:
+            message = conn.recv()
+            if message[0] == "work":
+                batch = _Batch(conn, message[1])
+                with ready:
+                    batches.append((batch, message[2]))
+                    ready.notify()
+            elif batch is not None and batch.number == message[1]:
+                batch.put(message[0] if message[0] in ("cancel", "kill") else (message[0], *message[2:]))
+    except (EOFError, OSError, ValueError) as exc:
+        if not isinstance(exc, EOFError):
+            error.warn(f"lost the coordinator: {exc}")
+    if batch is not None:
+        batch.close()
+    with ready:
+        batches.append(None)
+        ready.notify()
@@ -50,11 +50,13 @@ from __future__ import annotations
 import os
 import pwd
 import re
-import sys
 import tempfile
+from collections import ChainMap
+from itertools import islice
 from pathlib import Path
+from types import MappingProxyType
 
-from . import error, tpg
+from . import error, hostset, tpg
 from .error import Abort
 
 PARAMS = {
@@ -62,14 +64,63 @@ PARAMS = {
     "rsh_path": "/usr/bin/rsh",
     "method": "ssh",
     "maxparallel": "0",
+    # adjust the number of commands run in parallel to how the hosts and
+    # the network cope, between minparallel and maxparallel
+    "adaptive": "no",
+    "minparallel": "1",
+    # start at most spawnrate commands per second, spawnburst at once, and
+    # delay the start on every host by up to jitter seconds
+    "spawnrate": "0",
+    "spawnburst": "1",
+    "jitter": "0",
+    # remember how long commands take on every host, and for how long, to
+    # start the slowest first and predict run times
+    "history": "no",
+    "history_ttl": "2592000",
+    # label (or "group") telling which rack, datacenter... hosts are in, to
+    # spread the commands over them, and run at most domainparallel per
+    # domain at a time
+    "topology": "",
+    "domainparallel": "0",
+    # run fewer commands at once if this machine can't afford them all
+    "governor": "yes",
+    # host running the commands for this group, and how to start tentakel
+    # there
+    "relay": "",
+    "relay_command": "python3 -m tentakel.relay",
     "user": pwd.getpwuid(os.geteuid())[0],
     "format": r"### %d(stat: %s, dur(s): %t):\n%o\n",
+    "duplicates": "first",
+    # seconds cancelled commands get to terminate before they are killed
+    "kill_timeout": "2",
+    # look up the addresses of all hosts before running, and for how long
+    # to keep them
+    "resolve": "no",
+    "resolve_ttl": "300",
+    # check that the hosts accept connections before running, and how long
+    # to skip those that don't
+    "probe": "no",
+    "probe_timeout": "1",
+    "dead_ttl": "300",
+    # port of the remote method, empty for its default
+    "port": "",
+    # command printing key=value facts about a host, and for how long they
+    # are kept
+    "facts_command": "cut -d' ' -f1 /proc/loadavg | sed s/^/load=/; cut -d. -f1 /proc/uptime | sed s/^/uptime=/",
+    "facts_ttl": "600",
+    # interactive mode keeps the hosts of recently used groups around
+    "cache_hosts": "100000",
+    "cache_idle": "900",
 }
 
-METHODS = ["ssh", "rsh"]
+METHODS = ["ssh", "rsh", "local"]
+
+# how hosts that are reachable more than once from a group are treated
+DUPLICATES = ["first", "last"]
 
 __user_dir = os.path.join(os.environ["HOME"], ".tentakel")
 __user_plugin_dir = os.path.join(__user_dir, "plugins")
+__user_cache_dir = os.path.join(__user_dir, "cache")
 
 
 class ConfigParser(tpg.Parser):
@@ -81,12 +132,17 @@ class ConfigParser(tpg.Parser):
     token eq       : '='      str ;
     token word     : '\w+'      str ;
     token vchar    : '""|[^"]'    str ;
-    token hitem    : '\+[-\w\.:]+'    str ;
+    token hitem    : '\+[-\w\.:\[\],]+'    str ;
     token litem    : '@\w+'    str ;
+    token xhitem   : '-[\w\.:\[][-\w\.:\[\],]*'    str ;
+    token xlitem   : '-@\w+'    str ;
+    token ilitem   : '&@\w+'    str ;
+    token citem    : '\((?:[^()]|\([^()]*\))*\)\+[-\w\.:\[\],]+'    str ;
+    token label    : '[-\w\.:]+'    str ;
 
     separator spaces  : '\s+' ;
 
-    START/e ->      $ e = {{"groups": {{}}, "settings": PARAMS}}
+    START/e ->      $ e = {{"groups": {{}}, "settings": dict(PARAMS)}}
     (  SETTING/s    $ e["settings"].update(s)
       | GROUP/g     $ e["groups"][g["name"]] = g
       | COMMENT
@@ -123,14 +179,34 @@ class ConfigParser(tpg.Parser):
       '\)'
     ;
 
-    MEMBERS/l ->  $ l = {{"hosts": [], "lists": []}}
-      ( hitem/i   $ l["hosts"].append(i[1:])
+    LABELS/s ->           $ s = {{}}
+      '\{{'
+        LABEL/<k,v>       $ s[k] = v
+        ( ',' LABEL/<k,v> $ s[k] = v
+        )*
+      '\}}'
+    ;
+
+    LABEL/<k,v> -> word/k eq label/v ;
+
+    MEMBERS/l ->  $ l = ConfigGroup.empty_members()
+      ( ( hitem/i   $ l["hosts"].append(i[1:])
+        | citem/c   $ i = ConfigGroup.add_conditional(l, c)
+        )
+        ( LABELS/s  $ l["labels"].setdefault(i[1:], {{}}).update(s)
+        )?
+        ( GROUPSPEC/s  $ if s: l["overrides"][i[1:]] = s
+        )?
       | litem/i   $ l["lists"].append(i[1:])
+      | xlitem/i  $ l["exclude_lists"].append(i[2:])
+      | xhitem/i  $ l["exclude_hosts"].append(i[1:])
+      | ilitem/i  $ l["intersect_lists"].append(i[2:])
       | COMMENT
       )*
     ;
     """.format(
-        keywords="|".join(PARAMS.keys())
+        # longest first, so that no keyword shadows another one
+        keywords="|".join(sorted(PARAMS.keys(), key=len, reverse=True))
     )
 
 
@@ -143,16 +219,234 @@ class ConfigGroup(dict):
         # create keys that are also available globally, but with default values stripped
         p = dict(list(zip(list(PARAMS.keys()), [""] * len(PARAMS))))
         self.update(p)
-        self["hosts"] = []
-        self["lists"] = []
+        self.update(self.empty_members())
+
+    @staticmethod
+    def empty_members():
+        return {
+            "hosts": [],
+            "lists": [],
+            # per host parameters, only those that differ from the group's
+            "overrides": {},
+            # host labels, a host has all the labels given to it anywhere
+            "labels": {},
+            # host -> condition on its facts for it to be included
+            "conditions": {},
+            # set operations, applied after all hosts and lists are included
+            "exclude_hosts": [],
+            "exclude_lists": [],
+            "intersect_lists": [],
+        }
+
+    @staticmethod
+    def add_conditional(members, item: str) -> str:
+        """Add conditional host item (condition)+host to members. Return the
+        host item, as if it had no condition."""
+
+        condition, _, host = item[1:].rpartition(")+")
+        members["hosts"].append(host)
+        members["conditions"][host] = condition.strip()
+        return "+" + host
 
     def __str__(self):
-        groups = []
-        for param in PARAMS.keys():
-            if self[param]:
-                groups.append('{}="{}"'.format(param, re.sub('"', '""', self[param])))
+        return f"group {self['name']} ({format_params(self)})"
+
+    def sub_lists(self) -> list[str]:
+        """Return the names of all groups this group refers to."""
+        return self["lists"] + self["intersect_lists"] + self["exclude_lists"]
+
+
+class Host:
+    """A host to run commands on, as found in the configuration.
+
+    Holds the host name and the (shared) parameters it is run with. Hosts
+    unpack like (name, params) tuples.
+    """
+
+    __slots__ = ("name", "params")
+
+    def __init__(self, name: str, params):
+        self.name = name
+        self.params = params
+
+    def __iter__(self):
+        return iter((self.name, self.params))
+
+    def __repr__(self):
+        return f"Host({self.name!r})"
+
+
+class Expansion:
+    """Expanded member lists of all groups in a configuration.
+
+    Hosts are interned in the HostTable hosts. members maps every group
+    name to a list of (bits, group) tuples, where bits is the bitset of
+    the hosts that take their parameters from group. The bitsets of a
+    group's list are disjoint.
+
+    Groups that are part of a loop or include one are not in members,
+    instead loops maps them to the offending path of group names.
+    warnings maps group names to the warnings that should be reported
+    when the group is used.
+    """
 
-        return f"group {self['name']} ({', '.join(groups)})"
+    def __init__(self):
+        self.hosts = hostset.HostTable()
+        self.members: dict[str, list[tuple[int, str]]] = {}
+        self.loops: dict[str, list[str]] = {}
+        self.warnings: dict[str, list[str]] = {}
+        self.bits: dict[str, int] = {}
+        # group name -> bitset of the hosts listed in the group itself
+        self.own: dict[str, int] = {}
+        # group name -> {host index: parameter overrides}
+        self.overrides: dict[str, dict[int, dict]] = {}
+        # group name -> [(bits, condition)]
+        self.conditions: dict[str, list[tuple[int, str]]] = {}
+        # group name -> its own hosts in the order they are listed, as
+        # host indexes and range bitsets, for the groups where that is
+        # not index order
+        self.listed: dict[str, list[int | tuple[int]]] = {}
+
+    def group_bits(self, group_name: str) -> int:
+        """Return the bitset of the members of group_name."""
+
+        try:
+            return self.bits[group_name]
+        except KeyError:
+            bits = 0
+            for b, _ in self.members[group_name]:
+                bits |= b
+            self.bits[group_name] = bits
+            return bits
+
+    def indexes(self, bits: int, group_name: str):
+        """Yield the indexes of the hosts in bitset bits, which take their
+        parameters from group_name, in the order the group lists them."""
+
+        listed = self.listed.get(group_name)
+        if listed is None:
+            yield from hostset.indexes(bits)
+            return
+        seen = set()
+        for entry in listed:
+            if isinstance(entry, tuple):
+                found = hostset.indexes(bits & entry[0])
+            elif bits >> entry & 1:
+                found = (entry,)
+            else:
+                continue
+            for i in found:
+                if i not in seen:
+                    seen.add(i)
+                    yield i
+        if len(seen) < hostset.count(bits):
+            # not listed by the group itself
+            for i in hostset.indexes(bits):
+                if i not in seen:
+                    yield i
+
+    def set_listed(self, group_name: str, items: list):
+        """Remember the order of the host names and ranges items listed by
+        group_name, unless it is index order. They must be interned."""
+
+        listed: list[int | tuple[int]] = []
+        last = -1
+        ordered = True
+        for item in items:
+            if isinstance(item, hostset.HostRange):
+                bits = self.hosts.intern_range(item)
+                low, high = (bits & -bits).bit_length() - 1, bits.bit_length() - 1
+                listed.append((bits,))
+            else:
+                low = high = self.hosts.intern(item)
+                listed.append(low)
+            ordered = ordered and low > last
+            last = max(last, high)
+        if not ordered:
+            self.listed[group_name] = listed
+
+
+class GroupMembers:
+    """The hosts of a group, or of a group expression.
+
+    Iterating creates the Host records one at a time, host ranges are
+    only expanded then. len() and membership tests work on the bitsets.
+    """
+
+    def __init__(self, conf: ConfigBase, segments: list[tuple[int, str]]):
+        self.conf = conf
+        self.segments = segments
+        self.expansion = conf.expand_groups()
+        self.hosts = self.expansion.hosts
+
+    def __len__(self):
+        return sum(hostset.count(bits) for bits, _ in self.segments)
+
+    def __contains__(self, name):
+        i = self.hosts.find(name)
+        return i is not None and any(bits >> i & 1 for bits, _ in self.segments)
+
+    def __iter__(self):
+        conf = self.conf
+        for bits, group_name in self.segments:
+            params = conf.get_group_params(group_name)
+            overrides = conf.get_host_overrides(group_name)
+            for i in self.expansion.indexes(bits, group_name):
+                if i in overrides:
+                    yield Host(self.hosts.name(i), ChainMap(MappingProxyType(overrides[i]), params))
+                else:
+                    yield Host(self.hosts.name(i), params)
+
+    def bits(self) -> int:
+        """Return the bitset of the members."""
+
+        out = 0
+        for bits, _ in self.segments:
+            out |= bits
+        return out
+
+    def domains(self, key: str) -> dict[str, str]:
+        """Return the topology domain of the members, by host name: the
+        value of their label key, or the group they take their parameters
+        from if key is "group"."""
+
+        out = {}
+        for name, bits in hostset.partition(self.hosts, self.segments, key):
+            for host in self.hosts.names(bits):
+                out[host] = name
+        return out
+
+    def conditions(self) -> dict[str, str]:
+        """Return the conditions the members are included on, by host
+        name. Hosts without conditions are left out."""
+
+        out = {}
+        for bits, group_name in self.segments:
+            for cbits, condition in self.conf.get_host_conditions(group_name):
+                for name in self.hosts.names(bits & cbits):
+                    out[name] = condition
+        return out
+
+    def restrict(self, bits: int) -> GroupMembers:
+        """Return the members that are also in bitset bits."""
+
+        return GroupMembers(self.conf, merge_segments([(b & bits, g) for b, g in self.segments]))
+
+    def names(self, start: int = 0, count: int | None = None) -> list[str]:
+        """Return the host names, or count of them from position start."""
+
+        out: list[str] = []
+        for bits, group_name in self.segments:
+            n = hostset.count(bits)
+            if start >= n:
+                start -= n
+                continue
+            stop = None if count is None else start + count - len(out)
+            out += [self.hosts.name(i) for i in islice(self.expansion.indexes(bits, group_name), start, stop)]
+            start = 0
+            if count is not None and len(out) >= count:
+                break
+        return out
 
 
 class ConfigBase(dict):
@@ -166,18 +460,28 @@ class ConfigBase(dict):
     method can be used directly on a file.
 
     The configuration can be written to a file with the dump method.
+
+    Groups are expanded all at once, the first time members are asked for,
+    and the result is kept in the expansion attribute until the
+    configuration changes.
     """
 
+    expansion: Expansion | None
+
     def __init__(self):
         super().__init__()
         self["groups"] = {}
         self["settings"] = PARAMS
+        self.expansion = None
+        self._group_params = {}
 
     def parse(self, txt):
         """Parse a string containing configuration directives into the
         configuration tree."""
         parser = ConfigParser()
         self.update(parser(txt))
+        self.expansion = None
+        self._group_params = {}
 
     def load(self, path: str | Path):
         """Load configuration from file."""
@@ -217,15 +521,12 @@ class ConfigBase(dict):
     def edit(self):
         """Interactively edit configuration."""
 
-        tempedit = tempfile.NamedTemporaryFile()
-        try:
+        with tempfile.NamedTemporaryFile() as tempedit:
             self.dump(tempedit.name)
             tempedit.seek(0, 0)
             editor = os.getenv("VISUAL") or os.getenv("EDITOR") or "vi"
             os.spawnvp(os.P_WAIT, editor, [editor, tempedit.name])
             self.load(Path(tempedit.name))
-        finally:
-            tempedit.close()
 
     def __str__(self):
         """Pretty print configuration."""
@@ -234,15 +535,32 @@ class ConfigBase(dict):
         settings = self["settings"]
         for s_param, s_value in settings.items():
             if s_value:
-                out = f'{out}set {s_param}="{s_value}"\n'
+                out = out + 'set {}="{}"\n'.format(s_param, re.sub('"', '""', s_value))
         out += "\n"
         groups = self["groups"]
-        for group_name, group_obj in groups.items():
+        for group_obj in groups.values():
             out = out + str(group_obj) + "\n"
-            for list in groups[group_name]["lists"]:
+            for list in group_obj["lists"]:
                 out = out + "\t@" + list + "\n"
-            for host in groups[group_name]["hosts"]:
-                out = out + "\t+" + host + "\n"
+            overrides = group_obj["overrides"]
+            labels = group_obj["labels"]
+            conditions = group_obj["conditions"]
+            for host in group_obj["hosts"]:
+                out = out + "\t"
+                if host in conditions:
+                    out = out + f"({conditions[host]})"
+                out = out + "+" + host
+                if host in labels:
+                    out = out + "{" + ",".join(f"{k}={v}" for k, v in labels[host].items()) + "}"
+                if host in overrides:
+                    out = out + f"({format_params(overrides[host])})"
+                out += "\n"
+            for list in group_obj["intersect_lists"]:
+                out = out + "\t&@" + list + "\n"
+            for list in group_obj["exclude_lists"]:
+                out = out + "\t-@" + list + "\n"
+            for host in group_obj["exclude_hosts"]:
+                out = out + "\t-" + host + "\n"
             out += "\n"
         return out
 
@@ -256,23 +574,235 @@ class ConfigBase(dict):
 
         return self["groups"][group_name]
 
-    def get_group_members(self, group_name: str):
+    def get_group_members(self, group_name: str) -> list[Host]:
         """Return list of group_name members with sub lists expanded
-        recursively."""
+        recursively.
 
-        group = self._get_group(group_name)
-        out = [(x, self.get_group_params(group_name)) for x in group["hosts"]]
-        for list in group["lists"]:
+        group_name may also be a group expression, see hostset.
+
+        The parameters of hosts from the same group are one shared,
+        read-only mapping. Hosts with parameters of their own get a
+        mapping that only stores the difference to their group's.
+        """
+
+        return list(self.get_members(group_name))
+
+    def get_members(self, group_name: str | None, selection: hostset.Selection | None = None) -> GroupMembers:
+        """Same as get_group_members, but return a GroupMembers object that
+        creates the host records only when iterated over.
+
+        If group_name is None, all hosts of the configuration are returned,
+        with the parameters of the first group that lists them. selection
+        restricts the hosts further.
+        """
+
+        if group_name is None:
+            members = GroupMembers(self, self._get_all_hosts())
+        elif group_name in self["groups"] or not hostset.is_expression(group_name):
+            members = GroupMembers(self, self._get_expanded_group(group_name))
+        else:
+            members = GroupMembers(self, self._evaluate(group_name))
+        if selection:
+            members = members.restrict(selection.bits(self.expand_groups().hosts, members.bits()))
+        return members
+
+    def _get_all_hosts(self):
+        """Return the hosts listed in any group, as segments of the first
+        group listing them."""
+
+        expansion = self.expand_groups()
+        bits = ~0
+        out = []
+        for group_name, own in expansion.own.items():
+            out.append((own & bits, group_name))
+            bits &= ~own
+        return merge_segments(out)
+
+    def _get_expanded_group(self, group_name: str):
+        """Return the expanded members of group_name, reporting problems."""
+
+        expansion = self.expand_groups()
+        if group_name in expansion.loops:
+            loop = " -> ".join(expansion.loops[group_name])
+            raise Abort(f"loop in configuration file: {loop}")
+        for warning in expansion.warnings.get(group_name, []):
+            error.warn(warning)
+        return expansion.members[group_name]
+
+    def _evaluate(self, text: str):
+        """Return the members of group expression text.
+
+        Hosts take the parameters of the first group of the expression
+        they are a member of.
+        """
+
+        tree = hostset.parse_expression(text)
+        names = list_unique(hostset.leaves(tree))
+        segments = [m for name in names for m in self._get_expanded_group(name)]
+        bits = hostset.evaluate(tree, self.expand_groups().group_bits)
+        out = []
+        for b, g in segments:
+            b &= bits
+            bits &= ~b
+            out.append((b, g))
+        return merge_segments(out)
+
+    def get_host_overrides(self, group_name: str) -> dict[int, dict]:
+        """Return the parameter overrides of the hosts of group_name, keyed
+        by host index."""
+
+        expansion = self.expand_groups()
+        try:
+            return expansion.overrides[group_name]
+        except KeyError:
+            pass
+        out = {}
+        for text, params in self._get_group(group_name)["overrides"].items():
             try:
-                out += self.get_group_members(list)
-            except (KeyError, RuntimeError):  # pragma: nocover
-                if sys.exc_info()[0] == KeyError:
-                    error.warn(f"in group '{group_name}': no such group '{list}'")
-                if sys.exc_info()[0] == RuntimeError:
-                    raise Abort("runtime error: possible loop in configuration file")
+                bits = expansion.hosts.bits([hostset.parse_host(text)])
+            except ValueError:
+                continue
+            for i in hostset.indexes(bits):
+                out[i] = params
+        expansion.overrides[group_name] = out
+        return out
+
+    def get_host_conditions(self, group_name: str) -> list[tuple[int, str]]:
+        """Return the conditions on the facts of the hosts of group_name,
+        as (bits, condition) tuples."""
+
+        expansion = self.expand_groups()
+        try:
+            return expansion.conditions[group_name]
+        except KeyError:
+            pass
+        out = []
+        for text, condition in self._get_group(group_name)["conditions"].items():
+            try:
+                out.append((expansion.hosts.bits([hostset.parse_host(text)]), condition))
+            except ValueError:
+                continue
+        expansion.conditions[group_name] = out
+        return out
+
+    def expand_groups(self) -> Expansion:
+        """Expand the member lists of all groups.
+
+        All hosts are interned first, ranges before host names so that
+        ranges get blocks of indexes. Then the group graph is walked depth
+        first, once, and every group is expanded after all of its sub
+        lists. Loops are detected on the way.
+        """
+
+        if self.expansion is not None:
+            return self.expansion
 
+        expansion = Expansion()
+        groups = self["groups"]
+        items: dict[str, tuple[list, list]] = {}
+        for group_name, group in groups.items():
+            items[group_name] = (
+                self._parse_hosts(group_name, group["hosts"], expansion),
+                self._parse_hosts(group_name, group["exclude_hosts"], expansion),
+            )
+            for item in items[group_name][0] + items[group_name][1]:
+                if isinstance(item, hostset.HostRange):
+                    expansion.hosts.intern_range(item)
+        own = {name: (expansion.hosts.bits(i), expansion.hosts.bits(x)) for name, (i, x) in items.items()}
+        for group_name, group in groups.items():
+            expansion.own[group_name] = own[group_name][0]
+            expansion.set_listed(group_name, items[group_name][0])
+            for text, labels in group["labels"].items():
+                try:
+                    bits = expansion.hosts.bits([hostset.parse_host(text)])
+                except ValueError:
+                    continue
+                expansion.hosts.add_labels(bits, labels)
+
+        for root in groups:
+            if root in expansion.members or root in expansion.loops:
+                continue
+            path = [root]
+            todo = [iter(groups[root].sub_lists())]
+            while path:
+                name = path[-1]
+                sub = next(todo[-1], None)
+                if sub is None:
+                    self._expand_group(name, own[name], expansion)
+                    path.pop()
+                    todo.pop()
+                elif sub in expansion.members or sub in expansion.loops or sub not in groups:
+                    continue
+                elif sub in path:
+                    first = path.index(sub)
+                    loop = path[first:] + [sub]
+                    for group_name in path:
+                        expansion.loops.setdefault(group_name, loop)
+                else:
+                    path.append(sub)
+                    todo.append(iter(groups[sub].sub_lists()))
+
+        self.expansion = expansion
+        return expansion
+
+    def _parse_hosts(self, group_name: str, hosts: list[str], expansion: Expansion) -> list:
+        """Return hosts as host names and HostRange objects."""
+
+        out = []
+        for text in hosts:
+            try:
+                out.append(hostset.parse_host(text))
+            except ValueError as exc:
+                expansion.warnings.setdefault(group_name, []).append(f"in group '{group_name}': {exc}")
         return out
 
+    def _expand_group(self, group_name: str, own: tuple[int, int], expansion: Expansion):
+        """Expand group_name, whose sub lists must already be expanded.
+        own holds the bitsets of the group's own hosts and excluded hosts."""
+
+        group = self._get_group(group_name)
+        warnings = expansion.warnings.get(group_name, [])
+        for sub in group.sub_lists():
+            if sub in expansion.loops:
+                expansion.loops.setdefault(group_name, expansion.loops[sub])
+            elif sub in expansion.members:
+                warnings += expansion.warnings.get(sub, [])
+            else:
+                warnings.append(f"in group '{group_name}': no such group '{sub}'")
+
+        if group_name in expansion.loops:
+            return
+        if warnings:
+            expansion.warnings[group_name] = list_unique(warnings)
+
+        segments = [(own[0], group_name)]
+        for sub in group["lists"]:
+            segments += expansion.members.get(sub, [])
+
+        policy = self.get_param("duplicates", group_name)
+        if policy not in DUPLICATES:  # pragma: nocover
+            error.warn(f"in group '{group_name}': invalid duplicates policy '{policy}'")
+            policy = "first"
+        if policy == "last":
+            segments.reverse()
+
+        bits = ~own[1]
+        for sub in group["intersect_lists"]:
+            bits &= expansion.group_bits(sub) if sub in expansion.members else 0
+        for sub in group["exclude_lists"]:
+            if sub in expansion.members:
+                bits &= ~expansion.group_bits(sub)
+
+        out = []
+        for b, g in segments:
+            b &= bits
+            bits &= ~b
+            out.append((b, g))
+        if policy == "last":
+            out.reverse()
+
+        expansion.members[group_name] = merge_segments(out)
+
     def get_param(self, param: str, group=None):
         """Return the value for param.
 
@@ -283,7 +813,7 @@ class ConfigBase(dict):
         If param is not a valid parameter identifier, return None
         """
 
-        if param not in PARAMS.keys():  # pragma: nocover
+        if param not in PARAMS:  # pragma: nocover
             error.warn(f"invalid parameter: '{param}'")
             return None
         else:
@@ -297,6 +827,49 @@ class ConfigBase(dict):
                 return self["settings"][param]
 
     def get_group_params(self, group_name):
-        """Return complete configuration for the group group_name."""
+        """Return complete configuration for the group group_name.
+
+        The configuration is resolved once per group and shared between
+        callers, so it is returned as a read-only mapping.
+        """
+
+        try:
+            return self._group_params[group_name]
+        except KeyError:
+            params = MappingProxyType({k: self.get_param(k, group_name) for k in PARAMS})
+            self._group_params[group_name] = params
+            return params
+
+
+def format_params(params) -> str:
+    """Format the non-empty parameters in params as in a group statement."""
+
+    out = []
+    for param in PARAMS:
+        if params.get(param):
+            out.append('{}="{}"'.format(param, re.sub('"', '""', params[param])))
+    return ", ".join(out)
+
+
+def merge_segments(segments: list[tuple[int, str]]) -> list[tuple[int, str]]:
+    """Merge the (bits, group) segments of the same group, dropping the
+    empty ones. The order of the groups is kept."""
+
+    merged: dict[str, int] = {}
+    for bits, group_name in segments:
+        if bits:
+            merged[group_name] = merged.get(group_name, 0) | bits
+    return [(bits, group_name) for group_name, bits in merged.items()]
+
+
+def list_unique(items, key=None):
+    """Return items without duplicates, keeping the first occurrence."""
 
-        return {k: self.get_param(k, group_name) for k in PARAMS.keys()}
+    seen = set()
+    out = []
+    for item in items:
+        k = item if key is None else key(item)
+        if k not in seen:
+            seen.add(k)
+            out.append(item)
+    return out
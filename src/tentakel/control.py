@@ -0,0 +1,507 @@
+#
+# Copyright (c) 2002, 2003, 2004, 2005 Sebastian Stark
+# Copyright (c) 2019-2023 Stefane Fermigier
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR SEBASTIAN STARK
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Flow control for running a command on many hosts.
+
+The collator's workers ask a ConcurrencyLimit before they start the
+command on a host, and tell it how it went when it is done. The limit
+is either fixed, from maxparallel, or an AdaptiveLimit that finds the
+largest number of hosts that can be run at the same time without
+slowing down or failing.
+
+Before that, SpawnRate spreads the starts over time, so that hundreds of
+connections are not opened in the same instant, and DomainLimit keeps
+the commands running in every rack or datacenter in check.
+
+govern() keeps the number of commands run at once within what the local
+machine can afford, in file descriptors, processes and memory.
+
+Whatever happens during a run is counted in its RunMetrics, including
+the decisions of the limits, and summed up with --stats.
+
+History remembers how long a command took on every host, so that when
+not all hosts can run at once, the slowest ones start first, and the
+duration of the next run can be predicted:
+
+  history = History(cache.ttl_cache("history"), "uptime", ttl=30 * 86400)
+  objs = history.order(objs)
+  predict([history.expected(obj.destination) or 0 for obj in objs], 64)
+"""
+
+from __future__ import annotations
+
+import hashlib
+import heapq
+import os
+import random
+import resource
+import threading
+import time
+
+from .cache import TTLCache
+
+
+class RunMetrics:
+    """Counters and events of a run."""
+
+    def __init__(self, hosts: int = 0):
+        self.start = time.monotonic()
+        self.end: float | None = None
+        self.hosts = hosts
+        self.started = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.transport_errors = 0
+        self.most_running = 0
+        # starts delayed by the spawn rate, and for how long in total
+        self.throttled = 0
+        self.throttled_time = 0.0
+        # starts delayed because their domain was full
+        self.domain_waits = 0
+        # (seconds since the start, what was decided)
+        self.decisions: list[tuple[float, str]] = []
+
+    def log(self, decision: str):
+        """Record a decision taken during the run."""
+
+        self.decisions.append((time.monotonic() - self.start, decision))
+
+    def merge(self, state: dict, prefix: str):
+        """Add the metrics of a part of the run, run by another process,
+        from the attributes of its RunMetrics. Its decisions are logged
+        with prefix."""
+
+        for name in (
+            "started",
+            "succeeded",
+            "failed",
+            "transport_errors",
+            "most_running",
+            "throttled",
+            "throttled_time",
+            "domain_waits",
+        ):
+            setattr(self, name, getattr(self, name) + state[name])
+        # the times are those from the start of the part, which started
+        # with the run, give or take the time it took to start it
+        self.decisions += [(t, prefix + decision) for t, decision in state["decisions"]]
+        self.decisions.sort()
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.monotonic()
+
+    def summary(self) -> list[str]:
+        """Return the metrics, line by line."""
+
+        duration = (self.end or time.monotonic()) - self.start
+        out = [
+            (
+                f"hosts: {self.hosts}, started: {self.started}, succeeded: {self.succeeded}, "
+                f"failed: {self.failed} ({self.transport_errors} transport errors)"
+            ),
+            f"wall time: {duration:.2f}s, most running at once: {self.most_running}",
+        ]
+        if self.throttled:
+            out.append(f"starts delayed by spawnrate: {self.throttled}, for {self.throttled_time:.2f}s in total")
+        if self.domain_waits:
+            out.append(f"starts delayed by domainparallel: {self.domain_waits}")
+        out += [f"  {t:7.2f}s {decision}" for t, decision in self.decisions]
+        return out
+
+
+class ConcurrencyLimit:
+    """Runs at most limit commands at the same time, or any number if limit
+    is 0."""
+
+    def __init__(self, limit: int, metrics: RunMetrics):
+        self.limit = limit
+        self.metrics = metrics
+        self.running = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, stop: threading.Event) -> bool:
+        """Wait until one more command may start. Return False if stop was
+        set in the meantime."""
+
+        with self.cond:
+            while self.limit and self.running >= self.limit and not stop.is_set():
+                self.cond.wait()
+            if stop.is_set():
+                return False
+            self.running += 1
+            self.metrics.started += 1
+            self.metrics.most_running = max(self.metrics.most_running, self.running)
+            return True
+
+    def release(self, result=None, transport_error: bool = False):
+        """A command ended with result, a remote.Result, or was not started
+        after all if result is None."""
+
+        with self.cond:
+            self.running -= 1
+            if result is not None:
+                if result.status == 0:
+                    self.metrics.succeeded += 1
+                else:
+                    self.metrics.failed += 1
+                if transport_error:
+                    self.metrics.transport_errors += 1
+                self.adjust(result.duration, transport_error)
+            self.cond.notify_all()
+
+    def adjust(self, duration: float, transport_error: bool):
+        """Change the limit after a command ended. Called with cond held."""
+
+    def wake(self):
+        """Wake up the workers waiting to start a command, so that they see
+        that they have to stop."""
+
+        with self.cond:
+            self.cond.notify_all()
+
+
+class AdaptiveLimit(ConcurrencyLimit):
+    """A limit between floor and ceiling, adjusted with AIMD.
+
+    Starting from floor, the limit doubles for every limit commands that
+    end well (slow start), until the first sign of overload. From then on
+    it grows by one only. Overload is a transport error, or a command that
+    took more than TOLERANCE times as long as the commands so far on
+    average, weighing the last ones most, once there are WARMUP of them;
+    the limit is then halved, at most once per limit commands so that it
+    reacts to the commands started at the old limit only once.
+    """
+
+    TOLERANCE = 2.0
+    WARMUP = 5
+    # weight of the last command in the average, the first ones count alike
+    WEIGHT = 0.2
+
+    def __init__(self, floor: int, ceiling: int, metrics: RunMetrics):
+        super().__init__(max(floor, 1), metrics)
+        self.floor = max(floor, 1)
+        self.ceiling = max(ceiling, self.floor)
+        self.window = float(self.limit)
+        self.slow_start = True
+        self.average = 0.0
+        self.ended = 0
+        self.since_decrease = 0
+        metrics.log(f"adaptive limit: starting at {self.limit}, between {self.floor} and {self.ceiling}")
+
+    def adjust(self, duration: float, transport_error: bool):
+        self.since_decrease += 1
+        slow = self.ended >= self.WARMUP and duration > self.TOLERANCE * self.average
+        if not transport_error:
+            self.ended += 1
+            self.average += max(self.WEIGHT, 1 / self.ended) * (duration - self.average)
+
+        if transport_error or slow:
+            if self.since_decrease < self.limit:
+                return
+            self.since_decrease = 0
+            self.slow_start = False
+            self.window = max(self.window / 2, self.floor)
+            reason = "transport error" if transport_error else f"command took {duration:.2f}s"
+            self._set(f"{reason}, down to")
+        else:
+            self.window = min(self.window + (1 if self.slow_start else 1 / self.window), self.ceiling)
+            self._set("up to")
+
+    def _set(self, decision: str):
+        limit = int(self.window)
+        if limit != self.limit:
+            if limit < self.limit or limit == self.ceiling or limit & (limit - 1) == 0:
+                # log decreases, and increases to powers of two only
+                self.metrics.log(f"adaptive limit: {decision} {limit}")
+            self.limit = limit
+
+
+class SpawnRate:
+    """Paces the starts of the commands of a run.
+
+    Starts are limited by a token bucket, refilled with rate tokens per
+    second, up to burst tokens: on average no more than rate commands
+    start per second, and no more than burst at once. A rate of 0 means
+    no limit.
+
+    Besides, every host gets a random delay of up to jitter seconds from
+    the beginning of the run, before which it is not started, so that the
+    first commands don't all start at once either.
+    """
+
+    def __init__(self, rate: float, burst: int, jitter: float, metrics: RunMetrics):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.jitter = jitter
+        self.metrics = metrics
+        self.start = time.monotonic()
+        self.tokens = float(self.burst)
+        self.stamp = self.start
+        self.lock = threading.Lock()
+
+    def stagger(self, stop: threading.Event) -> bool:
+        """Wait for the random start delay of a host. Return False if stop
+        was set in the meantime."""
+
+        if self.jitter:
+            delay = self.start + random.uniform(0, self.jitter) - time.monotonic()
+            if delay > 0:
+                return not stop.wait(delay)
+        return not stop.is_set()
+
+    def wait(self, stop: threading.Event) -> bool:
+        """Take a token, waiting for it if the bucket is empty. Return
+        False if stop was set in the meantime."""
+
+        if not self.rate:
+            return not stop.is_set()
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.stamp) * self.rate, self.burst)
+            self.stamp = now
+            # the token is taken right away, and the next ones are reserved
+            # for the threads that come later
+            self.tokens -= 1
+            delay = -self.tokens / self.rate
+            if delay > 0:
+                self.metrics.throttled += 1
+                self.metrics.throttled_time += delay
+        if delay > 0:
+            return not stop.wait(delay)
+        return not stop.is_set()
+
+
+# what a running command costs locally: pipes, the worker thread, the
+# shell and the transport client, and their memory
+FDS_PER_HOST = 4
+TASKS_PER_HOST = 3
+MEMORY_PER_HOST = 8 << 20
+# commands run at most per CPU, as they are mostly waiting
+HOSTS_PER_CPU = 256
+# file descriptors and processes left for everything else
+RESERVE = 64
+
+
+def govern(wanted: int, metrics: RunMetrics) -> int:
+    """Return how many of wanted commands can run at the same time on this
+    machine, at most.
+
+    The soft limits on open files and processes are raised as far as
+    needed and allowed first. Then the number is bounded by those limits,
+    the available memory and the number of CPUs. The decisions are logged
+    in metrics.
+    """
+
+    bounds = {"CPU count": (os.cpu_count() or 1) * HOSTS_PER_CPU}
+
+    nofile = _raise_limit(resource.RLIMIT_NOFILE, "RLIMIT_NOFILE", RESERVE + wanted * FDS_PER_HOST, metrics)
+    if nofile != resource.RLIM_INFINITY:
+        bounds["RLIMIT_NOFILE"] = (nofile - RESERVE - _open_fds()) // FDS_PER_HOST
+
+    nproc = _raise_limit(resource.RLIMIT_NPROC, "RLIMIT_NPROC", RESERVE + wanted * TASKS_PER_HOST, metrics)
+    if nproc != resource.RLIM_INFINITY and os.geteuid() != 0:
+        bounds["RLIMIT_NPROC"] = (nproc - RESERVE - threading.active_count()) // TASKS_PER_HOST
+
+    memory = _available_memory()
+    if memory is not None:
+        bounds["available memory"] = memory // MEMORY_PER_HOST
+
+    reason = min(bounds, key=lambda name: bounds[name])
+    allowed = max(bounds[reason], 1)
+    if allowed < wanted:
+        metrics.log(f"governor: at most {allowed} hosts at once instead of {wanted}, because of {reason}")
+        return allowed
+    return wanted
+
+
+def _raise_limit(limit: int, name: str, needed: int, metrics: RunMetrics) -> int:
+    """Raise the soft resource limit to needed, or to the hard limit if
+    that is lower. Return the soft limit."""
+
+    soft, hard = resource.getrlimit(limit)
+    if soft == resource.RLIM_INFINITY or soft >= needed:
+        return soft
+    new = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+    if new > soft:
+        try:
+            resource.setrlimit(limit, (new, hard))
+        except (OSError, ValueError):
+            return soft
+        metrics.log(f"governor: raised the soft {name} from {soft} to {new}")
+        return new
+    return soft
+
+
+def _open_fds() -> int:
+    """Return the number of file descriptors open in this process."""
+
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return 0
+
+
+def _available_memory() -> int | None:
+    """Return the number of bytes of memory available, if known."""
+
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class DomainLimit:
+    """Runs at most limit commands at the same time in every topology
+    domain, or any number if limit is 0."""
+
+    def __init__(self, limit: int, metrics: RunMetrics):
+        self.limit = limit
+        self.metrics = metrics
+        # domain -> number of commands running there
+        self.running: dict[str, int] = {}
+        self.cond = threading.Condition()
+
+    def acquire(self, domain: str, stop: threading.Event) -> bool:
+        """Wait until one more command may start in domain. Return False if
+        stop was set in the meantime."""
+
+        if not self.limit:
+            return not stop.is_set()
+        with self.cond:
+            if self.running.get(domain, 0) >= self.limit:
+                self.metrics.domain_waits += 1
+            while self.running.get(domain, 0) >= self.limit and not stop.is_set():
+                self.cond.wait()
+            if stop.is_set():
+                return False
+            self.running[domain] = self.running.get(domain, 0) + 1
+            return True
+
+    def release(self, domain: str):
+        if not self.limit:
+            return
+        with self.cond:
+            self.running[domain] -= 1
+            self.cond.notify_all()
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+
+def interleave(objs: list, domains: dict[str, str]) -> list:
+    """Return the RemoteCommand objects objs taking one host of every
+    domain in turn, keeping the order of the hosts of each domain. domains
+    maps host names to their domain."""
+
+    by_domain: dict[str, list] = {}
+    for obj in objs:
+        by_domain.setdefault(domains.get(obj.destination, ""), []).append(obj)
+    out = []
+    rounds = [iter(hosts) for hosts in by_domain.values()]
+    while rounds:
+        left = []
+        for hosts in rounds:
+            obj = next(hosts, None)
+            if obj is not None:
+                out.append(obj)
+                left.append(hosts)
+        rounds = left
+    return out
+
+
+class History:
+    """Durations of a command on the hosts it ran on before.
+
+    They are kept in store, by host and by fingerprint of the command, for
+    ttl seconds after they were last updated. A new duration is averaged
+    with the previous ones, giving it a weight of WEIGHT.
+    """
+
+    WEIGHT = 0.5
+
+    def __init__(self, store: TTLCache, command: str, ttl: float):
+        self.store = store
+        self.fingerprint = fingerprint(command)
+        self.ttl = ttl
+
+    def expected(self, destination: str) -> float | None:
+        """Return how long the command is expected to take on destination,
+        or None if it never ran there."""
+
+        return self.store.get((destination, self.fingerprint))
+
+    def record(self, destination: str, duration: float):
+        old = self.expected(destination)
+        if old is not None:
+            duration = self.WEIGHT * duration + (1 - self.WEIGHT) * old
+        self.store.put((destination, self.fingerprint), duration, self.ttl)
+
+    def estimates(self, destinations: list[str]) -> tuple[list[float], int]:
+        """Return the expected durations of the command on destinations,
+        and how many of them are known. The others are assumed to take the
+        average of the known ones."""
+
+        known = [self.expected(destination) for destination in destinations]
+        found = [d for d in known if d is not None]
+        average = sum(found) / len(found) if found else 0.0
+        return [average if d is None else d for d in known], len(found)
+
+    def order(self, objs: list) -> list:
+        """Return the RemoteCommand objects objs, longest expected first."""
+
+        durations, _ = self.estimates([obj.destination for obj in objs])
+        order = sorted(range(len(objs)), key=lambda i: -durations[i])
+        return [objs[i] for i in order]
+
+    def save(self):
+        self.store.save()
+
+
+def fingerprint(command: str) -> str:
+    """Return a short digest of command, to key its durations."""
+
+    return hashlib.sha1(" ".join(command.split()).encode()).hexdigest()[:16]
+
+
+def predict(durations: list[float], parallel: int = 0, rate: float = 0) -> float:
+    """Return the wall time of running commands lasting durations, in that
+    order, at most parallel (if not 0) at the same time and starting at
+    most rate (if not 0) per second."""
+
+    # times at which the slots become free
+    slots = [0.0] * min(parallel or len(durations), len(durations))
+    end = 0.0
+    for i, duration in enumerate(durations):
+        start = max(heapq.heappop(slots), i / rate if rate else 0.0)
+        heapq.heappush(slots, start + duration)
+        end = max(end, start + duration)
+    return end
@@ -0,0 +1,186 @@
+#
+# Copyright (c) 2002, 2003, 2004, 2005 Sebastian Stark
+# Copyright (c) 2019-2023 Stefane Fermigier
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR SEBASTIAN STARK
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Facts about hosts, and conditions on them.
+
+Facts are gathered by running a collector command on the hosts, whose
+output is made of key=value pairs, e.g. "load=0.42 uptime=86400". They
+are kept in a TTL cache, so that selecting hosts again soon after does
+not poll them again:
+
+  store = cache.ttl_cache("facts")
+  found, failed = facts.gather(objs, "collector", store, ttl=600)
+
+Conditions compare facts with each other or with constants, and combine
+comparisons with and, or, not and parentheses:
+
+  tree = facts.parse_condition("load < 2 and kernel != '4.19'")
+  facts.evaluate(tree, found["web1"])
+
+Values that look like numbers are compared as numbers, others as text.
+A comparison involving a missing fact is false.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import tpg
+from .cache import TTLCache
+from .error import Abort
+
+# largest number of collectors run at the same time, if not limited by
+# maxparallel
+THREADS = 64
+
+
+class ConditionParser(tpg.Parser):
+    r"""
+
+    separator spaces  : '\s+' ;
+
+    token number  : '-?\d+(\.\d*)?'  str ;
+    token string  : '"[^"]*"|\'[^\']*\''  str ;
+    token op      : '<=|>=|==|!=|<|>|='  str ;
+    token name    : '[A-Za-z_][\w\.]*'  str ;
+
+    START/e -> OR/e ;
+
+    OR/e -> AND/e
+      ( 'or\b' AND/f    $ e = ("or", e, f)
+      )*
+    ;
+
+    AND/e -> NOT/e
+      ( 'and\b' NOT/f   $ e = ("and", e, f)
+      )*
+    ;
+
+    NOT/e -> 'not\b' NOT/f    $ e = ("not", f)
+      | ATOM/e
+    ;
+
+    ATOM/e -> '\(' OR/e '\)'
+      | VALUE/a op/o VALUE/b  $ e = (o, a, b)
+    ;
+
+    VALUE/v -> number/n  $ v = ("value", n)
+      | string/s         $ v = ("value", s[1:-1])
+      | name/n           $ v = ("fact", n)
+    ;
+    """
+
+
+def parse_condition(text: str):
+    """Parse condition text into a tree of tuples."""
+
+    try:
+        return ConditionParser()(text)
+    except tpg.Error as excerr:
+        raise Abort(f"in condition '{text}': {excerr.msg}")
+
+
+def evaluate(tree, facts: dict[str, str]) -> bool:
+    """Tell whether condition tree holds for a host with facts."""
+
+    op = tree[0]
+    if op == "and":
+        return evaluate(tree[1], facts) and evaluate(tree[2], facts)
+    if op == "or":
+        return evaluate(tree[1], facts) or evaluate(tree[2], facts)
+    if op == "not":
+        return not evaluate(tree[1], facts)
+
+    a, b = _value(tree[1], facts), _value(tree[2], facts)
+    if a is None or b is None:
+        return False
+    try:
+        return _compare(op, float(a), float(b))
+    except ValueError:
+        return _compare(op, a, b)
+
+
+def _compare(op: str, a, b) -> bool:
+    """Compare values a and b, numbers or strings, with operator op."""
+
+    if op == "<":
+        return a < b
+    if op == "<=":
+        return a <= b
+    if op == ">":
+        return a > b
+    if op == ">=":
+        return a >= b
+    if op == "!=":
+        return a != b
+    return a == b
+
+
+def _value(leaf, facts: dict[str, str]) -> str | None:
+    kind, text = leaf
+    return text if kind == "value" else facts.get(text)
+
+
+def parse_facts(output: str) -> dict[str, str]:
+    """Return the key=value pairs in the output of a collector."""
+
+    out = {}
+    for word in output.split():
+        key, eq, value = word.partition("=")
+        if eq and key:
+            out[key] = value
+    return out
+
+
+def gather(objs, command: str, store: TTLCache, ttl: float, nthreads: int = 0):
+    """Return the facts of the hosts of the RemoteCommand objects objs, and
+    error messages for the hosts where they could not be gathered.
+
+    Facts found in store are used as is, the others are gathered by
+    running command on the hosts, nthreads (or THREADS) of them at a time,
+    and kept in store for ttl seconds.
+    """
+
+    found: dict[str, dict[str, str]] = {}
+    failed: dict[str, str] = {}
+    todo = []
+    for obj in objs:
+        known = store.get((obj.destination, command))
+        if known is None:
+            todo.append(obj)
+        else:
+            found[obj.destination] = known
+    if not todo:
+        return found, failed
+
+    with ThreadPoolExecutor(min(len(todo), nthreads or THREADS)) as executor:
+        for result in executor.map(lambda obj: obj.run_command(command), todo):
+            if result.status != 0:
+                failed[result.destination] = f"could not gather facts: {result.output}"
+                continue
+            found[result.destination] = parse_facts(result.output)
+            store.put((result.destination, command), found[result.destination], ttl)
+    return found, failed
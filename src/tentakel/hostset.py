@@ -0,0 +1,681 @@
+#
+# Copyright (c) 2002, 2003, 2004, 2005 Sebastian Stark
+# Copyright (c) 2019-2023 Stefane Fermigier
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR SEBASTIAN STARK
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Sets of hosts as bitsets.
+
+Hosts are interned in a HostTable, which gives each of them a small
+integer index. A set of hosts is then an int whose bit i is set when the
+host with index i is in the set, so that union, intersection and
+difference of large sets are single operations on ints:
+
+  table = HostTable()
+  web = table.bits(["a", "b", "c"])
+  canary = table.bits(["b"])
+  table.names(web & ~canary)  # ["a", "c"]
+
+Host ranges like node[0001-4096] or rack[1-8]-n[01-48] are HostRange
+objects. The table gives them a block of consecutive indexes without
+creating their host names, which are only computed when asked for.
+
+Hosts may carry key=value labels. The table keeps an inverted index from
+every label to the bitset of the hosts that have it, so that selecting
+hosts by label, e.g. role=web,dc=fra, is an intersection of bitsets.
+
+Group expressions, as given on the command line, combine groups with the
+| (union), & (intersection) and - (difference) operators. They bind like
+their Python counterparts on sets: - before & before |.
+"""
+
+from __future__ import annotations
+
+import fnmatch
+import random
+import re
+from bisect import bisect_left, bisect_right, insort
+
+from . import error, tpg
+from .error import Abort
+
+_RANGE = re.compile(r"\[([^\]]*)\]")
+
+
+class HostRange:
+    """A host name pattern with numeric ranges in brackets.
+
+    A range is a comma separated list of numbers and intervals, e.g.
+    [1-8] or [01,03,10-12]. Numbers are zero-padded to the width of the
+    lower bound when it starts with a zero. The last range varies fastest.
+    """
+
+    __slots__ = ("parts", "pattern", "regex", "sizes")
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        # literal parts alternating with tuples of (low, high, width)
+        self.parts: list = []
+        self.sizes: list[int] = []
+        regex = ""
+        pos = 0
+        for m in _RANGE.finditer(pattern):
+            start = m.start()
+            self.parts.append(pattern[pos:start])
+            regex += re.escape(pattern[pos:start]) + r"(\d+)"
+            intervals = []
+            for spec in m.group(1).split(","):
+                low, _, high = spec.partition("-")
+                high = high or low
+                if not (low.isdigit() and high.isdigit() and int(low) <= int(high)):
+                    raise ValueError(f"invalid host range: '{pattern}'")
+                width = len(low) if low.startswith("0") and len(low) > 1 else 0
+                intervals.append((int(low), int(high), width))
+            self.parts.append(tuple(intervals))
+            self.sizes.append(sum(high - low + 1 for low, high, _ in intervals))
+            pos = m.end()
+        self.parts.append(pattern[pos:])
+        regex += re.escape(pattern[pos:])
+        if not self.sizes or "[" in self.parts[-1] or "]" in self.parts[-1]:
+            raise ValueError(f"invalid host range: '{pattern}'")
+        self.regex = re.compile(regex)
+
+    def __repr__(self):
+        return f"HostRange({self.pattern!r})"
+
+    def __str__(self):
+        return self.pattern
+
+    def __eq__(self, other):
+        return isinstance(other, HostRange) and other.pattern == self.pattern
+
+    def __hash__(self):
+        return hash(self.pattern)
+
+    def __len__(self):
+        n = 1
+        for size in self.sizes:
+            n *= size
+        return n
+
+    @property
+    def prefix(self) -> str:
+        """Literal text all host names of the range start with."""
+        return self.parts[0]
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        numbers = []
+        for intervals, size in zip(self.parts[-2:0:-2], self.sizes[::-1]):
+            i, r = divmod(i, size)
+            for low, high, width in intervals:
+                if r <= high - low:
+                    numbers.append(str(low + r).zfill(width))
+                    break
+                r -= high - low + 1
+        out = self.parts[0]
+        for number, literal in zip(numbers[::-1], self.parts[2::2]):
+            out += number + literal
+        return out
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def index(self, name: str) -> int:
+        """Return the position of host name in the range, raise ValueError
+        if it is not part of it."""
+
+        m = self.regex.fullmatch(name)
+        if m is None:
+            raise ValueError(name)
+        pos = 0
+        for digits, intervals, size in zip(m.groups(), self.parts[1::2], self.sizes):
+            number = int(digits)
+            offset = 0
+            for low, high, width in intervals:
+                if low <= number <= high and (len(digits) == width if width else str(number) == digits):
+                    break
+                offset += high - low + 1
+            else:
+                raise ValueError(name)
+            pos = pos * size + offset + number - low
+        return pos
+
+    def __contains__(self, name):
+        try:
+            self.index(name)
+            return True
+        except ValueError:
+            return False
+
+
+def parse_host(text: str) -> str | HostRange:
+    """Return text as a host name, or as a HostRange if it contains
+    ranges. Raise ValueError if the ranges are invalid."""
+
+    if "[" in text or "]" in text:
+        return HostRange(text)
+    return text
+
+
+class HostTable:
+    """Interned host names and ranges.
+
+    Every host name or range is an item with a block of indexes: one for
+    a host name, one per host for a range. A host name that is part of a
+    range already in the table gets the index it has in that range. A
+    range that overlaps with items already in the table is added host by
+    host instead of as a block, so that every host has only one index.
+    """
+
+    __slots__ = (
+        "_names",
+        "_new_names",
+        "_sorted_prefixes",
+        "index",
+        "items",
+        "labels",
+        "patterns",
+        "prefixes",
+        "size",
+        "starts",
+    )
+
+    def __init__(self):
+        self.items: list[str | HostRange] = []
+        self.starts: list[int] = []
+        # host name -> index, for hosts that are not in a range block
+        self.index: dict[str, int] = {}
+        # range pattern -> bitset of its hosts
+        self.patterns: dict[str, int] = {}
+        # prefix -> range blocks whose names start with it, as (start, range)
+        self.prefixes: dict[str, list[tuple[int, HostRange]]] = {}
+        self._sorted_prefixes: list[str] = []
+        # the names of index, sorted when a range is added, and those
+        # added since
+        self._names: list[str] = []
+        self._new_names: list[str] = []
+        # label key -> label value -> bitset of the hosts with that label
+        self.labels: dict[str, dict[str, int]] = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _append(self, item: str | HostRange) -> int:
+        start = self.size
+        self.items.append(item)
+        self.starts.append(start)
+        self.size += 1 if isinstance(item, str) else len(item)
+        return start
+
+    def find(self, name: str) -> int | None:
+        """Return the index of host name, or None if it is not there."""
+
+        i = self.index.get(name)
+        if i is not None:
+            return i
+        for start, host_range in self._blocks_before(name):
+            try:
+                return start + host_range.index(name)
+            except ValueError:
+                pass
+        return None
+
+    def _blocks_before(self, text: str):
+        """Yield the range blocks whose prefix is text, or the part of text
+        before one of its digits: the only ones with names that can start
+        with text, as numbers follow the prefix."""
+
+        if not self.prefixes:
+            return
+        for k, c in enumerate(text):
+            if c.isdigit():
+                yield from self.prefixes.get(text[:k], ())
+        yield from self.prefixes.get(text, ())
+
+    def intern(self, name: str) -> int:
+        """Return the index of host name, adding it if needed."""
+
+        i = self.find(name)
+        if i is None:
+            i = self._append(name)
+            self.index[name] = i
+            self._new_names.append(name)
+        return i
+
+    def intern_range(self, host_range: HostRange) -> int:
+        """Return the bitset of host_range, adding it if needed."""
+
+        try:
+            return self.patterns[host_range.pattern]
+        except KeyError:
+            pass
+
+        if self._overlaps(host_range):
+            bits = self.bits(iter(host_range))
+        else:
+            start = self._append(host_range)
+            if host_range.prefix not in self.prefixes:
+                self.prefixes[host_range.prefix] = []
+                insort(self._sorted_prefixes, host_range.prefix)
+            self.prefixes[host_range.prefix].append((start, host_range))
+            bits = ((1 << len(host_range)) - 1) << start
+        self.patterns[host_range.pattern] = bits
+        return bits
+
+    def _overlaps(self, host_range: HostRange) -> bool:
+        """Tell whether some host of host_range is already in the table."""
+
+        prefix = host_range.prefix
+        if self._new_names:
+            # the new names are sorted, then merged in linear time
+            self._new_names.sort()
+            self._names += self._new_names
+            self._names.sort()
+            self._new_names = []
+        # the names starting with the prefix, or those of the range if fewer
+        lo = bisect_left(self._names, prefix)
+        hi = bisect_left(self._names, prefix + "\U0010ffff", lo)
+        if hi - lo > len(host_range):
+            if any(name in self.index for name in host_range):
+                return True
+        elif any(self._names[i] in host_range for i in range(lo, hi)):
+            return True
+
+        # the ranges with a prefix starting with this one, or the other way
+        blocks = list(self._blocks_before(prefix))
+        i = bisect_right(self._sorted_prefixes, prefix)
+        while i < len(self._sorted_prefixes) and self._sorted_prefixes[i].startswith(prefix):
+            blocks += self.prefixes[self._sorted_prefixes[i]]
+            i += 1
+        for _, other in blocks:
+            small, large = sorted((host_range, other), key=len)
+            if any(name in large for name in small):
+                return True
+        return False
+
+    def bits(self, items) -> int:
+        """Return the bitset of the host names and ranges in items."""
+
+        out = 0
+        buf = bytearray((self.size >> 3) + 1)
+        for item in items:
+            if isinstance(item, HostRange):
+                out |= self.intern_range(item)
+                continue
+            i = self.intern(item)
+            if i >> 3 >= len(buf):
+                buf.extend(bytes((i >> 3) - len(buf) + 1))
+            buf[i >> 3] |= 1 << (i & 7)
+        return out | int.from_bytes(buf, "little")
+
+    def lookup(self, items) -> int:
+        """Same as bits, but leave out the hosts that are not in the table
+        instead of adding them."""
+
+        out = 0
+        for item in items:
+            if isinstance(item, HostRange):
+                if item.pattern in self.patterns:
+                    out |= self.patterns[item.pattern]
+                    continue
+                names = iter(item)
+            else:
+                names = [item]
+            for name in names:
+                i = self.find(name)
+                if i is not None:
+                    out |= 1 << i
+        return out
+
+    def add_labels(self, bits: int, labels: dict[str, str]):
+        """Give labels to the hosts in bitset bits."""
+
+        for key, value in labels.items():
+            values = self.labels.setdefault(key, {})
+            values[value] = values.get(value, 0) | bits
+
+    def select(self, labels: dict[str, str]) -> int:
+        """Return the bitset of the hosts that have all of labels."""
+
+        out = (1 << self.size) - 1
+        for key, value in labels.items():
+            out &= self.labels.get(key, {}).get(value, 0)
+        return out
+
+    def name(self, i: int) -> str:
+        """Return the name of the host with index i."""
+
+        k = bisect_right(self.starts, i) - 1
+        item = self.items[k]
+        if isinstance(item, str):
+            return item
+        return item[i - self.starts[k]]
+
+    def names(self, bits: int, start: int = 0, count: int | None = None) -> list[str]:
+        """Return the names of the hosts in bitset bits, in index order.
+        start and count select a part of them."""
+
+        out: list[str] = []
+        for i in indexes(bits, start):
+            if count is not None and len(out) >= count:
+                break
+            out.append(self.name(i))
+        return out
+
+
+class Selection:
+    """Restrictions on the hosts of a group, as given on the command line
+    or in interactive mode.
+
+    labels holds the labels that selected hosts must all have, hosts the
+    names and ranges of the only hosts to select, exclude glob patterns of
+    hosts not to select and match a regular expression selected host
+    names must contain. The patterns are compiled once, into a single
+    regular expression each.
+    """
+
+    __slots__ = ("_exclude", "_match", "exclude", "hosts", "labels", "match")
+
+    def __init__(self, labels: str = "", hosts: str = "", exclude: str = "", match: str = ""):
+        self.labels = parse_labels(labels)
+        self.hosts = split_list(hosts)
+        self.exclude = split_list(exclude)
+        self.match = match
+        try:
+            for host in self.hosts:
+                parse_host(host)
+            self._exclude = re.compile("|".join(fnmatch.translate(p) for p in self.exclude)) if self.exclude else None
+            self._match = re.compile(match) if match else None
+        except (ValueError, re.error) as exc:
+            raise Abort(f"invalid host selection: {exc}")
+
+    def __bool__(self):
+        return bool(self.labels or self.hosts or self.exclude or self.match)
+
+    def __str__(self):
+        out = []
+        if self.labels:
+            out.append(",".join(f"{key}={value}" for key, value in self.labels.items()))
+        if self.hosts:
+            out.append("-H " + ",".join(self.hosts))
+        if self.exclude:
+            out.append("-x " + ",".join(self.exclude))
+        if self.match:
+            out.append("--match " + self.match)
+        return " ".join(out)
+
+    def replace(self, **changes: str) -> Selection:
+        """Return a copy of the selection with the restrictions in changes,
+        given as text, replaced."""
+
+        texts = {
+            "labels": ",".join(f"{key}={value}" for key, value in self.labels.items()),
+            "hosts": ",".join(self.hosts),
+            "exclude": ",".join(self.exclude),
+            "match": self.match,
+        }
+        texts.update(changes)
+        return Selection(**texts)
+
+    def bits(self, table: HostTable, bits: int) -> int:
+        """Return the selected hosts of bitset bits, whose hosts are in
+        table. Host names are only computed if there are patterns to
+        match them against."""
+
+        if self.labels:
+            bits &= table.select(self.labels)
+        if self.hosts:
+            selected = 0
+            for host in self.hosts:
+                host_bits = table.lookup([parse_host(host)])
+                if not host_bits:
+                    error.warn(f"unknown host: '{host}'")
+                selected |= host_bits
+            bits &= selected
+        if self._exclude is None and self._match is None:
+            return bits
+
+        exclude = self._exclude.match if self._exclude else None
+        match = self._match.search if self._match else None
+        buf = bytearray((bits.bit_length() >> 3) + 1)
+        for i in indexes(bits):
+            name = table.name(i)
+            if exclude and exclude(name) or match and not match(name):
+                continue
+            buf[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(buf, "little")
+
+
+class Sample:
+    """A random subset of the hosts of a group, of size hosts or percent of
+    the group.
+
+    With stratify, the group is split into strata, by the value of the
+    label stratify, or by the group hosts take their parameters from if
+    stratify is "group". Every stratum gets its share of the sample, and
+    at least one host if the sample is large enough. The same seed picks
+    the same hosts, a random one is chosen if none is given.
+    """
+
+    __slots__ = ("hosts", "percent", "seed", "stratify")
+
+    def __init__(self, size: str, stratify: str = "", seed: int | None = None):
+        self.hosts = 0
+        self.percent = 0.0
+        try:
+            if size.endswith("%"):
+                self.percent = float(size[:-1])
+                valid = 0 < self.percent <= 100
+            else:
+                self.hosts = int(size)
+                valid = self.hosts > 0
+        except ValueError:
+            valid = False
+        if not valid:
+            raise Abort(f"invalid sample size: '{size}'")
+        self.stratify = stratify
+        self.seed = random.randrange(2**32) if seed is None else seed
+
+    def __str__(self):
+        size = f"{self.percent:g}%" if self.percent else str(self.hosts)
+        return size + (f" by {self.stratify}" if self.stratify else "")
+
+    def pick(self, table: HostTable, segments: list[tuple[int, str]]) -> tuple[int, list[str]]:
+        """Return the bitset of the sampled hosts of the (bits, group)
+        segments of a group, and a summary of the sample, line by line."""
+
+        strata = self._strata(table, segments)
+        total = sum(count(bits) for _, bits in strata)
+        size = self.hosts or round(total * self.percent / 100) or 1
+        size = min(size, total)
+
+        # largest remainder, with at least one host per stratum if possible
+        exact = [size * count(bits) / total for _, bits in strata] if total else []
+        shares = [int(x) for x in exact]
+        if size >= len(strata):
+            shares = [max(n, 1) for n in shares]
+        by_remainder = sorted(range(len(strata)), key=lambda k: shares[k] - exact[k])
+        k = 0
+        while sum(shares) < size:
+            shares[by_remainder[k % len(strata)]] += 1
+            k += 1
+        while sum(shares) > size:
+            # from the strata that keep a host, smallest remainder first
+            k = max((k for k in range(len(strata)) if shares[k] > 1), key=lambda k: shares[k] - exact[k])
+            shares[k] -= 1
+
+        rng = random.Random(self.seed)
+        out = 0
+        summary = [f"sampled {size} of {total} hosts (seed {self.seed})"]
+        for (name, bits), share in zip(strata, shares):
+            for i in rng.sample(list(indexes(bits)), share):
+                out |= 1 << i
+            if self.stratify:
+                summary.append(f"  {name}: {share} of {count(bits)}")
+        return out, summary
+
+    def _strata(self, table: HostTable, segments: list[tuple[int, str]]) -> list[tuple[str, int]]:
+        """Split the hosts of segments into (name, bits) strata."""
+
+        return partition(table, segments, self.stratify)
+
+
+def partition(table: HostTable, segments: list[tuple[int, str]], key: str) -> list[tuple[str, int]]:
+    """Split the hosts of the (bits, group) segments of a group into (name,
+    bits) parts, by the value of label key, or by the group hosts take their
+    parameters from if key is "group". Without key, there is one part."""
+
+    bits = 0
+    for b, _ in segments:
+        bits |= b
+    if not key:
+        return [("", bits)]
+    if key == "group":
+        return [(name, b) for b, name in segments if b]
+
+    parts = []
+    for value, vbits in table.labels.get(key, {}).items():
+        if bits & vbits:
+            parts.append((f"{key}={value}", bits & vbits))
+            bits &= ~vbits
+    if bits:
+        parts.append((f"no {key}", bits))
+    return parts
+
+
+def split_list(text: str) -> list[str]:
+    """Split a comma separated list of host names, ranges or patterns.
+    Commas inside brackets are part of a range."""
+
+    return [item.strip() for item in _COMMA.split(text) if item.strip()]
+
+
+_COMMA = re.compile(r",(?![^\[]*\])")
+
+_LABEL = re.compile(r"(\w+)=([-\w\.:]+)")
+
+
+def parse_labels(text: str) -> dict[str, str]:
+    """Parse a label selector like role=web,dc=fra into a dict."""
+
+    labels = {}
+    for term in filter(None, (t.strip() for t in text.split(","))):
+        m = _LABEL.fullmatch(term)
+        if m is None:
+            raise Abort(f"invalid label selector: '{term}'")
+        labels[m.group(1)] = m.group(2)
+    return labels
+
+
+def indexes(bits: int, start: int = 0):
+    """Yield the indexes of the bits set in bits, in increasing order,
+    skipping the first start of them."""
+
+    binary = bin(bits)[:1:-1]
+    i = binary.find("1")
+    while i != -1:
+        if start:
+            start -= 1
+        else:
+            yield i
+        i = binary.find("1", i + 1)
+
+
+def count(bits: int) -> int:
+    """Return the number of hosts in bitset bits."""
+
+    # int.bit_count() is for Python 3.10 and later
+    return bin(bits).count("1")  # noqa: FURB161
+
+
+class ExpressionParser(tpg.Parser):
+    r"""
+
+    separator spaces  : '\s+' ;
+
+    token name  : '\w+'  str ;
+
+    START/e -> UNION/e ;
+
+    UNION/e -> INTERSECTION/e
+      ( '\|' INTERSECTION/f     $ e = ("|", e, f)
+      )*
+    ;
+
+    INTERSECTION/e -> DIFFERENCE/e
+      ( '&' DIFFERENCE/f        $ e = ("&", e, f)
+      )*
+    ;
+
+    DIFFERENCE/e -> ATOM/e
+      ( '-' ATOM/f              $ e = ("-", e, f)
+      )*
+    ;
+
+    ATOM/e -> '\(' UNION/e '\)' | name/e ;
+    """
+
+
+def is_expression(text: str) -> bool:
+    """Tell whether text is a group expression rather than a group name."""
+
+    return any(c in text for c in "|&-() \t")
+
+
+def parse_expression(text: str):
+    """Parse group expression text into a tree of (operator, left, right)
+    tuples whose leaves are group names."""
+
+    try:
+        return ExpressionParser()(text)
+    except tpg.Error as excerr:
+        raise Abort(f"in group expression '{text}': {excerr.msg}")
+
+
+def leaves(tree) -> list[str]:
+    """Return the group names in expression tree, from left to right."""
+
+    if isinstance(tree, str):
+        return [tree]
+    return leaves(tree[1]) + leaves(tree[2])
+
+
+def evaluate(tree, lookup) -> int:
+    """Return the bitset of expression tree. lookup returns the bitset of
+    a group, given its name."""
+
+    if isinstance(tree, str):
+        return lookup(tree)
+    op, left, right = tree
+    a, b = evaluate(left, lookup), evaluate(right, lookup)
+    if op == "|":
+        return a | b
+    if op == "&":
+        return a & b
+    return a & ~b
@@ -30,6 +30,28 @@
 Usage: tentakel [ options ] [ command ]
  -c file        Use file as config file
  -g group       Select group
+ -s labels      Select hosts by label, e.g. -s role=web,dc=fra
+ -H hosts       Select only the given comma separated hosts
+ -x pattern     Exclude hosts matching the glob pattern
+ --match regex  Select only hosts matching the regular expression
+                Without -g, -s, -H, -x and --match select from all hosts
+ --recheck      Probe hosts remembered as unreachable again
+ --where cond   Run only on hosts whose facts meet cond, e.g. "load < 2"
+ --sample size  Run on a random sample of size hosts, or size% of them
+ --stratify key Sample every value of label key, or every group, evenly
+ --seed n       Seed of the sample, to pick the same hosts again
+ --first k      Stop as soon as k hosts succeeded, cancel the others
+ --quorum       Stop as soon as a majority of the hosts succeeded
+ --hedge secs   With --first or --quorum, start on that many hosts only,
+                and on one more when one fails or is slower than secs
+ --fail-fast n  Stop as soon as n hosts failed, cancel the others
+ --stats        Print the metrics of the run on stderr when done
+ --plan         Predict how long command will take, without running it
+ --spawn-helper Start the transport processes from a small helper process
+ --procs n      Split the hosts between n worker processes
+ --listen addr  Hand the hosts out to the worker tentakels connecting to
+                addr, host:port or the path of a Unix socket
+ --worker addr  Run the hosts handed out by the tentakel listening on addr
  -l             Print list of available groups
  -h             Display this help text
  -v             Display version information
@@ -38,10 +60,13 @@ Usage: tentakel [ options ] [ command ]
 See tentakel(1) for more information
 """
 
+from __future__ import annotations
+
 import getopt
 import os
 import sys
-from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
 
 from tentakel.error import Abort
 
@@ -51,20 +76,83 @@ except ImportError:
     # Running on pre-3.8 Python; use importlib-metadata package
     import importlib_metadata as metadata  # type: ignore
 
-from . import config, remote, shell
+from . import cache, cluster, config, facts, hostset, remote, shell, spawner
 
+# option -> (name, type of its value), None for flags. The values of
+# options given more than once are collected in a list if the type is list.
+OPTIONS = {
+    "-g": ("group_name", str),
+    "-c": ("override_config", str),
+    "-l": ("flag_listgroups", None),
+    "-s": ("labels", str),
+    "-H": ("hosts", list),
+    "-x": ("exclude", list),
+    "--match": ("match", str),
+    "--recheck": ("recheck", None),
+    "--where": ("where", str),
+    "--sample": ("sample", str),
+    "--stratify": ("stratify", str),
+    "--seed": ("seed", int),
+    "--first": ("first", int),
+    "--quorum": ("quorum", None),
+    "--hedge": ("hedge", float),
+    "--fail-fast": ("fail_fast", int),
+    "--stats": ("stats", None),
+    "--plan": ("plan", None),
+    "--spawn-helper": ("spawn_helper", None),
+    "--procs": ("procs", int),
+    "--listen": ("listen", str),
+    "--worker": ("worker", str),
+}
 
-def main():
-    group_name = "default"
-    flag_listgroups = 0
-    override_config = ""
+DEFAULTS: dict[str, Any] = {
+    "group_name": None,
+    "override_config": "",
+    "flag_listgroups": False,
+    "labels": "",
+    "hosts": [],
+    "exclude": [],
+    "match": "",
+    "recheck": False,
+    "where": "",
+    "sample": "",
+    "stratify": "",
+    "seed": None,
+    "first": 0,
+    "quorum": False,
+    "hedge": 0.0,
+    "fail_fast": 0,
+    "stats": False,
+    "plan": False,
+    "spawn_helper": False,
+    "procs": 1,
+    "listen": "",
+    "worker": "",
+}
+
+# what an invalid value of a numeric option is
+INVALID = {
+    "seed": "seed",
+    "first": "number of hosts",
+    "hedge": "hedge delay",
+    "fail_fast": "number of hosts",
+    "procs": "number of processes",
+}
+
+LONG_OPTIONS = [o[2:] + ("" if kind is None else "=") for o, (_, kind) in OPTIONS.items() if o.startswith("--")]
+
+
+def parse_options(argv: list[str]):
+    """Return the options in argv, as attributes, and the other
+    arguments."""
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "g:hlvc:D")
+        opts, args = getopt.getopt(argv, "g:hlvc:Ds:H:x:", LONG_OPTIONS)
     except getopt.GetoptError:
         print_help()
         raise Abort("parameter error")
 
+    options = SimpleNamespace(**{name: list(v) if isinstance(v, list) else v for name, v in DEFAULTS.items()})
     for o, v in opts:
         if o == "-h":
             print_help()
@@ -76,59 +164,121 @@ def main():
             print_info()
             sys.exit(0)
 
-        if o == "-g":
-            group_name = v
-        if o == "-c":
-            override_config = v
-        if o == "-l":
-            flag_listgroups = 1
+        name, kind = OPTIONS[o]
+        if kind is None:
+            setattr(options, name, True)
+        elif kind is list:
+            getattr(options, name).append(v)
+        else:
+            try:
+                setattr(options, name, kind(v))
+            except ValueError:
+                raise Abort(f"invalid {INVALID[name]}: '{v}'")
+    return options, args
+
 
-    command = " ".join(args)
+def find_config(override_config: str) -> str:
+    """Return the configuration file to use, override_config if given."""
 
     # check wether the user has chosen a specific configuration file
     # on the command line
-    config_file = None
     if override_config:
         if os.path.isfile(override_config):
-            config_file = override_config
-        else:
-            raise Abort(f"no such file: '{override_config}'")
-    else:
-        # look for configuration files from default locations
-        configs = [
-            os.path.join(config.__user_dir, "tentakel.conf"),
-            "/etc/tentakel.conf",
-        ]
-        for c in configs:
-            if os.path.isfile(c):
-                config_file = c
-                break
-
-    if config_file is None:
-        raise Abort("no configuration file found")
+            return override_config
+        raise Abort(f"no such file: '{override_config}'")
+
+    # look for configuration files from default locations
+    configs = [
+        os.path.join(config.__user_dir, "tentakel.conf"),
+        "/etc/tentakel.conf",
+    ]
+    for c in configs:
+        if os.path.isfile(c):
+            return c
+    raise Abort("no configuration file found")
+
+
+def main():
+    options, args = parse_options(sys.argv[1:])
+
+    if options.spawn_helper:
+        # while this process is still small and single-threaded
+        spawner.start()
+
+    if options.worker:
+        # the coordinator has the configuration
+        cluster.work(options.worker)
+        sys.exit(0)
+
+    selection = hostset.Selection(options.labels, ",".join(options.hosts), ",".join(options.exclude), options.match)
+    if options.where:
+        # report errors before anything is run
+        facts.parse_condition(options.where)
+    sampling = hostset.Sample(options.sample, options.stratify, options.seed) if options.sample else None
+    if options.group_name is None and not selection:
+        options.group_name = "default"
+
+    command = " ".join(args)
 
     # load configuration
-    conf = config.ConfigBase()
-    conf.load(Path(config_file))
+    conf = cache.load_config(find_config(options.override_config))
 
     # process -g parameter
-    if flag_listgroups:
+    if options.flag_listgroups:
         print("available groups:")
         for g in conf.get_groups():
             sys.stdout.write(g + " ")
         print()
         sys.exit(0)
 
-    # batch mode: execute command
     if command:
-        collator = remote.RemoteCollator(conf, group_name)
-        collator.exec_all(command)
-        collator.display_all()
-        collator.join_all()
+        run_command(conf, options, selection, sampling, command)
     else:
-        # interactive mode: open shell
-        sh = shell.TentakelShell(conf, group_name)
-        sh.cmdloop(intro="interactive mode")
+        run_shell(conf, options, selection, sampling)
+
+
+def run_command(conf, options, selection, sampling, command: str):
+    """Batch mode: execute command."""
+
+    collator = remote.RemoteCollator(conf, options.group_name, selection=selection, sample=sampling)
+    collator.recheck = options.recheck
+    collator.where = options.where
+    collator.first, collator.quorum, collator.hedge = options.first, options.quorum, options.hedge
+    collator.fail_fast = options.fail_fast
+    collator.procs = options.procs
+    if sampling:
+        sys.stderr.write("\n".join(collator.sample_summary) + "\n")
+    if options.plan:
+        print("\n".join(collator.plan(command)))
+        sys.exit(0)
+    if options.listen:
+        collator.coordinator = cluster.Coordinator(options.listen)
+    collator.exec_all(command)
+    collator.display_all()
+    collator.join_all()
+    if collator.coordinator is not None:
+        # lets the workers go
+        collator.coordinator.close()
+    if options.stats:
+        sys.stderr.write("\n".join(collator.metrics.summary()) + "\n")
+
+
+def run_shell(conf, options, selection, sampling):
+    """Interactive mode: open shell."""
+
+    sh = shell.TentakelShell(conf, options.group_name, selection)
+    if options.recheck:
+        sh.do_recheck("")
+    if options.where:
+        sh.do_where(options.where)
+    sh.dests.first, sh.dests.quorum, sh.dests.hedge = options.first, options.quorum, options.hedge
+    sh.dests.fail_fast = options.fail_fast
+    sh.dests.procs = options.procs
+    if options.listen:
+        sh.dests.coordinator = cluster.Coordinator(options.listen)
+    if sampling:
+        sh.set_sample(sampling)
+    sh.cmdloop(intro="interactive mode")
 
 
 def print_help():
@@ -22,8 +22,8 @@ def __importPlugins():
     for path in __user_plugin_dir, os.path.dirname(__file__):
         if os.path.exists(path):
             files = os.listdir(path)
-            p += [x[:-3] for x in files if x.endswith(".py") and not x == "__init__.py"]
+            p += [x[:-3] for x in files if x.endswith(".py") and x != "__init__.py"]
     return p
 
 
-__all__ = __importPlugins()
+__all__ = __importPlugins()  # noqa: PLE0605
@@ -24,7 +24,6 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import random
-import subprocess
 import time
 from hashlib import md5
 
@@ -34,21 +33,30 @@ from tentakel.remote import RemoteCommand, register_remote_command_plugin
 class RSHRemoteCommand(RemoteCommand):
     """RSH remote execution class."""
 
+    __slots__ = ("delim", "rsh_path", "user")
+
+    default_port = 514
+
     rsh_path: str
     user: str
 
     def __init__(self, destination, params):
+        super().__init__(destination, params)
+        self.delim = md5(str(random.random()).encode()).hexdigest()
+
+    def configure(self, params):
         self.rsh_path = params["rsh_path"]
         self.user = params["user"]
-        super().__init__(destination, params)
-        self.delim = md5(str(random.random())).hexdigest()
+        super().configure(params)
+
+    def shell_command(self, command: str) -> str:
+        return f'{self.rsh_path} -l {self.user} {self.address or self.destination} "{command}"'
 
     def _rexec(self, command):
-        s = '{} -l {} {} "{}; echo {} \\$?"'.format(
-            self.rsh_path, self.user, self.destination, command, self.delim
-        )
+        host = self.address or self.destination
+        s = f'{self.rsh_path} -l {self.user} {host} "{command}; echo {self.delim} \\$?"'
         t1 = time.time()
-        ol = subprocess.getoutput(s).split("\n")
+        ol = self.run_process(s)[1].split("\n")
         for line_number, line in enumerate(ol):
             i = line.find(self.delim)
             if i != -1:
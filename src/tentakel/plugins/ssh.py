@@ -25,7 +25,6 @@
 
 from __future__ import annotations
 
-import subprocess
 import time
 
 from tentakel.remote import RemoteCommand, register_remote_command_plugin
@@ -34,21 +33,39 @@ from tentakel.remote import RemoteCommand, register_remote_command_plugin
 class SSHRemoteCommand(RemoteCommand):
     """SSH remote execution class."""
 
+    __slots__ = ("port", "ssh_path", "user")
+
+    # ssh_config can set another port than 22, hosts are probed only if
+    # the port parameter is given
+    default_port = None
+
     ssh_path: str
     user: str
+    port: str
 
-    def __init__(self, destination, params):
+    def configure(self, params):
         self.ssh_path = params["ssh_path"]
         self.user = params["user"]
-        super().__init__(destination, params)
+        self.port = params["port"]
+        super().configure(params)
+
+    def shell_command(self, command: str) -> str:
+        options = f"-p {self.port} " if self.port else ""
+        if self.address:
+            # keep the host name for ssh_config and known_hosts
+            options += f"-o HostName={self.address} -o HostKeyAlias={self.destination} "
+        return f'{self.ssh_path} {options}{self.user}@{self.destination} "{command}"'
 
     def _rexec(self, command: str) -> tuple[int, str]:
-        s = f'{self.ssh_path} {self.user}@{self.destination} "{command}"'
+        s = self.shell_command(command)
         t1 = time.time()
-        status, output = subprocess.getstatusoutput(s)
+        status, output = self.run_process(s)
         self.duration = time.time() - t1
-        # shift 8 bits right to strip signal number from status
-        return (status >> 8, output)
+        return (status, output)
+
+    def transport_error(self, result) -> bool:
+        # ssh exits with 255 when it can't reach the host
+        return result.status in (-1, 255)
 
 
 register_remote_command_plugin("ssh", SSHRemoteCommand)
@@ -0,0 +1,195 @@
+#
+# Copyright (c) 2002, 2003, 2004, 2005 Sebastian Stark
+# Copyright (c) 2019-2023 Stefane Fermigier
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR SEBASTIAN STARK
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Checks run on all hosts at once, before a command is started on them.
+
+Doing these once for the whole group, with many of them in flight at the
+same time, is much faster than letting every transport wait for them on
+its own. The results are kept in TTL caches between runs:
+
+  addresses = cache.ttl_cache("addresses")
+  found, failed = preflight.resolve(["web1", "web2"], addresses, ttl=300)
+
+  dead = cache.ttl_cache("dead")
+  failed = preflight.probe([("web1", "192.0.2.1", 22)], dead, timeout=1, ttl=300)
+"""
+
+from __future__ import annotations
+
+import errno
+import os
+import selectors
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import TTLCache
+
+# largest number of checks run at the same time
+THREADS = 64
+SOCKETS = 512
+
+
+def resolve(names: list[str], addresses: TTLCache, ttl: float) -> tuple[dict[str, str], dict[str, str]]:
+    """Look up the addresses of the host names.
+
+    Return a dict of the addresses found, and a dict of error messages for
+    the names that could not be resolved. Addresses are taken from and
+    added to the cache addresses, where they are kept for ttl seconds.
+    """
+
+    found: dict[str, str] = {}
+    failed: dict[str, str] = {}
+    todo = []
+    for name in names:
+        address = addresses.get(name)
+        if address is None:
+            todo.append(name)
+        else:
+            found[name] = address
+    if not todo:
+        return found, failed
+
+    with ThreadPoolExecutor(min(len(todo), THREADS)) as executor:
+        for name, (address, message) in zip(todo, executor.map(_lookup, todo)):
+            if address is None:
+                failed[name] = message
+            else:
+                found[name] = address
+                addresses.put(name, address, ttl)
+    return found, failed
+
+
+def _lookup(name: str) -> tuple[str | None, str]:
+    """Return the first address of host name, or None and the reason why
+    there is none."""
+
+    try:
+        infos = socket.getaddrinfo(name, None, type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError) as exc:
+        return None, f"could not resolve host: {getattr(exc, 'strerror', None) or exc}"
+    return str(infos[0][4][0]), ""
+
+
+def probe(
+    targets: list[tuple[str, str, int]], dead: TTLCache, timeout: float, ttl: float, recheck: bool = False
+) -> dict[str, str]:
+    """Check that the hosts accept connections on their port.
+
+    targets holds (name, address, port) tuples, address may be a host
+    name. Return error messages for the hosts that are not reachable.
+    These are remembered in the cache dead for ttl seconds and not probed
+    again until then, unless recheck is true.
+    """
+
+    failed: dict[str, str] = {}
+    todo = []
+    for name, address, port in targets:
+        message = None if recheck else dead.get((name, port))
+        if message is None:
+            todo.append((name, address, port))
+        else:
+            failed[name] = f"{message} (remembered, recheck to retry)"
+
+    names = [address for _, address, _ in todo if not _is_address(address)]
+    lookups = {}
+    if names:
+        with ThreadPoolExecutor(min(len(names), THREADS)) as executor:
+            lookups = dict(zip(names, executor.map(_lookup, names)))
+    connect = []
+    for name, address, port in todo:
+        if address in lookups:
+            found, message = lookups[address]
+            if found is None:
+                failed[name] = message
+                continue
+            address = found
+        connect.append((name, address, port))
+
+    for (name, _, port), reason in zip(connect, _connect_all(connect, timeout)):
+        if reason:
+            failed[name] = f"unreachable: port {port}: {reason}"
+            dead.put((name, port), failed[name], ttl)
+        else:
+            dead.discard((name, port))
+    return failed
+
+
+def _is_address(text: str) -> bool:
+    """Tell whether text is an IPv4 or IPv6 address."""
+
+    for family in socket.AF_INET, socket.AF_INET6:
+        try:
+            socket.inet_pton(family, text)
+            return True
+        except OSError:
+            pass
+    return False
+
+
+def _connect_all(targets: list[tuple[str, str, int]], timeout: float) -> list[str]:
+    """Open a connection to every (name, address, port) target, SOCKETS at
+    a time, and close it right away. Return the reasons of the failures,
+    in the order of targets, with an empty string for the successes."""
+
+    out = [""] * len(targets)
+    todo = list(enumerate(targets))[::-1]
+    deadlines: dict[socket.socket, tuple[float, int]] = {}
+    with selectors.DefaultSelector() as selector:
+        try:
+            while todo or deadlines:
+                while todo and len(deadlines) < SOCKETS:
+                    i, (_, address, port) = todo.pop()
+                    sock = socket.socket(socket.AF_INET6 if ":" in address else socket.AF_INET, socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    err = sock.connect_ex((address, port))
+                    if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        selector.register(sock, selectors.EVENT_WRITE, sock)
+                        deadlines[sock] = (time.monotonic() + timeout, i)
+                    else:
+                        out[i] = os.strerror(err) if err else ""
+                        sock.close()
+                if not deadlines:
+                    continue
+
+                wait = min(deadline for deadline, _ in deadlines.values()) - time.monotonic()
+                done = {key.data for key, _ in selector.select(max(wait, 0))}
+                for sock in done:
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    out[deadlines[sock][1]] = os.strerror(err) if err else ""
+                now = time.monotonic()
+                for sock, (deadline, i) in list(deadlines.items()):
+                    if sock not in done and deadline > now:
+                        continue
+                    if sock not in done:
+                        out[i] = "timed out"
+                    selector.unregister(sock)
+                    sock.close()
+                    del deadlines[sock]
+        finally:
+            for sock in deadlines:
+                sock.close()
+    return out
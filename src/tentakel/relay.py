@@ -0,0 +1,221 @@
+#
+# Copyright (c) 2002, 2003, 2004, 2005 Sebastian Stark
+# Copyright (c) 2019-2023 Stefane Fermigier
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR SEBASTIAN STARK
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Running commands through relay hosts.
+
+One control node can't keep tens of thousands of ssh sessions open. The
+hosts of a group with a relay parameter are run by a tentakel agent
+started on the relay host instead, with the relay_command parameter and
+the remote method of the group:
+
+  group dc1 (relay="gw1.dc1") +web[1-500].dc1
+
+The agent gets the command, the hosts and their parameters on its
+standard input, runs the command on them, and streams the results back
+on its standard output. The control node then has one session per
+relay instead of one per host. Both directions use frames: a 4 byte
+length, then the JSON encoded message.
+
+The agent runs the command with the same parameters as the control node
+would, apart from the relay, so the remote method of the hosts must work
+from the relay host.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import struct
+import subprocess
+import sys
+import threading
+
+from . import remote
+
+_HEADER = struct.Struct("!I")
+
+# attributes of the collator passed on to the agents
+SETTINGS = (
+    "maxparallel",
+    "minparallel",
+    "adaptive",
+    "spawnrate",
+    "spawnburst",
+    "jitter",
+    "governor",
+    "kill_timeout",
+    "resolve_ttl",
+    "probe_timeout",
+    "dead_ttl",
+    "recheck",
+    "facts_command",
+    "facts_ttl",
+    "where",
+)
+
+
+def write_frame(stream, message):
+    """Write message to the binary stream, as a frame."""
+
+    data = json.dumps(message).encode()
+    stream.write(_HEADER.pack(len(data)) + data)
+    stream.flush()
+
+
+def read_frame(stream):
+    """Return the next message in the binary stream, or None at the end."""
+
+    header = stream.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    data = stream.read(_HEADER.unpack(header)[0])
+    return json.loads(data)
+
+
+class Agent:
+    """The agent on a relay host, seen from the control node. Used by the
+    collator like the connection to a worker process."""
+
+    def __init__(self, name: str, process: subprocess.Popen):
+        self.name = name
+        self.process = process
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            if self.process.stdin.closed:
+                raise BrokenPipeError(f"relay {self.name} is closed")
+            write_frame(self.process.stdin, message)
+
+    def recv(self):
+        message = read_frame(self.process.stdout)
+        if message is None:
+            raise EOFError(f"relay {self.name} went away")
+        return message
+
+    def close(self):
+        with self.lock:
+            self.process.stdin.close()
+        self.process.stdout.close()
+
+    def join(self, timeout: float | None = None):
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def start_agent(name: str, objs: list, command: str, collator) -> Agent:
+    """Start the agent on relay host name, through the remote method of the
+    first of the RemoteCommand objects objs, and send it command and the
+    hosts of objs to run it on, with the settings of collator."""
+
+    params = dict(objs[0].params, relay="")
+    relay = remote.remote_command_factory(name, params)
+    cmd = relay.shell_command(params["relay_command"])
+    if cmd is None:
+        raise OSError(f"method {params['method']} can't start relay agents")
+    process = subprocess.Popen(
+        cmd,
+        shell=True,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        start_new_session=True,
+    )
+    agent = Agent(name, process)
+    try:
+        agent.send(make_job(objs, command, collator))
+    except OSError:
+        # it went away already, the reader will tell
+        pass
+    return agent
+
+
+def make_job(objs: list, command: str, collator, checked: bool = False) -> dict:
+    """Return the message that has another tentakel run command on the
+    hosts of the RemoteCommand objects objs, with the settings of
+    collator. If checked is true, the hosts already met their conditions
+    and the where condition, they are not checked again."""
+
+    conditions = {} if checked else collator.conditions
+    settings = {setting: getattr(collator, setting) for setting in SETTINGS}
+    if checked:
+        settings["where"] = ""
+    return {
+        "command": command,
+        "hosts": [[obj.destination, dict(obj.params, relay="")] for obj in objs],
+        "conditions": {obj.destination: conditions[obj.destination] for obj in objs if obj.destination in conditions},
+        "settings": settings,
+    }
+
+
+def job_collator(job: dict) -> remote.RemoteCollator:
+    """Return a collator with the hosts and settings of job, made by
+    make_job()."""
+
+    collator = remote.RemoteCollator(None, None)
+    for setting, value in job["settings"].items():
+        setattr(collator, setting, value)
+    collator.conditions = job["conditions"]
+    for destination, params in job["hosts"]:
+        collator.add(remote.remote_command_factory(destination, params))
+    return collator
+
+
+class _Parent:
+    """The connection of an agent to the control node, over its standard
+    input and output."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            write_frame(sys.stdout.buffer, message)
+
+    def recv(self):
+        message = read_frame(sys.stdin.buffer)
+        if message is None:
+            raise EOFError("the control node went away")
+        return message
+
+
+def main():
+    """The agent: run the job read from the standard input."""
+
+    job = read_frame(sys.stdin.buffer)
+    if job is None:
+        return
+    collator = job_collator(job)
+    objs, _, _ = collator.prepare(job["command"])
+    collator.serve(objs, job["command"], _Parent())
+    # without waiting for the thread reading the standard input
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
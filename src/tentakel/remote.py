@@ -28,27 +28,53 @@ Provides the two classes which are most important in tentakel:
 
   - RemoteCommand
     A basic class which needs to be subclassed by plugins. A RemoteCommand
-    descendant is a single thread which runs as long as tentakel is running.
-    It checks continuously if there is a command to execute by fetching it from
-    its commandQueue. The command is then executed by the _rexec method and
-    the result is inserted into the resultQueue.
-    Subclasses must define the _rexec method in order to be useful.
+    descendant holds the execution state for a single host. Commands are
+    executed by the _rexec method, which subclasses must define in order
+    to be useful.
 
   - RemoteCollator
     Container used to create and control RemoteCommand instances.
-    It is also responsible for outputting the results.
+    It runs commands on them from a pool of worker threads and is also
+    responsible for outputting the results, which come back as Result
+    records.
 """
 
 from __future__ import annotations
 
+import errno
+import multiprocessing
+import os
 import queue
+import signal
+import subprocess
 import sys
 import threading
+import time
 from abc import ABCMeta, abstractmethod
+from collections import deque
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
+from typing import TYPE_CHECKING
 
-from . import error, tpg
+from . import cache, control, error, facts, hostset, preflight, relay, spawner, tpg
 from .error import Abort
 
+if TYPE_CHECKING:
+    from . import cluster, config
+
+
+# number of hosts listed by plan()
+PLAN_SLOWEST = 5
+
+# how many times, and after how long at first, to try starting a process
+# again when this machine is out of file descriptors or processes
+SPAWN_RETRIES = 5
+SPAWN_BACKOFF = 0.1
+_RESOURCE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.EAGAIN, errno.ENOMEM)
+
+# how often serve() checks whether the hosts left were stolen
+STEAL_POLL = 0.1
+
 
 class FormatString(tpg.Parser):
     r"""
@@ -89,84 +115,203 @@ class FormatString(tpg.Parser):
         return self.format_map[s]
 
 
-class RemoteCommand(threading.Thread, metaclass=ABCMeta):
+class Result:
+    """Outcome of a command on one host.
+
+    The status is None for a host that a relay left out because its facts
+    don't meet its condition. collect() skips these.
+    """
+
+    __slots__ = ("destination", "duration", "output", "status")
+
+    def __init__(self, destination: str, status: int | None, output: str, duration: float):
+        self.destination = destination
+        self.status = status
+        self.output = output
+        self.duration = duration
+
+    def __repr__(self):
+        return f"Result({self.destination!r}, {self.status!r})"
+
+
+class RemoteCommand(metaclass=ABCMeta):
     """Generic remote execution class.
 
     Specific remote command classes should inherit from this class
     and define a _rexec() method that executes the command and
-    puts the result into the result queue by calling putResult().
+    returns a (status, output) tuple.
 
     The __init__ method can be overridden if special processing of
     the params parameter should be done. In that case,
     RemoteCommand.__init__(self, destination, params) should
     be called at the end of __init__.
 
+    Rather than overriding __init__, plugins should derive their
+    attributes from params in configure(), which is also called when the
+    parameters of an existing host change.
+
     The _rexec() method should measure the time it needs to run and
-    set duration accordingly.
+    set duration accordingly. If address is set, it is the address of
+    the host, already resolved, and should be connected to instead of
+    looking destination up again.
+
+    Instances are kept for every host of the current group, so they
+    should stay small: they do not run anything by themselves, the
+    RemoteCollator calls run_command() from its worker threads.
+
+    default_port is the port the remote method connects to, unless the
+    port parameter says otherwise. It is used to check that hosts are up,
+    leave it None if the port can be set elsewhere.
+
+    Plugins that run a local program should do it with run_process(), so
+    that the command can be cancelled while it runs.
+
+    Methods that can run a command with its standard input and output
+    connected, like ssh does, should implement shell_command(), so that
+    hosts can be used as relays.
+
+    transport_error() tells failures of the remote method itself, which
+    make an adaptive collator run fewer hosts at a time, from failures of
+    the command.
     """
 
-    # auxiliary queue that holds references to objects that
-    # have results ready
-    finished_objects: queue.Queue = queue.Queue()
+    default_port: int | None = None
+
+    __slots__ = ("address", "cancelled", "destination", "duration", "params", "process")
 
     def __init__(self, destination, params):
-        super().__init__()
         self.duration = 0.0
         self.destination = destination
+        self.address: str | None = None
+        self.process: subprocess.Popen | spawner.SpawnedProcess | None = None
+        self.cancelled = False
+        self.configure(params)
 
-        self._command_queue = queue.Queue()
-        self._result_queue = queue.Queue()
-        self._command_timeout = 0.3
-        self._sleep_period = 0.8
-        self._stopevent = threading.Event()
-        # In the end this will be the maxparallel value of the _outermost_ group
-        # instead of the innermost, unlike all other parameters. Although
-        # it is indeed predictable behaviour (because tentakel.config returns all
-        # hosts in a group before it returns the subgroups hosts) it is not nice
-        # and therefore a TODO
-        self.__maxparallel = int(params["maxparallel"])
-
-        # Create the semaphore as a class attribute only once, and only when needed
-        if "slot" not in self.__class__.__dict__ and not self.__maxparallel <= 0:
-            self.__class__.slot = threading.BoundedSemaphore(self.__maxparallel)
+    def configure(self, params):
+        """Take the parameters for this host into account."""
+        # shared with the other hosts of the group, do not modify
+        self.params = params
 
-        self.start()
+    def close(self):
+        """Release whatever is kept for this host, it is no longer used."""
 
     @abstractmethod
     def _rexec(self, command):
         pass
 
-    def execute(self, command: str):
-        """Execute a command in this thread."""
-        self._command_queue.put_nowait(command)
+    def run_process(self, cmd: str, env: dict[str, str] | None = None) -> tuple[int, str]:
+        """Run shell command cmd, in environment env if given, and return
+        its exit status and output, stdout and stderr together.
 
-    def put_result(self, result):
-        """Push result onto the result queue."""
-        self._result_queue.put(result)
-        self.__class__.finished_objects.put(self)
+        The process gets a process group of its own, which cancel()
+        terminates. Raise Cancelled if the command was cancelled before
+        the process could be started. If this machine is out of file
+        descriptors or processes, starting it is tried again a few times.
 
-    def get_result(self):
-        """Return result from result queue."""
-        return self._result_queue.get()
+        The process is started by the spawn helper if it runs, see the
+        spawner module.
+        """
 
-    def run(self):
-        while not self._stopevent.is_set():
+        process: subprocess.Popen[str] | spawner.SpawnedProcess
+        for attempt in range(SPAWN_RETRIES + 1):
+            if self.cancelled:
+                raise Cancelled()
             try:
-                command = self._command_queue.get(timeout=self._command_timeout)
-                if self.__maxparallel > 0:
-                    self.slot.acquire()
-                result = self._rexec(command)
-                if self.__maxparallel > 0:
-                    self.slot.release()
-                self.put_result(result)
-            except queue.Empty:
-                pass
-            self._stopevent.wait(self._sleep_period)
+                if spawner.running():
+                    process = spawner.spawn(cmd, env)
+                else:
+                    process = subprocess.Popen(
+                        cmd,
+                        shell=True,
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                        start_new_session=True,
+                        env=env,
+                        text=True,
+                        errors="replace",
+                    )
+                break
+            except OSError as exc:
+                if exc.errno not in _RESOURCE_ERRORS or attempt == SPAWN_RETRIES:
+                    raise
+            time.sleep(SPAWN_BACKOFF * 2**attempt)
+        # the processes are started without the lock, so that the workers
+        # can start theirs at the same time
+        with _process_lock:
+            self.process = process
+            cancelled = self.cancelled
+        if cancelled:
+            # while it was being started, cancel() could not see it
+            signal_process_group(process, signal.SIGKILL)
+        try:
+            output, _ = process.communicate()
+            status = process.returncode
+            # set once communicate() returns
+            assert status is not None
+        finally:
+            with _process_lock:
+                self.process = None
+        output = output.removesuffix("\n")
+        return (status, output)
+
+    def cancel(self) -> subprocess.Popen | spawner.SpawnedProcess | None:
+        """Stop the running command, if any, and don't start it anymore.
+        Called from another thread than the one running the command.
+
+        Return the process that was asked to terminate, if any, so that it
+        can be killed if it doesn't.
+        """
+
+        with _process_lock:
+            self.cancelled = True
+            process = self.process
+        if process is not None:
+            signal_process_group(process, signal.SIGTERM)
+        return process
+
+    def shell_command(self, command: str) -> str | None:
+        """Return a local shell command line that runs command on the host,
+        with its standard input and output connected, or None if the
+        method can't do that. Used to start relay agents."""
+        return None
+
+    def transport_error(self, result: Result) -> bool:
+        """Tell whether result is a failure to reach the host, rather than
+        a failure of the command."""
+        return result.status == -1
+
+    def run_command(self, command: str) -> Result:
+        """Execute command on the host and return the result."""
+
+        try:
+            if self.cancelled:
+                raise Cancelled()
+            status, output = self._rexec(command)
+        except Exception as exc:  # noqa: BLE001
+            status, output = -1, f"tentakel: {exc}"
+        return Result(self.destination, status, output, self.duration)
+
+
+class Cancelled(Exception):
+    """The command was cancelled."""
+
+    def __str__(self):
+        return "cancelled"
 
-    def join(self, timeout=None):
-        """Stop the thread."""
-        self._stopevent.set()
-        threading.Thread.join(self, self._command_timeout)
+
+# protects the process and cancelled attributes of RemoteCommand objects
+_process_lock = threading.Lock()
+
+
+def signal_process_group(process: subprocess.Popen | spawner.SpawnedProcess, sig: int):
+    """Send sig to the process group of process, unless it is gone."""
+
+    if process.poll() is None:
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            pass
 
 
 def remote_command_factory(destination, params):
@@ -181,47 +326,278 @@ def remote_command_factory(destination, params):
         raise Abort(f'Method not implemented: "{method}"')
 
 
+def reconfigure_remote_command(obj, params):
+    """Apply params to the existing RemoteCommand obj if possible,
+    otherwise replace it by a new object. Return the object to use."""
+
+    if obj.params is params or obj.params == params:
+        return obj
+
+    cls = type(obj)
+    same_method = cls is _remote_command_plugins.get(params["method"])
+    # plugins that only override __init__ can't be reconfigured
+    legacy = cls.configure is RemoteCommand.configure and cls.__init__ is not RemoteCommand.__init__
+    if same_method and not legacy:
+        obj.configure(params)
+        return obj
+
+    obj.close()
+    return remote_command_factory(obj.destination, params)
+
+
+class RemoteCommandPool:
+    """RemoteCommand objects shared between collators.
+
+    Collators using the same pool get the same object for a host, as long
+    as its parameters are the same, so that the per-host state is kept
+    when switching between groups. Objects are closed when the last
+    collator using them releases them.
+    """
+
+    def __init__(self):
+        self._objects: dict[str, list[RemoteCommand]] = {}
+        self._users: dict[int, int] = {}
+
+    def __len__(self):
+        return len(self._users)
+
+    def acquire(self, destination, params) -> RemoteCommand:
+        """Return an object for destination with parameters params."""
+
+        objs = self._objects.setdefault(destination, [])
+        for obj in objs:
+            if obj.params is params or obj.params == params:
+                break
+        else:
+            obj = remote_command_factory(destination, params)
+            objs.append(obj)
+        self._users[id(obj)] = self._users.get(id(obj), 0) + 1
+        return obj
+
+    def release(self, obj: RemoteCommand):
+        """Give obj back, closing it if no one else uses it."""
+
+        if id(obj) not in self._users:
+            # added to a collator by hand
+            obj.close()
+            return
+        self._users[id(obj)] -= 1
+        if self._users[id(obj)] == 0:
+            del self._users[id(obj)]
+            self._objects[obj.destination].remove(obj)
+            if not self._objects[obj.destination]:
+                del self._objects[obj.destination]
+            obj.close()
+
+    def update(self, obj: RemoteCommand, params) -> RemoteCommand:
+        """Return an object to use instead of obj, with parameters params.
+        obj itself is reconfigured if no one else uses it."""
+
+        if obj.params is params or obj.params == params:
+            return obj
+        if self._users[id(obj)] > 1:
+            self.release(obj)
+            return self.acquire(obj.destination, params)
+
+        new = reconfigure_remote_command(obj, params)
+        if new is not obj:
+            del self._users[id(obj)]
+            self._users[id(new)] = 1
+            objs = self._objects[obj.destination]
+            objs[objs.index(obj)] = new
+        return new
+
+
 class RemoteCollator:
     """This class is meant to hold RemoteCommand instances each of which
-    implements a specific way too execute a command on a remote host."""
+    implements a specific way too execute a command on a remote host.
 
-    def __init__(self, conf, group_name):
-        self.remote_objects = []
-        self.use_conf(conf, group_name)
+    Collators sharing a RemoteCommandPool share the objects of their
+    common hosts. selection restricts the members of the group, hosts
+    that are not selected never get an object. where is a condition on
+    the facts of the hosts, checked along with the conditions of the
+    configuration before running a command. sample, if set, keeps a
+    random subset of the members, and sample_summary describes it.
+
+    metrics holds the counters of the last command, limit decides how
+    many hosts it runs on at the same time, domain_limit how many in the
+    same topology domain, and spawn how fast it is started on them.
+    """
+
+    def __init__(self, conf, group_name, pool: RemoteCommandPool | None = None, selection=None, sample=None):
+        self.members: list[str] | config.GroupMembers = []
+        self.selection = selection
+        self.where = ""
+        self.sample: hostset.Sample | None = sample
+        self.sample_summary: list[str] = []
+        # host name -> condition, for the members included on a condition
+        self.conditions: dict[str, str] = {}
+        self._trees: dict[str, object] = {}
+        # RemoteCommand objects of the members, by destination. They are
+        # created when the members are first run.
+        self.objects: dict[str, RemoteCommand] = {}
+        self._added: list[RemoteCommand] = []
+        self.pool = RemoteCommandPool() if pool is None else pool
+        self.maxparallel = 0
+        self.governor = True
+        # worker processes to split the hosts of a command between
+        self.procs = 1
+        # (process, connection) of the worker processes, relay agents and
+        # coordinator running the current command
+        self._shards: list[
+            tuple[BaseProcess | relay.Agent | cluster._Run, Connection | relay.Agent | cluster._Run]
+        ] = []
+        # cluster.Coordinator handing the hosts out to worker tentakels
+        self.coordinator: cluster.Coordinator | None = None
+        # commands run at the same time for the current command, 0 for all
+        self._parallel = 0
+        self.minparallel = 1
+        self.adaptive = False
+        self.metrics = control.RunMetrics()
+        self.limit = control.ConcurrencyLimit(0, self.metrics)
+        self.spawnrate = 0.0
+        self.spawnburst = 1
+        self.jitter = 0.0
+        self.spawn = control.SpawnRate(0, 1, 0, self.metrics)
+        self.history = False
+        self.history_ttl = 0.0
+        self._history: control.History | None = None
+        self.topology = ""
+        self.domainparallel = 0
+        # host name -> topology domain
+        self.domains: dict[str, str] = {}
+        self.domain_limit = control.DomainLimit(0, self.metrics)
+        self.resolve_ttl = 0.0
+        self.probe_timeout = 1.0
+        self.dead_ttl = 0.0
+        # probe hosts remembered as unreachable again
+        self.recheck = False
+        self.facts_command = ""
+        self.facts_ttl = 0.0
+        self._results: queue.Queue[Result] = queue.Queue()
+        self._pending = 0
+        self._workers: list[threading.Thread] = []
+        # state of the current command
+        self._todo: queue.SimpleQueue[RemoteCommand | None] = queue.SimpleQueue()
+        self._stop = threading.Event()
+        self._backlog: deque[RemoteCommand] = deque()
+        self._running: set[RemoteCommand] = set()
+        # hosts taken back by steal()
+        self._stolen: set[RemoteCommand] = set()
+        self._lock = threading.Lock()
+        self._nworkers = 0
+        self._dispatched = 0
+        self._needed = 0
+        self._succeeded = 0
+        self._failed = 0
+        self._command = ""
+        self._processes: list[subprocess.Popen | spawner.SpawnedProcess] = []
+        # number of hosts the last command was cancelled on, and why
+        self.cancelled = 0
+        self.stop_reason = ""
+        # cancel the command once that many hosts failed
+        self.fail_fast = 0
+        self.kill_timeout = 2.0
+        # how many hosts must succeed, see exec_all
+        self.first = 0
+        self.quorum = False
+        self.hedge = 0.0
+        self.format = ""
+        if conf is not None:
+            self.use_conf(conf, group_name)
         self.formatter = FormatString()
 
     def clear(self):
         """Empty the list of contained remoteobjects after stopping them."""
-        for obj in self.remote_objects:
-            obj.join()
-        self.remote_objects = []
+        self.join_all()
+        for obj in list(self.objects.values()) + self._added:
+            self.pool.release(obj)
+        self.members = []
+        self.objects = {}
+        self._added = []
 
     def use_conf(self, conf, group_name):
-        """Load the specified group from configuration object conf and add
-        RemoteCommand objects for each contained host."""
-        # FIXME: not sure what this does
-        save = self
-        self.clear()
+        """Load the specified group from configuration object conf.
+
+        The RemoteCommand objects of hosts that are still members are kept,
+        and reconfigured when they are run next if their parameters
+        changed. The others are closed.
+        """
+        self.join_all()
         try:
-            for destination, params in conf.get_group_members(group_name):
-                self.add(remote_command_factory(destination, params))
-                self.format = conf.get_param("format", group=group_name)
+            self.members = conf.get_members(group_name, self.selection)
+            if self.sample:
+                bits, self.sample_summary = self.sample.pick(self.members.hosts, self.members.segments)
+                self.members = self.members.restrict(bits)
+            self.format = conf.get_param("format", group=group_name)
+            self.maxparallel = int(conf.get_param("maxparallel", group=group_name))
+            self.governor = conf.get_param("governor", group=group_name) == "yes"
+            self.minparallel = int(conf.get_param("minparallel", group=group_name))
+            self.adaptive = conf.get_param("adaptive", group=group_name) == "yes"
+            self.spawnrate = float(conf.get_param("spawnrate", group=group_name))
+            self.spawnburst = int(conf.get_param("spawnburst", group=group_name))
+            self.jitter = float(conf.get_param("jitter", group=group_name))
+            self.history = conf.get_param("history", group=group_name) == "yes"
+            self.history_ttl = float(conf.get_param("history_ttl", group=group_name))
+            self.kill_timeout = float(conf.get_param("kill_timeout", group=group_name))
+            self.resolve_ttl = float(conf.get_param("resolve_ttl", group=group_name))
+            self.probe_timeout = float(conf.get_param("probe_timeout", group=group_name))
+            self.dead_ttl = float(conf.get_param("dead_ttl", group=group_name))
+            self.facts_command = conf.get_param("facts_command", group=group_name)
+            self.facts_ttl = float(conf.get_param("facts_ttl", group=group_name))
+            self.topology = conf.get_param("topology", group=group_name)
+            self.domainparallel = int(conf.get_param("domainparallel", group=group_name))
+            self.conditions = self.members.conditions()
+            self.domains = self.members.domains(self.topology) if self.topology else {}
         except KeyError:
-            self = save
+            self.members = []
+            self.conditions = {}
+            self.domains = {}
             error.warn(f"unknown group: '{group_name}'")
 
-    def get_destinations(self):
-        """Return expanded list of hosts."""
-        return [x.destination for x in self.remote_objects]
+        for destination in list(self.objects):
+            if destination not in self.members:
+                self.pool.release(self.objects.pop(destination))
+
+    def get_object(self, host) -> RemoteCommand:
+        """Return the RemoteCommand object for host, a Host record."""
+
+        destination, params = host
+        obj = self.objects.get(destination)
+        if obj is None:
+            obj = self.pool.acquire(destination, params)
+        else:
+            obj = self.pool.update(obj, params)
+        self.objects[destination] = obj
+        return obj
+
+    @property
+    def remote_objects(self) -> list[RemoteCommand]:
+        """RemoteCommand objects of all members."""
+        return [self.get_object(host) for host in self.members] + self._added
+
+    def get_destinations(self, start: int = 0, count: int | None = None) -> list[str]:
+        """Return expanded list of hosts, or count of them from position
+        start."""
+        out: list[str] = [] if isinstance(self.members, list) else self.members.names(start, count)
+        if self._added and (count is None or len(out) < count):
+            added = [obj.destination for obj in self._added]
+            skip = max(0, start - len(self.members))
+            added = added[skip:]
+            out += added if count is None else added[: count - len(out)]
+        return out
+
+    def __len__(self):
+        return len(self.members) + len(self._added)
 
     def add(self, obj: RemoteCommand):
         """Add a RemoteObject."""
         assert isinstance(obj, RemoteCommand)
-        self.remote_objects.append(obj)
+        self._added.append(obj)
 
     def remove(self, obj):
         """Remove a RemoteObject."""
-        self.remote_objects.remove(obj)
+        self._added.remove(obj)
 
     def expand_format(self, map=None):
         """Apply a format mapping to the format string.
@@ -237,37 +613,606 @@ class RemoteCollator:
         return self.formatter(self.format)
 
     def exec_all(self, command: str):
-        """Execute command on all remote objects."""
+        """Execute command on all remote objects.
+
+        Returns immediately, the results are collected by collect() or
+        display_all(). At most maxparallel commands run at the same time,
+        fewer if the governor finds that this machine can't afford them.
+        If adaptive is set, the limit starts at minparallel and changes
+        with the durations and transport errors of the commands. Starts
+        are paced by spawnrate, spawnburst and jitter.
+
+        With history, the durations of the command are recorded, and if
+        not all hosts can run at once, those where it took longest before
+        are started first. With topology, the hosts of the topology domains
+        take turns, and at most domainparallel of them run at the same time
+        in a domain.
+
+        With procs above 1, the hosts are dealt out to that many worker
+        processes, which share the limits and send their results back, so
+        that large runs are not bound to one CPU.
 
-        for obj in self.remote_objects:
-            obj.execute(command)
+        If first is set, only that many hosts need to succeed (a majority
+        of them with quorum): the command is cancelled on the others as
+        soon as they have. With hedge too, the command is started on first
+        hosts only, then on one more whenever one fails or no result came
+        for hedge seconds.
+
+        Hosts with a relay are run by a tentakel agent started on the relay
+        host instead, see the relay module. With a coordinator, the other
+        hosts are run by the worker tentakels connected to it, see the
+        cluster module.
+        """
+
+        objs, needed, relayed = self.prepare(command)
+        if self.coordinator is not None:
+            self._start([], needed, command)
+            self._pending += len(objs)
+            run = self.coordinator.start(objs, command, self)
+            self._shards.append((run, run))
+        else:
+            shards = self.procs > 1 and len(objs) > 1 and not (needed and self.hedge)
+            self._start(objs, needed, command, self.procs if shards else 1)
+        for name, relay_objs in relayed.items():
+            self._start_relay(name, relay_objs, command)
+
+    def prepare(self, command: str):
+        """Return the objects to run command on, in order, the number of
+        hosts that must succeed, and the objects of the hosts with a relay,
+        by relay. The metrics of the run are reset."""
+
+        objs = self.remote_objects
+        needed = len(objs) // 2 + 1 if self.quorum else self.first
+        relayed: dict[str, list[RemoteCommand]] = {}
+        for obj in objs:
+            if obj.params["relay"]:
+                relayed.setdefault(obj.params["relay"], []).append(obj)
+        if relayed:
+            objs = [obj for obj in objs if not obj.params["relay"]]
+        objs = self.check_facts(self.check_all(objs))
+        self.metrics = control.RunMetrics(len(objs) + sum(map(len, relayed.values())))
+        self._parallel = self.maxparallel
+        if self.governor and objs:
+            parallel = control.govern(self.maxparallel or len(objs), self.metrics)
+            if parallel < len(objs):
+                self._parallel = parallel
+        self._history = None
+        if self.history:
+            self._history = control.History(cache.ttl_cache("history"), command, self.history_ttl)
+            if self._parallel and self._parallel < len(objs) and not needed:
+                objs = self._history.order(objs)
+        if self.domains:
+            objs = control.interleave(objs, self.domains)
+        return objs, needed, relayed
+
+    def _start(self, objs: list[RemoteCommand], needed: int, command: str, nshards: int = 1):
+        """Start command on the objects objs, split between nshards worker
+        processes if more than one."""
+
+        self._todo = queue.SimpleQueue()
+        self._stop = threading.Event()
+        # the worker processes have their own backlogs
+        self._backlog = deque(objs if nshards == 1 else ())
+        self._nworkers = 0
+        self._dispatched = 0
+        self._needed = needed
+        self._succeeded = 0
+        self._failed = 0
+        self._processes = []
+        self._shards = []
+        self._stolen = set()
+        self.cancelled = 0
+        self.stop_reason = ""
+        self._pending += len(objs)
+        self._command = command
+        if nshards > 1:
+            self._start_shards(objs, nshards)
+            return
+        if self.adaptive:
+            ceiling = self._parallel or len(objs)
+            self.limit = control.AdaptiveLimit(self.minparallel, ceiling, self.metrics)
+        else:
+            self.limit = control.ConcurrencyLimit(self._parallel, self.metrics)
+        self.spawn = control.SpawnRate(self.spawnrate, self.spawnburst, self.jitter, self.metrics)
+        self.domain_limit = control.DomainLimit(self.domainparallel if self.domains else 0, self.metrics)
+        self._feed(needed if needed and self.hedge else len(objs))
+
+    def _start_shards(self, objs: list[RemoteCommand], nshards: int):
+        """Deal the objects objs out to nshards worker processes, and start
+        a thread per worker to pass its results on."""
+
+        context = multiprocessing.get_context("fork")
+        for i in range(nshards):
+            shard = objs[i::nshards]
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=self._run_shard, args=(shard, child_conn, nshards), daemon=True)
+            process.start()
+            child_conn.close()
+            args = (f"worker process {i}", shard, conn, self._results)
+            reader = threading.Thread(target=self._read_shard, args=args, daemon=True)
+            reader.start()
+            self._shards.append((process, conn))
+            self._workers.append(reader)
+
+    def _start_relay(self, name: str, objs: list[RemoteCommand], command: str):
+        """Start the agent on relay host name, have it run command on the
+        objects objs, and start a thread to pass its results on."""
+
+        try:
+            agent = relay.start_agent(name, objs, command, self)
+        except OSError as exc:
+            for obj in objs:
+                self._fail(obj, f"relay {name}: {exc}")
+            return
+        self._pending += len(objs)
+        args = (f"relay {name}", objs, agent, self._results)
+        reader = threading.Thread(target=self._read_shard, args=args, daemon=True)
+        reader.start()
+        self._shards.append((agent, agent))
+        self._workers.append(reader)
+
+    def _read_shard(self, name: str, objs: list[RemoteCommand], conn, results: queue.Queue[Result]):
+        """Reader thread: pass the results of the worker process or relay
+        name on to results, until it is done. The hosts it sent no result
+        for were left out, see Result. If it goes away, they fail instead."""
+
+        received = set()
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == "done":
+                    with self._lock:
+                        self.metrics.merge(message[1], f"{name}: ")
+                    for obj in objs:
+                        if obj.destination not in received:
+                            # left out by its condition there
+                            results.put(Result(obj.destination, None, "", 0.0))
+                    break
+                received.add(message[1])
+                results.put(Result(*message[1:]))
+        except (EOFError, OSError):
+            for obj in objs:
+                if obj.destination not in received:
+                    results.put(Result(obj.destination, -1, f"tentakel: {name} went away", 0.0))
+        conn.close()
+
+    def _run_shard(self, objs: list[RemoteCommand], conn, nshards: int):
+        """Main function of a worker process: run the command on objs, with
+        a share of the limits of the run, and send the results to the
+        parent as they come."""
+
+        # Ctrl-C is for the parent, which cancels the command itself
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for _, other in self._shards:
+            # the connections of the shards started before
+            other.close()
+        self._shards = []
+        self._results = queue.Queue()
+        self._pending = 0
+        self._workers = []
+        self._lock = threading.Lock()
+        self._history = None
+        self.fail_fast = 0
+        self.metrics = control.RunMetrics(len(objs))
+        if self._parallel:
+            self._parallel = -(-self._parallel // nshards)
+        if self.governor:
+            self._parallel = control.govern(self._parallel or len(objs), self.metrics)
+        self.spawnrate /= nshards
+        self.serve(objs, self._command, conn)
+
+    def serve(self, objs: list[RemoteCommand], command: str, conn):
+        """Run command on the objects objs on behalf of another tentakel,
+        the parent, and send it the results as they come, then the metrics.
+
+        conn is a connection to the parent, with send() and recv() methods.
+        The parent sends "cancel" or "kill" to cancel the command or kill
+        its processes, or ("steal", n) to take back up to n hosts the
+        command was not started on yet, see steal(). Their names are sent
+        back in a "stolen" message, they get no result. The command is
+        cancelled if the parent goes away.
+        """
+
+        self._start(objs, 0, command)
+        threading.Thread(target=self._listen, args=(conn,), daemon=True).start()
+
+        sent = set()
+        while self._pending > len(self._stolen):
+            try:
+                result = self.next_result(timeout=STEAL_POLL)
+            except queue.Empty:
+                # the hosts left may have been stolen meanwhile
+                continue
+            conn.send(("result", result.destination, result.status, result.output, result.duration))
+            sent.add(result.destination)
+        # all the hosts left were stolen, none is waiting to be started
+        self._pending -= len(self._stolen)
+        for obj in objs:
+            if obj.destination not in sent and obj not in self._stolen:
+                # cancelled before it started
+                conn.send(("result", obj.destination, -1, "tentakel: cancelled", 0.0))
+        self.join_all()
+        self.metrics.finish()
+        conn.send(("done", vars(self.metrics)))
+
+    def _listen(self, conn):
+        """Thread of serve(): cancel or kill the command when the parent
+        says so."""
+
+        try:
+            while True:
+                message = conn.recv()
+                if message == "cancel":
+                    self.cancel("cancelled by the parent")
+                elif message == "kill":
+                    self.kill()
+                elif message[0] == "steal":
+                    stolen = self.steal(message[1])
+                    conn.send(("stolen", [obj.destination for obj in stolen]))
+        except (EOFError, OSError):
+            if self._pending > 0:
+                self.cancel("lost the parent")
+
+    def steal(self, n: int) -> list[RemoteCommand]:
+        """Take back up to n hosts of the current command that it was not
+        started on yet, so that another tentakel can run it there instead.
+        Return their objects."""
+
+        out: list[RemoteCommand] = []
+        with self._lock:
+            if self._stop.is_set():
+                return out
+            while len(out) < n:
+                try:
+                    obj = self._todo.get_nowait()
+                except queue.Empty:
+                    break
+                if obj is None:
+                    # the hosts are all started, let the worker go
+                    self._todo.put(None)
+                    break
+                out.append(obj)
+            self._stolen.update(out)
+        return out
+
+    def plan(self, command: str) -> list[str]:
+        """Predict how long command will take, from its durations in the
+        history, without running it. Return the prediction, line by line."""
+
+        history = control.History(cache.ttl_cache("history"), command, self.history_ttl)
+        objs = self.remote_objects
+        if self.maxparallel and self.maxparallel < len(objs):
+            objs = history.order(objs)
+        if self.domains:
+            objs = control.interleave(objs, self.domains)
+        durations, known = history.estimates([obj.destination for obj in objs])
+        if not known:
+            return [f"no history of '{command}' on these {len(objs)} hosts"]
+        wall = control.predict(durations, self.maxparallel, self.spawnrate)
+        out = [
+            f"{len(objs)} hosts, {known} with history, at most {self.maxparallel or len(objs)} in parallel",
+            f"predicted wall time: {wall:.2f}s",
+        ]
+        slowest = sorted(zip(durations, objs), key=lambda d: -d[0])[:PLAN_SLOWEST]
+        out += [f"  {obj.destination}: {duration:.2f}s" for duration, obj in slowest]
+        return out
+
+    def check_all(self, objs: list[RemoteCommand]) -> list[RemoteCommand]:
+        """Resolve the addresses of the hosts that ask for it, then probe
+        the port of the hosts that ask for it, all at once.
+
+        Return the objects to run the command on. Hosts that can't be
+        resolved or reached get a failed result right away instead.
+        """
+
+        names = []
+        for obj in objs:
+            obj.address = None
+            # left over from a command cancelled before, facts are
+            # gathered with run_command() too
+            obj.cancelled = False
+            if obj.params["resolve"] == "yes":
+                names.append(obj.destination)
+        if names:
+            addresses = cache.ttl_cache("addresses")
+            found, failed = preflight.resolve(names, addresses, self.resolve_ttl)
+            addresses.save()
+            objs = self._drop_failed(objs, failed)
+            for obj in objs:
+                obj.address = found.get(obj.destination)
+
+        targets = []
+        for obj in objs:
+            port = obj.params["port"] or obj.default_port
+            if obj.params["probe"] == "yes" and port:
+                targets.append((obj.destination, obj.address or obj.destination, int(port)))
+        if targets:
+            dead = cache.ttl_cache("dead")
+            failed = preflight.probe(targets, dead, self.probe_timeout, self.dead_ttl, self.recheck)
+            dead.save()
+            objs = self._drop_failed(objs, failed)
+        return objs
+
+    def check_facts(self, objs: list[RemoteCommand]) -> list[RemoteCommand]:
+        """Leave out the hosts whose facts don't meet their condition from
+        the configuration, or the where condition.
+
+        Facts are gathered for the hosts that have a condition, unless
+        they are still cached. Hosts whose facts can't be gathered get a
+        failed result right away.
+        """
+
+        todo = [obj for obj in objs if self.where or obj.destination in self.conditions]
+        if not todo:
+            return objs
+
+        store = cache.ttl_cache("facts")
+        found, failed = facts.gather(todo, self.facts_command, store, self.facts_ttl, self.maxparallel)
+        store.save()
+        objs = self._drop_failed(objs, failed)
+        where = self._condition_tree(self.where)
+        out = []
+        for obj in objs:
+            if obj.destination in found:
+                host_facts = found[obj.destination]
+                condition = self._condition_tree(self.conditions.get(obj.destination, ""))
+                if where is False or condition is False:
+                    continue
+                if where and not facts.evaluate(where, host_facts):
+                    continue
+                if condition and not facts.evaluate(condition, host_facts):
+                    continue
+            out.append(obj)
+        return out
+
+    def _condition_tree(self, text: str):
+        """Return condition text parsed, None if there is no condition, or
+        False if it is invalid."""
+
+        if not text:
+            return None
+        if text not in self._trees:
+            try:
+                self._trees[text] = facts.parse_condition(text)
+            except Abort:
+                # already reported
+                self._trees[text] = False
+        return self._trees[text]
+
+    def _drop_failed(self, objs: list[RemoteCommand], failed: dict[str, str]) -> list[RemoteCommand]:
+        """Report the failures of the hosts in failed, return the other
+        objects."""
+
+        if not failed:
+            return objs
+        out = []
+        for obj in objs:
+            if obj.destination in failed:
+                self._fail(obj, failed[obj.destination])
+            else:
+                out.append(obj)
+        return out
+
+    def _fail(self, obj: RemoteCommand, message: str):
+        """Report that the command could not be run on obj."""
+
+        self._pending += 1
+        self._results.put(Result(obj.destination, -1, f"tentakel: {message}", 0.0))
+
+    def _feed(self, n: int):
+        """Start the command on n more hosts of the backlog."""
+
+        limit = self._parallel or len(self._backlog) + self._dispatched
+        for _ in range(min(n, len(self._backlog))):
+            self._todo.put(self._backlog.popleft())
+            self._dispatched += 1
+            if self._nworkers < min(self._dispatched, limit):
+                args = (self._todo, self._stop, self._results, self._command)
+                worker = threading.Thread(target=self._work, args=args, daemon=True)
+                try:
+                    worker.start()
+                except RuntimeError:
+                    if not self._nworkers:
+                        raise
+                    # out of threads, the workers there are take the rest
+                    self.metrics.log(f"governor: could not start more than {self._nworkers} workers")
+                    self._parallel = limit = self._nworkers
+                    continue
+                self._workers.append(worker)
+                self._nworkers += 1
+        if not self._backlog:
+            # no more hosts to come, let the workers go
+            for _ in range(self._nworkers):
+                self._todo.put(None)
+            self._nworkers = 0
+
+    def _work(self, todo, stop, results, command):
+        """Worker thread: run command on remote objects until none is left."""
+
+        limit, spawn, domain_limit = self.limit, self.spawn, self.domain_limit
+        while True:
+            obj = todo.get()
+            if obj is None:
+                return
+            domain = self.domains.get(obj.destination, "")
+            if not (spawn.stagger(stop) and domain_limit.acquire(domain, stop)):
+                results.put(Result(obj.destination, -1, "tentakel: cancelled", 0.0))
+                continue
+            started = limit.acquire(stop)
+            if started and not spawn.wait(stop):
+                limit.release()
+                started = False
+            with self._lock:
+                if not started or stop.is_set():
+                    if started:
+                        limit.release()
+                    domain_limit.release(domain)
+                    results.put(Result(obj.destination, -1, "tentakel: cancelled", 0.0))
+                    continue
+                obj.cancelled = False
+                self._running.add(obj)
+            result = obj.run_command(command)
+            with self._lock:
+                self._running.discard(obj)
+            # cancelled while running, it counts as neither
+            limit.release(None if obj.cancelled else result, obj.transport_error(result))
+            domain_limit.release(domain)
+            results.put(result)
+
+    def cancel(self, reason: str = ""):
+        """Stop the current command: start it on no more hosts, and cancel
+        it where it is running. The results of the cancelled hosts are left
+        out by collect(). Processes that don't terminate within
+        kill_timeout seconds are killed."""
+
+        with self._lock:
+            if self._stop.is_set():
+                return
+            self._stop.set()
+            running = list(self._running)
+            # hosts with no result yet, their results are dropped. Worker
+            # processes cancel from their listener thread.
+            self.cancelled = self._pending - self._results.qsize()
+            self._pending -= len(self._backlog)
+            self._backlog.clear()
+        self.stop_reason = reason
+        self._feed(0)
+        self.limit.wake()
+        self.domain_limit.wake()
+        self._tell_shards("cancel")
+        self._processes = [p for p in (obj.cancel() for obj in running) if p is not None]
+        if self._processes:
+            timer = threading.Timer(self.kill_timeout, self.kill)
+            timer.daemon = True
+            timer.start()
+
+    def kill(self):
+        """Kill the processes of the cancelled command right away."""
+
+        for process in self._processes:
+            signal_process_group(process, signal.SIGKILL)
+        self._tell_shards("kill")
+
+    def _tell_shards(self, message: str):
+        for _, conn in self._shards:
+            try:
+                conn.send(message)
+            except OSError:
+                pass
 
     def join_all(self):
-        """Join the running threads for all remote objects."""
+        """Wait for the worker threads of running commands to finish.
+        Hosts the command was not started on yet are cancelled.
+
+        If the command was cancelled, wait only as long as it takes to
+        kill its processes: workers stuck with processes that can't be
+        killed are left behind.
+        """
+
+        if self._backlog:
+            self.cancel()
+        deadline = time.monotonic() + self.kill_timeout + 1 if self._stop.is_set() else None
+        for worker in self._workers:
+            worker.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        self._workers = []
+        for process, _ in self._shards:
+            process.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        self._shards = []
 
-        for obj in self.remote_objects:
-            obj.join()
+    def next_result(self, timeout: float | None = None) -> Result:
+        """Return the next result of a running command, in the order the
+        commands finish."""
+
+        result = self._results.get(timeout=timeout)
+        with self._lock:
+            self._pending -= 1
+        return result
+
+    def collect(self):
+        """Yield the results of the running command as they come, until
+        there are no more.
+
+        The command is cancelled once enough hosts succeeded, see exec_all,
+        or once fail_fast hosts failed. The results that come after that
+        are still waited for, but not yielded.
+        """
+
+        while self._pending > 0:
+            try:
+                result = self.next_result(timeout=self.hedge if self._backlog else None)
+            except queue.Empty:
+                # slow hosts, hedge with another one
+                self._feed(1)
+                continue
+            if self._stop.is_set() or result.status is None:
+                continue
+            if self._history is not None and result.status != -1:
+                self._history.record(result.destination, result.duration)
+            yield result
+            if result.status == 0:
+                self._succeeded += 1
+                if self._needed and self._succeeded >= self._needed:
+                    self.cancel(f"{self._succeeded} hosts succeeded")
+            else:
+                self._failed += 1
+                if self.fail_fast and self._failed >= self.fail_fast:
+                    self.cancel(f"{self._failed} hosts failed")
+                elif self._needed and self.hedge:
+                    self._feed(1)
+        self.metrics.finish()
+        if self._history is not None:
+            self._history.save()
+
+    def _drain(self):
+        """Wait for the results of a cancelled command, as long as it takes
+        to kill its processes. Results that come later are dropped: they go
+        to the queue of the command, which the threads waiting for them
+        hold on to, and the next command gets a new one."""
+
+        deadline = time.monotonic() + self.kill_timeout + 1
+        while self._pending > 0:
+            try:
+                self.next_result(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                self._results = queue.Queue()
+                self._pending = 0
+                # stuck, they are left behind
+                self._workers = []
 
     def display_all(self):
-        """Display the next pending result for every remote object."""
+        """Display the results of all pending commands, then wait for the
+        worker threads, see join_all().
 
-        display_count = len(self.remote_objects)
-        while display_count > 0:
-            obj = RemoteCommand.finished_objects.get()
-            display_count -= 1
-            status, output = obj.get_result()
-            result_map = {
-                "%d": obj.destination,
-                "%t": str(round(obj.duration, 2)),
-                "%o": output,
-                "%s": str(status),
-            }
-            sys.stdout.write(self.expand_format(result_map))
+        On an interrupt, the command is cancelled and the results it had
+        so far are summed up. A second interrupt kills its processes right
+        away instead of giving them kill_timeout seconds to terminate.
+        """
 
-        assert RemoteCommand.finished_objects.qsize() == 0
+        try:
+            for result in self.collect():
+                result_map = {
+                    "%d": result.destination,
+                    "%t": str(round(result.duration, 2)),
+                    "%o": result.output,
+                    "%s": str(result.status),
+                }
+                sys.stdout.write(self.expand_format(result_map))
+        except KeyboardInterrupt:
+            self.cancel("interrupted")
+        try:
+            self._drain()
+        except KeyboardInterrupt:
+            self.kill()
+            self._drain()
+        self.join_all()
+        if self.stop_reason:
+            error.warn(
+                f"{self.stop_reason}: {self._succeeded} succeeded, {self._failed} failed, "
+                f"cancelled on {self.cancelled} hosts"
+            )
 
 
-_remote_command_plugins = {}
+_remote_command_plugins: dict[str, type[RemoteCommand]] = {}
 
 
 def register_remote_command_plugin(method: str, cls: type[RemoteCommand]):
@@ -278,4 +1223,4 @@ def register_remote_command_plugin(method: str, cls: type[RemoteCommand]):
 
 
 # Don't remove / don't move
-from .plugins import *  # noqa
+from .plugins import *  # noqa: E402, F401, F403
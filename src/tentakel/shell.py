@@ -27,24 +27,48 @@
 """Interactive mode for tentakel."""
 
 import cmd
+import time
+from collections import OrderedDict
 
-from . import remote
+from . import cache, facts, hostset, remote
+from .error import Abort
 
 try:
     import readline  # noqa
 except ImportError:
     pass
 
+# number of hosts listed at once by the hosts command
+HOSTS_PAGE = 1000
+
+# attributes of the current collator passed on to the collator of a group
+# used for the first time
+RUN_SETTINGS = ("where", "first", "quorum", "hedge", "fail_fast", "procs", "coordinator")
+
 
 class TentakelShell(cmd.Cmd):
-    def __init__(self, conf, group_name):
+    """Interactive shell.
+
+    The collators of recently used groups are kept, least recently used
+    first, so that switching back to a group is instant. They are dropped
+    when they have been idle for more than cache_idle seconds or when
+    together they hold more than cache_hosts hosts. Hosts common to
+    several groups share their RemoteCommand objects.
+    """
+
+    def __init__(self, conf, group_name, selection=None):
         super().__init__()
         self.doc_header = "commands (type help <topic>):"
         self.ruler = ""
         self.group_name = group_name
-        self.prompt = f"tentakel({group_name})> "
         self.conf = conf
-        self.dests = remote.RemoteCollator(conf, group_name)
+        self.pool = remote.RemoteCommandPool()
+        self.dests = remote.RemoteCollator(conf, group_name, self.pool, selection)
+        self.set_prompt()
+        # group name -> (collator, time it was left)
+        self.collators: OrderedDict[str, tuple[remote.RemoteCollator, float]] = OrderedDict()
+        # cached groups that need to be reloaded from the configuration
+        self.stale: set[str] = set()
 
     def __del__(self):
         self.dests.join_all()
@@ -53,16 +77,25 @@ class TentakelShell(cmd.Cmd):
         pass
 
     def postcmd(self, stop, rest):
-        self.prompt = f"tentakel({self.group_name})> "
+        self.set_prompt()
         return stop
 
+    def set_prompt(self):
+        name = "*" if self.group_name is None else self.group_name
+        if self.dests.selection:
+            name += f" {self.dests.selection}"
+        self.prompt = f"tentakel({name})> "
+
     def do_exec(self, cmd):
         """exec <cmd>: applies <cmd> to the current group."""
 
         if not cmd:
             print("empty command")
             return
-        self.dests.exec_all(cmd)
+        try:
+            self.dests.exec_all(cmd)
+        except KeyboardInterrupt:
+            self.dests.cancel("interrupted")
         self.dests.display_all()
 
     def do_conf(self, rest):
@@ -70,13 +103,169 @@ class TentakelShell(cmd.Cmd):
 
         self.conf.edit()
         self.dests.use_conf(self.conf, self.group_name)
+        self.stale.update(self.collators)
 
     def do_use(self, rest):
-        """use <groupname>: use the specified group."""
+        """use <groupname>: use the specified group. A group used for the
+        first time gets the where, first, failfast, worker processes and
+        coordinator settings of the current one."""
 
-        if rest:
+        if rest and rest != self.group_name:
+            self.collators[self.group_name] = (self.dests, time.time())
+            if rest in self.collators:
+                self.dests, _ = self.collators.pop(rest)
+                if rest in self.stale:
+                    self.dests.use_conf(self.conf, rest)
+            else:
+                dests = remote.RemoteCollator(self.conf, rest, self.pool)
+                for setting in RUN_SETTINGS:
+                    setattr(dests, setting, getattr(self.dests, setting))
+                self.dests = dests
+            self.stale.discard(rest)
             self.group_name = rest
-            self.dests.use_conf(self.conf, self.group_name)
+            self.trim_collators()
+
+    def do_select(self, rest):
+        """select [labels]: run only on the hosts of the current group that
+        have all of labels, e.g. select role=web,dc=fra. Without labels, run
+        on all of them again."""
+
+        self.change_selection(labels=rest)
+
+    def do_only(self, rest):
+        """only [hosts]: run only on the given comma separated hosts of the
+        current group. Without hosts, run on all of them again."""
+
+        self.change_selection(hosts=rest)
+
+    def do_exclude(self, rest):
+        """exclude [patterns]: do not run on the hosts of the current group
+        matching the comma separated glob patterns. Without patterns, run on
+        all of them again."""
+
+        self.change_selection(exclude=rest)
+
+    def do_match(self, rest):
+        """match [regex]: run only on the hosts of the current group whose
+        name matches regex. Without regex, run on all of them again."""
+
+        self.change_selection(match=rest.strip())
+
+    def do_where(self, rest):
+        """where [condition]: run only on the hosts of the current group whose
+        facts meet condition, e.g. where load < 2. Without condition, run on
+        all of them again."""
+
+        rest = rest.strip()
+        if rest:
+            try:
+                facts.parse_condition(rest)
+            except Abort:
+                # already reported
+                return
+        self.dests.where = rest
+
+    def do_first(self, rest):
+        """first [k|quorum [hedge]]: stop running commands in the current group
+        as soon as k hosts (or a majority of them) succeeded. With hedge, start
+        on that many hosts only, then on one more when one fails or is slower
+        than hedge seconds. Without k, wait for all hosts again."""
+
+        args = rest.split()
+        try:
+            first = 0 if not args or args[0] == "quorum" else int(args[0])
+            hedge = float(args[1]) if len(args) > 1 else 0.0
+        except ValueError:
+            print("usage: first [k|quorum [hedge]]")
+            return
+        self.dests.first = first
+        self.dests.quorum = bool(args) and args[0] == "quorum"
+        self.dests.hedge = hedge
+
+    def do_failfast(self, rest):
+        """failfast [n]: stop running commands in the current group as soon as
+        n hosts failed. Without n, never stop early."""
+
+        try:
+            self.dests.fail_fast = int(rest or 0)
+        except ValueError:
+            print("usage: failfast [n]")
+
+    def do_sample(self, rest):
+        """sample [size [key [seed]]]: run on a random sample of size hosts,
+        or size% of the current group, every value of label key (or every
+        group, if key is "group") getting its share. Without size, run on
+        all of them again."""
+
+        args = rest.split()
+        if not args:
+            self.set_sample(None)
+            return
+        try:
+            seed = int(args[2]) if len(args) > 2 else None
+            self.set_sample(hostset.Sample(args[0], args[1] if len(args) > 1 else "", seed))
+        except ValueError:
+            print("invalid seed")
+        except Abort:
+            # already reported
+            pass
+
+    def set_sample(self, sample):
+        """Sample the current group, and print a summary of the sample."""
+
+        self.dests.sample = sample
+        self.dests.use_conf(self.conf, self.group_name)
+        if sample:
+            print("\n".join(self.dests.sample_summary))
+
+    def change_selection(self, **changes):
+        """Change the selection of the current collator and reload it."""
+
+        try:
+            selection = (self.dests.selection or hostset.Selection()).replace(**changes)
+        except Abort:
+            # already reported
+            return
+        self.dests.selection = selection
+        self.dests.use_conf(self.conf, self.group_name)
+
+    def trim_collators(self):
+        """Drop the cached collators that are over budget."""
+
+        max_hosts = int(self.conf.get_param("cache_hosts"))
+        max_idle = float(self.conf.get_param("cache_idle"))
+        now = time.time()
+        hosts = sum(len(dests.objects) for dests, _ in self.collators.values())
+        while self.collators:
+            group_name, (dests, left) = next(iter(self.collators.items()))
+            if hosts <= max_hosts and now - left <= max_idle:
+                break
+            del self.collators[group_name]
+            self.stale.discard(group_name)
+            hosts -= len(dests.objects)
+            dests.clear()
+
+    def do_recheck(self, rest):
+        """recheck: forget the hosts remembered as unreachable."""
+
+        dead = cache.ttl_cache("dead")
+        dead.clear()
+        dead.save()
+
+    def do_stats(self, rest):
+        """stats: show the metrics of the last command run in the current
+        group."""
+
+        print("\n".join(self.dests.metrics.summary()))
+
+    def do_plan(self, rest):
+        """plan <command>: predict how long command will take in the current
+        group, from its past durations, without running it."""
+
+        if not rest:
+            print("usage: plan <command>")
+            return
+        print("\n".join(self.dests.plan(rest)))
 
     def do_groups(self, rest):
         """groups: list available groups"""
@@ -84,9 +273,20 @@ class TentakelShell(cmd.Cmd):
         print("\n".join(self.conf.get_groups()))
 
     def do_hosts(self, rest):
-        """hosts: list of affected hosts"""
+        """hosts [page]: list of affected hosts, a page at a time"""
 
-        print("\n".join(self.dests.get_destinations()))
+        try:
+            page = int(rest or 1)
+        except ValueError:
+            print("invalid page number")
+            return
+        count = len(self.dests)
+        hosts = self.dests.get_destinations((page - 1) * HOSTS_PAGE, HOSTS_PAGE)
+        if hosts:
+            print("\n".join(hosts))
+        if count > HOSTS_PAGE:
+            pages = (count + HOSTS_PAGE - 1) // HOSTS_PAGE
+            print(f"(page {page} of {pages}, {count} hosts)")
 
     def do_quit(self, rest):
         """quit or ctrl-d: quit program."""
@@ -0,0 +1,297 @@
+#
+# Copyright (c) 2002, 2003, 2004, 2005 Sebastian Stark
+# Copyright (c) 2019-2023 Stefane Fermigier
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR SEBASTIAN STARK
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""A small helper process that starts the processes of the transports.
+
+Forking the main tentakel process for every host gets slow once it runs
+many threads and holds many results in memory. With the helper, that is
+forked once, early, while tentakel is still small and single-threaded,
+and forks the transport processes on its behalf:
+
+  spawner.start()
+  process = spawner.spawn("ssh web1 uptime", env=None)
+  output, _ = process.communicate()
+
+The helper passes the read end of the output pipe of every process it
+starts back over a Unix socket, so that the output goes straight to
+tentakel, and reports their exit status when they end. Processes get a
+process group of their own, as with run_process(), so that they can be
+signalled by tentakel directly.
+"""
+
+from __future__ import annotations
+
+import os
+import pickle
+import selectors
+import signal
+import socket
+import struct
+import subprocess
+import threading
+from collections import deque
+
+_HEADER = struct.Struct("!I")
+
+
+class SpawnedProcess:
+    """A process started by the helper, with the part of the interface of
+    subprocess.Popen that run_process() and cancellation use."""
+
+    def __init__(self):
+        self.pid = 0
+        self.returncode: int | None = None
+        self.fd = -1
+        self.error: OSError | None = None
+        self.started = threading.Event()
+        self.exited = threading.Event()
+
+    def poll(self) -> int | None:
+        return self.returncode
+
+    def wait(self, timeout: float | None = None) -> int | None:
+        self.exited.wait(timeout)
+        return self.returncode
+
+    def communicate(self) -> tuple[str, None]:
+        """Read the output of the process until it ends, and wait for its
+        exit status."""
+
+        with open(self.fd, errors="replace") as stream:
+            output = stream.read()
+        self.wait()
+        return output, None
+
+
+class SpawnHelper:
+    """The helper process, seen from tentakel."""
+
+    def __init__(self):
+        sock, helper_sock = socket.socketpair()
+        self.pid = os.fork()
+        if self.pid == 0:  # pragma: nocover
+            sock.close()
+            try:
+                _serve(helper_sock)
+            finally:
+                os._exit(0)
+        helper_sock.close()
+        self.sock = sock
+        self.lock = threading.Lock()
+        # request number -> process, until it ends
+        self.processes: dict[int, SpawnedProcess] = {}
+        self.count = 0
+        self.alive = True
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def spawn(self, cmd: str, env: dict[str, str] | None = None) -> SpawnedProcess:
+        """Have shell command cmd started, in environment env if given, and
+        return its process. Raise OSError if it could not be started."""
+
+        process = SpawnedProcess()
+        with self.lock:
+            if not self.alive:
+                raise OSError("spawn helper is gone")
+            self.count += 1
+            self.processes[self.count] = process
+            _send(self.sock, (self.count, cmd, env))
+        process.started.wait()
+        if process.error is not None:
+            raise process.error
+        return process
+
+    def _read(self):
+        """Reader thread: dispatch the messages of the helper."""
+
+        fds: deque[int] = deque()
+        try:
+            while True:
+                message = _receive(self.sock, fds)
+                if message is None:
+                    break
+                kind, n, *args = message
+                process = self.processes[n]
+                if kind == "started":
+                    process.pid, process.fd = args[0], fds.popleft()
+                    process.started.set()
+                elif kind == "exited":
+                    process.returncode = args[0]
+                    del self.processes[n]
+                    process.exited.set()
+                else:
+                    process.error = OSError(*args)
+                    del self.processes[n]
+                    process.started.set()
+        except OSError:
+            pass
+        with self.lock:
+            self.alive = False
+            processes, self.processes = self.processes, {}
+        for process in processes.values():
+            if not process.started.is_set():
+                process.error = OSError("spawn helper is gone")
+                process.started.set()
+            process.returncode = -1
+            process.exited.set()
+
+    def close(self):
+        """Stop the helper. The processes it started go on by themselves."""
+
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.reader.join()
+        self.sock.close()
+        os.waitpid(self.pid, 0)
+
+
+def _send(sock: socket.socket, message, fds: list[int] | None = None):
+    data = pickle.dumps(message)
+    data = _HEADER.pack(len(data)) + data
+    sent = socket.send_fds(sock, [data], fds) if fds else sock.send(data)
+    if sent < len(data):
+        sock.sendall(data[sent:])
+
+
+def _receive(sock: socket.socket, fds: deque[int]):
+    """Return the next message on sock, or None at the end. File
+    descriptors sent along with it are added to fds."""
+
+    header = _read_exactly(sock, _HEADER.size, fds)
+    if header is None:
+        return None
+    data = _read_exactly(sock, _HEADER.unpack(header)[0], fds)
+    return None if data is None else pickle.loads(data)
+
+
+def _read_exactly(sock: socket.socket, size: int, fds: deque[int]) -> bytes | None:
+    data = b""
+    while len(data) < size:
+        chunk, received, _, _ = socket.recv_fds(sock, size - len(data), 4)
+        if not chunk:
+            return None
+        data += chunk
+        fds.extend(received)
+    return data
+
+
+def _serve(sock: socket.socket):  # pragma: nocover
+    """Main loop of the helper: start the processes asked for, and report
+    when they end, until tentakel goes away."""
+
+    # Ctrl-C is for tentakel, which cancels the processes itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    processes: dict[int, subprocess.Popen] = {}
+    buffer = b""
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_READ)
+        selector.register(wakeup_r, selectors.EVENT_READ)
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is not sock:
+                    os.read(wakeup_r, 4096)
+                    continue
+                data = sock.recv(65536)
+                if not data:
+                    return
+                buffer += data
+                while len(buffer) >= _HEADER.size:
+                    size = _HEADER.unpack_from(buffer)[0]
+                    if len(buffer) < _HEADER.size + size:
+                        break
+                    start, end = _HEADER.size, _HEADER.size + size
+                    n, cmd, env = pickle.loads(buffer[start:end])
+                    buffer = buffer[end:]
+                    try:
+                        process = subprocess.Popen(
+                            cmd,
+                            shell=True,
+                            stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            start_new_session=True,
+                            env=env,
+                        )
+                    except OSError as exc:
+                        _send(sock, ("error", n, exc.errno, exc.strerror))
+                        continue
+                    # a pipe, as asked
+                    assert process.stdout is not None
+                    _send(sock, ("started", n, process.pid), [process.stdout.fileno()])
+                    process.stdout.close()
+                    processes[n] = process
+            for n, process in list(processes.items()):
+                if process.poll() is not None:
+                    _send(sock, ("exited", n, process.returncode))
+                    del processes[n]
+
+
+_helper: SpawnHelper | None = None
+
+
+def _forget():
+    """Forked processes can't share the helper, they start their
+    processes themselves."""
+
+    global _helper
+    _helper = None
+
+
+os.register_at_fork(after_in_child=_forget)
+
+
+def start():
+    """Start the helper, if it is not running yet. Best called before
+    tentakel starts any thread or loads its configuration."""
+
+    global _helper
+    if _helper is None:
+        _helper = SpawnHelper()
+
+
+def stop():
+    """Stop the helper, if it is running."""
+
+    global _helper
+    if _helper is not None:
+        _helper.close()
+        _helper = None
+
+
+def running() -> bool:
+    return _helper is not None and _helper.alive
+
+
+def spawn(cmd: str, env: dict[str, str] | None = None) -> SpawnedProcess:
+    """Start shell command cmd with the helper, see SpawnHelper.spawn."""
+
+    if _helper is None:
+        raise OSError("spawn helper is not running")
+    return _helper.spawn(cmd, env)
@@ -0,0 +1,84 @@
+# Copyright (c) 2002, 2003, 2004, 2005 Sebastian Stark
+# Copyright (c) 2011, 2019-2021 Stefane Fermigier
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR SEBASTIAN STARK
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import os
+
+from tentakel import cache
+from tentakel.config import PARAMS, ConfigBase
+
+CONFIG = """
+set method="ssh"
+group default () @all
+group all (user="root") +a +b @sub
+group sub () +c
+"""
+
+
+def test_config_cache(tmp_path, monkeypatch):
+    path = tmp_path / "tentakel.conf"
+    path.write_text(CONFIG)
+    cache_dir = tmp_path / "cache"
+
+    c1 = cache.load_config(path, cache_dir)
+    assert [h for h, _ in c1.get_group_members("default")] == ["a", "b", "c"]
+    assert len(list(cache_dir.iterdir())) == 1
+
+    # a fresh cache is used without parsing the file again
+    def fail(self, txt):
+        raise AssertionError("configuration parsed again")
+
+    monkeypatch.setattr(ConfigBase, "parse", fail)
+    c2 = cache.load_config(path, cache_dir)
+    assert c1 == c2
+    assert [h for h, _ in c2.get_group_members("default")] == ["a", "b", "c"]
+    assert c2.get_group_params("all")["user"] == "root"
+    monkeypatch.undo()
+
+    # a stale cache is rebuilt
+    path.write_text(CONFIG + "group other () +d\n")
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    c3 = cache.load_config(path, cache_dir)
+    assert "other" in c3.get_groups()
+    assert "other" in cache.load_config(path, cache_dir).expansion.members
+
+    # so is a cache compiled with other defaults, e.g. by another user
+    monkeypatch.setitem(PARAMS, "user", "someone-else")
+    c4 = cache.load_config(path, cache_dir)
+    assert c4["settings"]["user"] == "someone-else"
+    assert c4.get_group_params("sub")["user"] == "someone-else"
+
+
+def test_ttl_cache(tmp_path, monkeypatch):
+    store = cache.ttl_cache("test", tmp_path)
+    store.put("a", "192.0.2.1", ttl=60)
+    store.put("b", "192.0.2.2", ttl=-1)
+    assert store.get("a") == "192.0.2.1"
+    assert store.get("b") is None
+    store.save()
+
+    store = cache.ttl_cache("test", tmp_path)
+    assert len(store) == 1
+    assert store.get("a") == "192.0.2.1"
+    monkeypatch.setattr(cache.time, "time", lambda: 2**40)
+    assert store.get("a") is None
@@ -0,0 +1,171 @@
+# Copyright (c) 2002, 2003, 2004, 2005 Sebastian Stark
+# Copyright (c) 2011, 2019-2021 Stefane Fermigier
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR SEBASTIAN STARK
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import os
+import re
+import subprocess
+import sys
+import time
+
+from tentakel import cache, cluster
+from tentakel.config import ConfigBase
+from tentakel.remote import RemoteCollator
+
+# prints the pid of the worker running it
+COMMAND = "echo $TENTAKEL_HOST $PPID"
+
+
+def cluster_conf(n, maxparallel=0):
+    conf = ConfigBase()
+    members = " ".join(f"+h{i}" for i in range(n))
+    conf.parse(f'set method="local"\ngroup g (maxparallel="{maxparallel}") {members}\n')
+    return conf
+
+
+def start_worker(address, env=None):
+    return subprocess.Popen([sys.executable, "-m", "tentakel.main", "--worker", address], env=env)
+
+
+def wait_workers(coordinator, n):
+    deadline = time.monotonic() + 10
+    while len(coordinator.idle) < n:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def run(collator, command=COMMAND):
+    collator.exec_all(command)
+    results = {r.destination: r for r in collator.collect()}
+    collator.join_all()
+    return results
+
+
+def test_parse_address():
+    assert cluster.parse_address("ctl1:7000")[1] == ("ctl1", 7000)
+    assert cluster.parse_address("[::1]:7000")[1] == ("::1", 7000)
+    assert cluster.parse_address("/run/tentakel.sock")[1] == "/run/tentakel.sock"
+
+
+def test_cluster(tmp_path):
+    address = str(tmp_path / "coordinator.sock")
+    coordinator = cluster.Coordinator(address, batch=4)
+    workers = [start_worker(address) for _ in range(3)]
+    try:
+        wait_workers(coordinator, 3)
+        collator = RemoteCollator(cluster_conf(40), "g")
+        collator.coordinator = coordinator
+        results = run(collator)
+        assert sorted(results) == sorted(f"h{i}" for i in range(40))
+        assert all(r.status == 0 and r.output.startswith(d + " ") for d, r in results.items())
+        # in batches, by all the workers
+        pids = {r.output.split()[1] for r in results.values()}
+        assert pids == {str(w.pid) for w in workers}
+        assert collator.metrics.started == 40
+
+        # again, with the same workers
+        assert len(run(collator)) == 40
+
+        # the first result cancels the command on the workers
+        collator.first = 1
+        start = time.monotonic()
+        collator.exec_all("test $TENTAKEL_HOST = h0 || sleep 10")
+        assert [r.destination for r in collator.collect()] == ["h0"]
+        collator.join_all()
+        assert time.monotonic() - start < 5
+        assert collator.cancelled == 39
+    finally:
+        coordinator.close()
+        for worker in workers:
+            worker.wait(10)
+
+
+def test_where(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "__user_cache_dir", str(tmp_path))
+    address = str(tmp_path / "coordinator.sock")
+    coordinator = cluster.Coordinator(address, batch=2)
+    # where the workers would find other facts
+    env = dict(os.environ, HOME=str(tmp_path), LOAD="5")
+    workers = [start_worker(address, env) for _ in range(2)]
+    try:
+        wait_workers(coordinator, 2)
+        collator = RemoteCollator(cluster_conf(6), "g")
+        collator.coordinator = coordinator
+        # checked by the coordinator only, the workers run what they get
+        collator.facts_command = 'test $TENTAKEL_HOST = h1 && echo load=5 || echo "load=${LOAD:-1}"'
+        collator.where = "load < 2"
+        assert sorted(run(collator)) == ["h0", "h2", "h3", "h4", "h5"]
+    finally:
+        coordinator.close()
+        for worker in workers:
+            worker.wait(10)
+
+
+def test_steal(tmp_path):
+    address = str(tmp_path / "coordinator.sock")
+    coordinator = cluster.Coordinator(address, batch=20)
+    workers = [start_worker(address)]
+    try:
+        wait_workers(coordinator, 1)
+        collator = RemoteCollator(cluster_conf(20, maxparallel=2), "g")
+        collator.coordinator = coordinator
+        # the first worker gets all the hosts
+        collator.exec_all(f"sleep 0.2; {COMMAND}")
+        workers.append(start_worker(address))
+        results = {r.destination: r for r in collator.collect()}
+        collator.join_all()
+        assert len(results) == 20
+        assert all(r.status == 0 for r in results.values())
+        # the second one took half of those it had not started yet
+        assert {r.output.split()[1] for r in results.values()} == {str(w.pid) for w in workers}
+        steals = [decision for _, decision in collator.metrics.decisions if "stole" in decision]
+        assert len(steals) >= 1
+        # up to half of the 20, depending on how many the first one started
+        assert 0 < int(re.search(r"stole (\d+) hosts", steals[0]).group(1)) <= 10
+    finally:
+        coordinator.close()
+        for worker in workers:
+            worker.wait(10)
+
+
+def test_worker_gone(tmp_path):
+    address = str(tmp_path / "coordinator.sock")
+    coordinator = cluster.Coordinator(address, batch=5)
+    workers = [start_worker(address) for _ in range(2)]
+    try:
+        wait_workers(coordinator, 2)
+        collator = RemoteCollator(cluster_conf(20, maxparallel=2), "g")
+        collator.coordinator = coordinator
+        collator.exec_all(f"sleep 0.2; {COMMAND}")
+        time.sleep(0.1)
+        workers[0].kill()
+        results = {r.destination: r for r in collator.collect()}
+        collator.join_all()
+        # its hosts were handed out again
+        assert len(results) == 20
+        assert all(r.status == 0 for r in results.values())
+        assert {r.output.split()[1] for r in results.values()} == {str(workers[1].pid)}
+        assert any("went away" in decision for _, decision in collator.metrics.decisions)
+    finally:
+        coordinator.close()
+        for worker in workers:
+            worker.wait(10)
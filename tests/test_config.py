@@ -26,7 +26,10 @@ import os
 import pwd
 import tempfile
 
+import pytest
+
 from tentakel.config import ConfigBase
+from tentakel.hostset import HostRange, Selection
 
 
 def test_config_from_doc():
@@ -73,3 +76,127 @@ def test_whitespace_format():
     ]
     c4 = ConfigBase()
     c4.parse("".join(wsconfig))
+
+
+def test_group_expansion():
+    c = ConfigBase()
+    c.parse(
+        'group all () +a @web @db\n'
+        'group web (user="www") +w1 +shared\n'
+        'group db () +d1 +shared\n'
+        'group last (duplicates="last") @web @db\n'
+    )
+    members = c.get_group_members("all")
+    assert [h for h, _ in members] == ["a", "w1", "shared", "d1"]
+    assert dict(members)["shared"]["user"] == "www"
+    last = dict(c.get_group_members("last"))
+    assert sorted(last) == ["d1", "shared", "w1"]
+    assert last["shared"]["user"] != "www"
+
+
+def test_group_loop():
+    c = ConfigBase()
+    c.parse("group a () @b\ngroup b () +x @c\ngroup c () @b\ngroup d () +y\n")
+    assert [tuple(h) for h in c.get_group_members("d")] == [("y", c.get_group_params("d"))]
+    with pytest.raises(SystemExit) as excinfo:
+        c.get_group_members("a")
+    assert "b -> c -> b" in str(excinfo.value)
+
+
+def test_host_overrides():
+    c = ConfigBase()
+    c.parse('group g (user="www") +a +b(user="root", format="%o") +c\n')
+    members = dict(c.get_group_members("g"))
+    assert members["a"] is members["c"]
+    assert members["a"]["user"] == "www"
+    assert members["b"]["user"] == "root"
+    assert members["b"]["method"] == members["a"]["method"]
+    with pytest.raises(TypeError):
+        members["a"]["user"] = "root"
+
+    c2 = ConfigBase()
+    c2.parse(str(c))
+    assert c2 == c
+
+
+def test_group_set_operations():
+    c = ConfigBase()
+    c.parse(
+        "group web () +w1 +w2 +canary1 +w3\n"
+        "group canary () +canary1 +canary2\n"
+        "group eu () +w1 +w3 +canary1 +e1\n"
+        "group euweb () @web -@canary &@eu -w3\n"
+    )
+    assert [h for h, _ in c.get_group_members("euweb")] == ["w1"]
+    assert [h for h, _ in c.get_group_members("web - canary & eu")] == ["w1", "w3"]
+    assert [h for h, _ in c.get_group_members("canary | eu - web")] == ["canary1", "canary2", "e1"]
+    assert [h for h, _ in c.get_group_members("(web | eu) - canary")] == ["w1", "w2", "w3", "e1"]
+
+    c2 = ConfigBase()
+    c2.parse(str(c))
+    assert c2 == c
+
+
+def test_host_ranges():
+    c = ConfigBase()
+    c.parse(
+        "group all () +node[0001-4096] +rack[1-8]-n[01-48] @canary\n"
+        'group canary (user="admin") +node0001 +extra\n'
+        "group some () @all -node[0003-4096] -@canary\n"
+    )
+    members = c.get_members("all")
+    assert len(members) == 4096 + 384 + 1
+    assert "node4096" in members and "rack3-n07" in members and "node4097" not in members
+    assert members.names(0, 3) == ["node0001", "node0002", "node0003"]
+    assert [h.name for h in c.get_members("some")] == ["node0002"] + list(HostRange("rack[1-8]-n[01-48]"))
+    assert dict(c.get_group_members("all"))["node0001"]["user"] != "admin"
+
+    c2 = ConfigBase()
+    c2.parse(str(c))
+    assert c2 == c
+
+
+def test_listed_order():
+    c = ConfigBase()
+    c.parse("group g () +zeta +b +a +n[1-2]\ngroup h () +a +zeta\ngroup k () @h @g\n")
+    # the order of the group, not that of the host table
+    assert [h.name for h in c.get_members("g")] == ["zeta", "b", "a", "n1", "n2"]
+    assert c.get_members("g").names(1, 3) == ["b", "a", "n1"]
+    assert [h.name for h in c.get_members("k")] == ["a", "zeta", "b", "n1", "n2"]
+    assert c.get_members("k").names(2) == ["b", "n1", "n2"]
+
+
+def test_host_labels():
+    c = ConfigBase()
+    c.parse(
+        "group web () +web[1-4]{role=web,dc=fra} +web9{role=web}\n"
+        "group db () +db1{role=db,dc=fra} +db2 +web9{dc=ams}\n"
+        "group all () @web @db\n"
+    )
+    assert c.get_members("all", Selection("dc=fra")).names() == ["web1", "web2", "web3", "web4", "db1"]
+    assert c.get_members("db", Selection("role=web,dc=ams")).names() == ["web9"]
+    assert c.get_members(None, Selection("role=web")).names() == ["web1", "web2", "web3", "web4", "web9"]
+    assert c.get_members(None, Selection("role=mail")).names() == []
+
+    c2 = ConfigBase()
+    c2.parse(str(c))
+    assert c2 == c
+
+
+def test_conditional_hosts():
+    c = ConfigBase()
+    c.parse(
+        'group g () +a (load<2)+b{role=x}(user="u") (load < 2 and (up > 3 or x = 1))+c[1-2]\n'
+        "group h () @g +z\n"
+        "group i () @g +b\n"
+    )
+    condition = "load < 2 and (up > 3 or x = 1)"
+    assert c.get_members("g").conditions() == {"b": "load<2", "c1": condition, "c2": condition}
+    assert c.get_members("h").conditions()["b"] == "load<2"
+    assert "b" not in c.get_members("i").conditions()
+    assert c.get_group_params("g")["user"] != "u"
+    assert dict(c.get_group_members("g"))["b"]["user"] == "u"
+
+    c2 = ConfigBase()
+    c2.parse(str(c))
+    assert c2 == c
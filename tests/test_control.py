@@ -0,0 +1,298 @@
+# Copyright (c) 2002, 2003, 2004, 2005 Sebastian Stark
+# Copyright (c) 2011, 2019-2021 Stefane Fermigier
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR SEBASTIAN STARK
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import errno
+import os
+import resource
+import signal
+import subprocess
+import threading
+import time
+
+from tentakel import cache, control, remote
+from tentakel.config import ConfigBase
+from tentakel.control import (
+    AdaptiveLimit,
+    ConcurrencyLimit,
+    History,
+    RunMetrics,
+    SpawnRate,
+    predict,
+)
+from tentakel.remote import RemoteCollator, Result
+
+from .test_remote import EchoRemoteCommand, make_conf
+
+
+def run(limit, duration, status=0, transport_error=False):
+    assert limit.acquire(threading.Event())
+    limit.release(Result("h", status, "", duration), transport_error)
+
+
+def test_concurrency_limit():
+    metrics = RunMetrics(3)
+    limit = ConcurrencyLimit(1, metrics)
+    stop = threading.Event()
+    assert limit.acquire(stop)
+
+    waiting = threading.Thread(target=lambda: limit.acquire(stop))
+    waiting.start()
+    waiting.join(0.1)
+    assert waiting.is_alive()
+    stop.set()
+    limit.wake()
+    waiting.join(1)
+    assert not waiting.is_alive()
+    assert not limit.acquire(stop)
+    assert metrics.started == 1
+
+
+def test_adaptive_limit():
+    metrics = RunMetrics()
+    limit = AdaptiveLimit(2, 20, metrics)
+    # slow start: doubles for every limit commands that end well
+    for _ in range(2 + 4):
+        run(limit, 0.1)
+    assert limit.limit == 8
+
+    # halved once for the commands started at the old limit
+    run(limit, 0.1, -1, transport_error=True)
+    run(limit, 0.1, -1, transport_error=True)
+    assert limit.limit == 4
+
+    # then grows by one per window only
+    for _ in range(5):
+        run(limit, 0.1)
+    assert limit.limit == 5
+    run(limit, 0.5)
+    assert limit.limit == 2
+    for _ in range(100):
+        run(limit, 0.1)
+    assert limit.limit <= 20
+    assert metrics.transport_errors == 2
+    assert metrics.failed == 2
+    assert any("transport error, down to 4" in d for _, d in metrics.decisions)
+    assert any("took 0.50s, down to 2" in d for _, d in metrics.decisions)
+
+
+def test_adaptive_limit_mixed():
+    metrics = RunMetrics()
+    limit = AdaptiveLimit(1, 64, metrics)
+    # hosts that are slower than others, but not overloaded
+    for _ in range(40):
+        run(limit, 0.1)
+        run(limit, 0.25)
+    assert limit.limit == 64
+    assert not any("took" in d for _, d in metrics.decisions)
+
+
+def test_adaptive_collator():
+    hosts = " ".join(f"+h{i}" for i in range(20))
+    conf = make_conf('group g (adaptive="yes", minparallel="2", maxparallel="4") ' + hosts)
+    collator = RemoteCollator(conf, "g")
+    collator.exec_all("fail")
+    results = list(collator.collect())
+    collator.join_all()
+    assert len(results) == 20
+    assert collator.limit.limit == 2
+    assert collator.metrics.transport_errors == 20
+    assert collator.metrics.most_running <= 4
+    assert "hosts: 20, started: 20, succeeded: 0, failed: 20 (20 transport errors)" in collator.metrics.summary()
+
+
+def test_spawn_rate():
+    conf = make_conf('group g (spawnrate="20", maxparallel="0") ' + " ".join(f"+h{i}" for i in range(6)))
+    collator = RemoteCollator(conf, "g")
+    start = time.monotonic()
+    collator.exec_all("uptime")
+    assert len(list(collator.collect())) == 6
+    collator.join_all()
+    # the first one starts right away, the others one every 50ms
+    assert time.monotonic() - start >= 0.24
+    assert collator.metrics.throttled == 5
+
+    spawn = SpawnRate(0, 1, 60, RunMetrics())
+    stop = threading.Event()
+    stop.set()
+    assert not spawn.stagger(stop)
+
+
+def test_predict():
+    assert predict([3, 1, 1, 1], 2) == 3
+    assert predict([1, 1, 1, 3], 2) == 4
+    assert predict([1, 1, 1, 1]) == 1
+    assert predict([1, 1, 1, 1], 0, rate=2) == 2.5
+
+
+def test_history(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "__user_cache_dir", str(tmp_path))
+    conf = ConfigBase()
+    conf.parse(
+        'set method="local"\ngroup g (maxparallel="1", history="yes") '
+        + " ".join(f"+h{i}" for i in range(4))
+    )
+    collator = RemoteCollator(conf, "g")
+    command = "test $TENTAKEL_HOST = h2 && sleep 0.3; true"
+    assert collator.plan(command) == [f"no history of '{command}' on these 4 hosts"]
+
+    collator.exec_all(command)
+    assert [r.destination for r in collator.collect()] == ["h0", "h1", "h2", "h3"]
+    collator.join_all()
+
+    # the slowest host goes first next time
+    collator.exec_all(command)
+    destinations = [r.destination for r in collator.collect()]
+    assert destinations[0] == "h2"
+    collator.join_all()
+
+    plan = collator.plan(command)
+    assert plan[0] == "4 hosts, 4 with history, at most 1 in parallel"
+    assert plan[2].startswith("  h2: 0.3")
+
+    history = History(cache.ttl_cache("history"), command, 60)
+    assert history.expected("h2") >= 0.3
+    assert History(cache.ttl_cache("history"), "uptime", 60).expected("h2") is None
+
+
+def test_topology():
+    conf = make_conf(
+        'group g (maxparallel="1", topology="dc") +a1{dc=a} +a2{dc=a} +a3{dc=a} +b1{dc=b} +b2{dc=b} +c1\n'
+        'group racks (topology="group", domainparallel="1") @r1 @r2\n'
+        "group r1 () +x1 +x2 +x3\n"
+        "group r2 () +y1\n"
+    )
+    collator = RemoteCollator(conf, "g")
+    assert collator.domains["c1"] == "no dc"
+    collator.exec_all("uptime")
+    assert [r.destination for r in collator.collect()] == ["a1", "b1", "c1", "a2", "b2", "a3"]
+    collator.join_all()
+
+    collator = RemoteCollator(conf, "racks")
+    EchoRemoteCommand.most_running = 0
+    collator.exec_all("uptime")
+    assert sorted([r.destination for r in collator.collect()][:2]) == ["x1", "y1"]
+    collator.join_all()
+    # only x1 and y1 ran at the same time
+    assert EchoRemoteCommand.most_running <= 2
+    assert collator.metrics.domain_waits >= 1
+
+
+def test_governor(monkeypatch):
+    limits = {resource.RLIMIT_NOFILE: (256, 1024), resource.RLIMIT_NPROC: (resource.RLIM_INFINITY,) * 2}
+    monkeypatch.setattr(control.resource, "getrlimit", lambda limit: limits[limit])
+    monkeypatch.setattr(control.resource, "setrlimit", lambda limit, value: limits.__setitem__(limit, value))
+    monkeypatch.setattr(control, "_open_fds", lambda: 16)
+    monkeypatch.setattr(control, "_available_memory", lambda: 1 << 40)
+    monkeypatch.setattr(control.os, "cpu_count", lambda: 64)
+
+    metrics = RunMetrics()
+    assert control.govern(10, metrics) == 10
+    assert limits[resource.RLIMIT_NOFILE] == (256, 1024)
+    assert control.govern(1000, metrics) == (1024 - 64 - 16) // 4
+    assert limits[resource.RLIMIT_NOFILE] == (1024, 1024)
+    assert [d for _, d in metrics.decisions] == [
+        "governor: raised the soft RLIMIT_NOFILE from 256 to 1024",
+        "governor: at most 236 hosts at once instead of 1000, because of RLIMIT_NOFILE",
+    ]
+
+    # work is queued instead of failing
+    conf = make_conf("group g () " + " ".join(f"+h{i}" for i in range(300)))
+    collator = RemoteCollator(conf, "g")
+    EchoRemoteCommand.most_running = 0
+    collator.exec_all("uptime")
+    assert len(list(collator.collect())) == 300
+    collator.join_all()
+    assert EchoRemoteCommand.most_running <= 236
+
+
+def test_spawn_retry(monkeypatch):
+    popen = subprocess.Popen
+    errors = [OSError(errno.EMFILE, "Too many open files")] * 2
+
+    def flaky_popen(*args, **kwargs):
+        if errors:
+            raise errors.pop()
+        return popen(*args, **kwargs)
+
+    monkeypatch.setattr(remote.subprocess, "Popen", flaky_popen)
+    monkeypatch.setattr(remote, "SPAWN_BACKOFF", 0.01)
+    conf = ConfigBase()
+    conf.parse('set method="local"\ngroup g () +h1')
+    collator = RemoteCollator(conf, "g")
+    collator.exec_all("echo $TENTAKEL_HOST")
+    [result] = collator.collect()
+    collator.join_all()
+    assert (result.status, result.output) == (0, "h1")
+
+
+def test_procs(capsys):
+    conf = ConfigBase()
+    conf.parse(
+        'set method="local"\ngroup g (maxparallel="8", format="%d %s %o\\n") '
+        + " ".join(f"+h{i}" for i in range(40))
+    )
+    collator = RemoteCollator(conf, "g")
+    collator.procs = 3
+    collator.exec_all("echo $TENTAKEL_HOST $PPID")
+    results = list(collator.collect())
+    collator.join_all()
+    assert sorted(r.destination for r in results) == sorted(f"h{i}" for i in range(40))
+    assert all(r.output.startswith(r.destination + " ") for r in results)
+    # run by the worker processes, not by this one
+    parents = {r.output.split()[1] for r in results}
+    assert len(parents) == 3
+    assert str(os.getpid()) not in parents
+    assert collator.metrics.started == 40
+    assert collator.metrics.succeeded == 40
+
+    # the first hosts to succeed cancel the others, in all processes
+    collator.first = 2
+    start = time.monotonic()
+    collator.exec_all("test $TENTAKEL_HOST = h0 -o $TENTAKEL_HOST = h1 || sleep 10")
+    collator.display_all()
+    collator.join_all()
+    assert time.monotonic() - start < 5
+    assert sorted(capsys.readouterr().out.splitlines()) == ["h0 0 ", "h1 0 "]
+    assert collator.stop_reason == "2 hosts succeeded"
+
+
+def test_procs_interrupt(capfd):
+    conf = ConfigBase()
+    conf.parse('set method="local"\ngroup g (kill_timeout="0.3") ' + " ".join(f"+h{i}" for i in range(4)))
+    collator = RemoteCollator(conf, "g")
+    collator.procs = 2
+
+    def interrupt():
+        # Ctrl-C reaches the worker processes too
+        for process, _ in collator._shards:
+            os.kill(process.pid, signal.SIGINT)
+        os.kill(os.getpid(), signal.SIGINT)
+
+    threading.Timer(0.5, interrupt).start()
+    collator.exec_all("sleep 30")
+    collator.display_all()
+    collator.join_all()
+    err = capfd.readouterr().err
+    assert "interrupted: 0 succeeded, 0 failed, cancelled on 4 hosts" in err
+    assert "KeyboardInterrupt" not in err
+    assert subprocess.run(["pgrep", "-f", "sleep 30"], capture_output=True, check=False).stdout == b""
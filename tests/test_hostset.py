@@ -0,0 +1,128 @@
+# Copyright (c) 2002, 2003, 2004, 2005 Sebastian Stark
+# Copyright (c) 2011, 2019-2021 Stefane Fermigier
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR SEBASTIAN STARK
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import pytest
+
+from tentakel.hostset import HostRange, HostTable, Sample, Selection, count
+
+
+def test_host_range():
+    r = HostRange("rack[1-8]-n[01-48]")
+    assert len(r) == 384
+    assert (r[0], r[47], r[48], r[-1]) == ("rack1-n01", "rack1-n48", "rack2-n01", "rack8-n48")
+    assert r.index("rack2-n05") == 52
+    assert "rack8-n48" in r
+    assert "rack9-n01" not in r
+    assert "rack1-n1" not in r
+    assert list(HostRange("x[1,3,9-10]")) == ["x1", "x3", "x9", "x10"]
+    for pattern in ["x[2-1]", "x[a]", "x[1", "x"]:
+        with pytest.raises(ValueError):
+            HostRange(pattern)
+
+
+def test_host_table_ranges():
+    table = HostTable()
+    nodes = table.intern_range(HostRange("node[0001-4096]"))
+    assert len(table.items) == 1
+    assert count(nodes) == 4096
+    assert table.bits(["node0005"]) == 1 << 4
+    assert table.names(nodes, 4094) == ["node4095", "node4096"]
+
+    # overlapping ranges are added host by host
+    more = table.bits([HostRange("node[4095-4097]")])
+    assert table.names(more) == ["node4095", "node4096", "node4097"]
+    assert count(nodes | more) == 4097
+
+
+def test_host_table_overlaps():
+    table = HostTable()
+    table.bits(["web12", "db1"] + [f"app{i}" for i in range(1000)])
+    # by a name
+    table.intern_range(HostRange("web1[0-5]"))
+    # by a range with a shorter or a longer prefix
+    table.intern_range(HostRange("web[20-30]"))
+    table.intern_range(HostRange("web2[5-9]"))
+    table.intern_range(HostRange("web[30-31]"))
+    # none
+    table.intern_range(HostRange("w[1-3]"))
+    table.intern_range(HostRange("db[2-3]"))
+    blocks = [item.pattern for item in table.items if isinstance(item, HostRange)]
+    assert blocks == ["web[20-30]", "w[1-3]", "db[2-3]"]
+    assert count(table.lookup([HostRange("web[10-31]")])) == 18
+
+
+def test_host_table_labels():
+    table = HostTable()
+    web = table.bits([HostRange("web[1-4]")])
+    table.add_labels(web, {"role": "web", "dc": "fra"})
+    table.add_labels(table.bits(["web2", "db1"]), {"dc": "ams"})
+    assert table.names(table.select({"role": "web"})) == ["web1", "web2", "web3", "web4"]
+    assert table.names(table.select({"role": "web", "dc": "ams"})) == ["web2"]
+    assert table.select({"role": "db"}) == 0
+    assert table.select({}) == web | table.bits(["db1"])
+    assert str(Selection(" role=web, dc=fra")) == "role=web,dc=fra"
+    with pytest.raises(SystemExit):
+        Selection("role")
+
+
+def test_selection_patterns():
+    table = HostTable()
+    nodes = table.bits([HostRange("node[01-20]"), "db1", "db2"])
+    listed = Selection(hosts="db2,node[01-02,07]").bits(table, nodes)
+    assert table.names(listed) == ["node01", "node02", "node07", "db2"]
+    assert count(Selection(exclude="node1*,db?").bits(table, nodes)) == 10
+    assert table.names(Selection(match=r"[02]$").bits(table, nodes)) == ["node02", "node10", "node12", "node20", "db2"]
+    selection = Selection(labels="role=web", exclude="db*").replace(labels="", match="2")
+    assert str(selection) == "-x db* --match 2"
+    assert table.names(selection.bits(table, nodes)) == ["node02", "node12", "node20"]
+    with pytest.raises(SystemExit):
+        Selection(match="(")
+
+
+def test_sample():
+    table = HostTable()
+    web = table.bits([HostRange("web[1-80]")])
+    db = table.bits([HostRange("db[1-20]")])
+    table.add_labels(web, {"role": "web"})
+    segments = [(web, "web"), (db, "db")]
+
+    bits, summary = Sample("10", seed=1).pick(table, segments)
+    assert count(bits) == 10
+    assert summary == ["sampled 10 of 100 hosts (seed 1)"]
+    assert Sample("10", seed=1).pick(table, segments)[0] == bits
+    assert Sample("10", seed=2).pick(table, segments)[0] != bits
+
+    bits, summary = Sample("10%", "role", seed=1).pick(table, segments)
+    assert (count(bits & web), count(bits & db)) == (8, 2)
+    assert summary[1:] == ["  role=web: 8 of 80", "  no role: 2 of 20"]
+
+    # every stratum gets a host, when possible
+    bits, _ = Sample("2", "group", seed=1).pick(table, [(web, "web"), (table.bits(["x"]), "x")])
+    assert table.bits(["x"]) & bits
+    # even when the large strata have to give hosts back for it
+    a, b, c = table.bits([HostRange("a[1-28]")]), table.bits(["b"]), table.bits(["c"])
+    bits, summary = Sample("3", "group", seed=1).pick(table, [(a, "a"), (b, "b"), (c, "c")])
+    assert summary[1:] == ["  a: 1 of 28", "  b: 1 of 1", "  c: 1 of 1"]
+    for size in ["0", "-1", "0%", "101%", "many"]:
+        with pytest.raises(SystemExit):
+            Sample(size)
@@ -0,0 +1,104 @@
+# Copyright (c) 2002, 2003, 2004, 2005 Sebastian Stark
+# Copyright (c) 2011, 2019-2021 Stefane Fermigier
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR SEBASTIAN STARK
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import io
+import sys
+import time
+
+from tentakel import relay
+from tentakel.config import ConfigBase
+from tentakel.remote import RemoteCollator
+
+AGENT = f"{sys.executable} -m tentakel.relay"
+
+
+def relay_conf(agent=AGENT):
+    conf = ConfigBase()
+    conf.parse(
+        'set method="local"\n'
+        f'group dc1 (relay="r1", relay_command="{agent}", maxparallel="2") +a1 +a2 +a3\n'
+        f'group dc2 (relay="r2", relay_command="{agent}") +b1 +b2\n'
+        "group all () @dc1 @dc2 +c1\n"
+    )
+    return conf
+
+
+def test_frames():
+    stream = io.BytesIO()
+    relay.write_frame(stream, ["result", "h1", 0, "out\nput", 0.5])
+    relay.write_frame(stream, "cancel")
+    stream.seek(0)
+    assert relay.read_frame(stream) == ["result", "h1", 0, "out\nput", 0.5]
+    assert relay.read_frame(stream) == "cancel"
+    assert relay.read_frame(stream) is None
+
+
+def test_relay():
+    collator = RemoteCollator(relay_conf(), "all")
+    # the relays run the command, with a process of their own
+    collator.exec_all("echo $TENTAKEL_HOST; ps -o pid= -p $PPID >/dev/null && echo $PPID")
+    results = {r.destination: r for r in collator.collect()}
+    collator.join_all()
+    assert sorted(results) == ["a1", "a2", "a3", "b1", "b2", "c1"]
+    assert all(r.status == 0 and r.output.startswith(d + "\n") for d, r in results.items())
+    assert collator.metrics.started == 6
+
+    # with the limits of the group being run
+    dc1 = RemoteCollator(relay_conf(), "dc1")
+    dc1.exec_all("sleep 0.1")
+    assert len(list(dc1.collect())) == 3
+    dc1.join_all()
+    assert dc1.metrics.most_running == 2
+
+    # the first result cancels the command on the relays too
+    collator.first = 1
+    start = time.monotonic()
+    collator.exec_all("test $TENTAKEL_HOST = c1 || sleep 10")
+    assert [r.destination for r in collator.collect()] == ["c1"]
+    collator.join_all()
+    assert time.monotonic() - start < 5
+    assert collator.cancelled == 5
+
+
+def test_relay_conditions(tmp_path, monkeypatch):
+    # the facts of the agents are cached there
+    monkeypatch.setenv("HOME", str(tmp_path))
+    conf = ConfigBase()
+    conf.parse(
+        'set method="local"\n'
+        'set facts_command="test $TENTAKEL_HOST = a2 && echo load=5 || echo load=1"\n'
+        f'group dc1 (relay="r1", relay_command="{AGENT}") +a1 (load<2)+a2 (load<2)+a3\n'
+    )
+    collator = RemoteCollator(conf, "dc1")
+    collator.exec_all("echo $TENTAKEL_HOST")
+    # the relay leaves a2 out
+    assert sorted(r.destination for r in collator.collect()) == ["a1", "a3"]
+    collator.join_all()
+
+
+def test_relay_gone():
+    collator = RemoteCollator(relay_conf(agent="exit 1"), "dc2")
+    collator.exec_all("uptime")
+    results = list(collator.collect())
+    collator.join_all()
+    assert [(r.status, r.output) for r in results] == [(-1, "tentakel: relay r2 went away")] * 2
@@ -0,0 +1,338 @@
+# Copyright (c) 2002, 2003, 2004, 2005 Sebastian Stark
+# Copyright (c) 2011, 2019-2021 Stefane Fermigier
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR SEBASTIAN STARK
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+from typing import ClassVar
+
+from tentakel import cache, preflight
+from tentakel.config import ConfigBase
+from tentakel.remote import (
+    RemoteCollator,
+    RemoteCommand,
+    register_remote_command_plugin,
+)
+
+
+class EchoRemoteCommand(RemoteCommand):
+    """Runs nothing, answers with the host name and the command."""
+
+    lock = threading.Lock()
+    running = 0
+    most_running = 0
+    closed: ClassVar[list[str]] = []
+    facts: ClassVar[dict[str, str]] = {}
+
+    def close(self):
+        self.closed.append(self.destination)
+
+    def _rexec(self, command):
+        cls = self.__class__
+        with cls.lock:
+            cls.running += 1
+            cls.most_running = max(cls.most_running, cls.running)
+        time.sleep(0.01)
+        with cls.lock:
+            cls.running -= 1
+        if command == "fail":
+            raise OSError("broken transport")
+        if command == "facts":
+            return (0, self.facts.get(self.destination, ""))
+        return (0, f"{self.destination}: {command}")
+
+
+register_remote_command_plugin("echo", EchoRemoteCommand)
+
+
+def make_conf(text):
+    conf = ConfigBase()
+    conf.parse('set method="echo"\n' + text)
+    return conf
+
+
+def test_exec_all():
+    conf = make_conf('group g (maxparallel="2") ' + " ".join(f"+h{i}" for i in range(6)))
+    collator = RemoteCollator(conf, "g")
+    assert collator.get_destinations() == [f"h{i}" for i in range(6)]
+
+    EchoRemoteCommand.most_running = 0
+    collator.exec_all("uptime")
+    results = [collator.next_result(timeout=5) for _ in range(6)]
+    collator.join_all()
+    assert sorted(r.output for r in results) == [f"h{i}: uptime" for i in range(6)]
+    assert {r.status for r in results} == {0}
+    assert EchoRemoteCommand.most_running == 2
+
+
+def test_exec_all_error():
+    collator = RemoteCollator(make_conf("group g () +a"), "g")
+    collator.exec_all("fail")
+    result = collator.next_result(timeout=5)
+    assert (result.destination, result.status) == ("a", -1)
+    assert "broken transport" in result.output
+
+
+def test_use_conf_reconciles():
+    conf = make_conf('group g (user="u1") +a +b +c')
+    collator = RemoteCollator(conf, "g")
+    a, b, _ = collator.remote_objects
+
+    conf = make_conf('group g (user="u1") +a +b(user="u2") +d')
+    EchoRemoteCommand.closed = []
+    collator.use_conf(conf, "g")
+    assert collator.get_destinations() == ["a", "b", "d"]
+    assert collator.remote_objects[0] is a
+    assert collator.remote_objects[1] is b
+    assert b.params["user"] == "u2"
+    assert EchoRemoteCommand.closed == ["c"]
+
+
+def test_resolve(tmp_path, monkeypatch):
+    lookups = []
+
+    def getaddrinfo(name, port, type=0):
+        lookups.append(name)
+        if name == "dead":
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [(socket.AF_INET, type, 6, "", ("192.0.2.1", 0))]
+
+    monkeypatch.setattr(cache, "__user_cache_dir", str(tmp_path))
+    monkeypatch.setattr(preflight.socket, "getaddrinfo", getaddrinfo)
+    conf = make_conf('group g (resolve="yes") +a +dead @other\ngroup other () +b')
+    collator = RemoteCollator(conf, "g")
+    collator.exec_all("uptime")
+    collator.join_all()
+    results = {r.destination: r for r in (collator.next_result(timeout=5) for _ in range(3))}
+    assert results["dead"].status == -1
+    assert "could not resolve host" in results["dead"].output
+    addresses = {obj.destination: obj.address for obj in collator.remote_objects}
+    assert addresses == {"a": "192.0.2.1", "dead": None, "b": None}
+
+    # addresses are cached, failures are not
+    lookups.clear()
+    collator.exec_all("uptime")
+    collator.join_all()
+    assert lookups == ["dead"]
+
+
+def test_probe(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "__user_cache_dir", str(tmp_path))
+    listener = socket.create_server(("127.0.0.1", 0))
+    closed = socket.create_server(("127.0.0.1", 0))
+    port, dead_port = listener.getsockname()[1], closed.getsockname()[1]
+    closed.close()
+
+    conf = make_conf(f'group g (probe="yes", port="{port}") +127.0.0.1 +127.0.0.2(port="{dead_port}") +a(probe="no")')
+    collator = RemoteCollator(conf, "g")
+
+    def run():
+        collator.exec_all("uptime")
+        collator.join_all()
+        return {r.destination: r for r in (collator.next_result(timeout=5) for _ in range(3))}
+
+    try:
+        results = run()
+        assert results["127.0.0.1"].status == 0
+        assert results["a"].status == 0
+        assert results["127.0.0.2"].status == -1
+        assert f"unreachable: port {dead_port}" in results["127.0.0.2"].output
+
+        # dead hosts are remembered, unless asked to check again
+        assert "remembered" in run()["127.0.0.2"].output
+        collator.recheck = True
+        assert "remembered" not in run()["127.0.0.2"].output
+    finally:
+        listener.close()
+
+
+def test_probe_ssh_config(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "__user_cache_dir", str(tmp_path))
+    probed = []
+
+    def connect_all(targets, timeout):
+        probed.extend(targets)
+        return [""] * len(targets)
+
+    monkeypatch.setattr(preflight, "_connect_all", connect_all)
+    conf = ConfigBase()
+    conf.parse('set method="ssh"\ngroup g (probe="yes") +192.0.2.1 +192.0.2.2(port="2222")')
+    collator = RemoteCollator(conf, "g")
+    # the port of the first one may come from ssh_config
+    assert len(collator.check_all(collator.remote_objects)) == 2
+    assert probed == [("192.0.2.2", "192.0.2.2", 2222)]
+
+
+def test_facts(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "__user_cache_dir", str(tmp_path))
+    EchoRemoteCommand.facts = {"a": "load=0.5", "b": "load=1 kernel=6.1", "c": "load=5"}
+    conf = make_conf('set facts_command="facts"\ngroup g () +a (load<2)+b (load < 2)+c +d')
+    collator = RemoteCollator(conf, "g")
+
+    def run():
+        collator.exec_all("uptime")
+        collator.join_all()
+        results = []
+        while collator._pending:
+            results.append(collator.next_result(timeout=5).destination)
+        return sorted(results)
+
+    assert run() == ["a", "b", "d"]
+
+    # facts are cached
+    EchoRemoteCommand.facts = {}
+    collator.where = "load > 0.7 or kernel == '6.1'"
+    assert run() == ["b"]
+
+
+def local_conf(slow: str, hosts: int):
+    """Hosts h0... run by the local method, those in slow take long."""
+
+    conf = ConfigBase()
+    conf.parse('set method="local"\ngroup g () ' + " ".join(f"+h{i}" for i in range(hosts)))
+    command = f'case $TENTAKEL_HOST in {slow}) sleep 30;; esac; echo "$TENTAKEL_HOST"'
+    return conf, command
+
+
+def test_first(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "__user_cache_dir", str(tmp_path))
+    conf, command = local_conf("h0|h3|h4", 5)
+    collator = RemoteCollator(conf, "g")
+    collator.first = 2
+    t = time.time()
+    collator.exec_all(command)
+    results = list(collator.collect())
+    collator.join_all()
+    assert sorted(r.output for r in results) == ["h1", "h2"]
+    assert collator.cancelled == 3
+    assert time.time() - t < 10
+
+    collator.first = 0
+    collator.quorum = True
+    collator.exec_all(command.replace("30", "0.2"))
+    assert len(list(collator.collect())) == 3
+    collator.join_all()
+
+    # the hosts cancelled before can be asked for their facts again
+    collator.quorum = False
+    collator.facts_command = "echo x=1"
+    collator.where = "x == 1"
+    collator.exec_all("true")
+    assert [r.status for r in collator.collect()] == [0] * 5
+    collator.join_all()
+
+
+def test_hedge():
+    conf, command = local_conf("h0", 3)
+    collator = RemoteCollator(conf, "g")
+    collator.first = 1
+    collator.hedge = 0.2
+    collator.exec_all(command)
+    results = list(collator.collect())
+    collator.join_all()
+    assert [r.output for r in results] == ["h1"]
+    assert collator.cancelled == 2
+
+
+def test_fail_fast():
+    conf = ConfigBase()
+    conf.parse('set method="local"\ngroup g (maxparallel="2") ' + " ".join(f"+h{i}" for i in range(10)))
+    collator = RemoteCollator(conf, "g")
+    collator.fail_fast = 2
+    collator.exec_all("sleep 0.1; exit 3")
+    collator.display_all()
+    collator.join_all()
+    assert collator.stop_reason == "2 hosts failed"
+    assert collator.cancelled >= 6
+
+
+def test_interrupt(capsys):
+    conf = ConfigBase()
+    hosts = " ".join(f"+h{i}" for i in range(5))
+    conf.parse('set method="local"\ngroup g (kill_timeout="0.3", format="%d: %o\\n") ' + hosts)
+    collator = RemoteCollator(conf, "g")
+    # the children ignore SIGTERM, they have to be killed
+    command = "case $TENTAKEL_HOST in h0) echo done;; *) trap '' TERM; sleep 30;; esac"
+    threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGINT)).start()
+    t = time.time()
+    collator.exec_all(command)
+    collator.display_all()
+    collator.join_all()
+    assert time.time() - t < 5
+    assert collator.cancelled == 4
+    out, err = capsys.readouterr()
+    assert out == "h0: done\n"
+    assert "interrupted: 1 succeeded, 0 failed, cancelled on 4 hosts" in err
+    assert subprocess.run(["pgrep", "-f", "sleep 30"], capture_output=True, check=False).stdout == b""
+
+
+def test_cancelled_count():
+    conf = ConfigBase()
+    conf.parse('set method="local"\ngroup g (kill_timeout="2") +h0 +h1 +h2')
+    collator = RemoteCollator(conf, "g")
+    collator.first = 1
+    collator.exec_all('test $TENTAKEL_HOST = h2 && { trap "" TERM; sleep 0.5; }; exit 0')
+    # h0 and h1 are done, h2 is still running when the first result cancels
+    time.sleep(0.3)
+    assert len(list(collator.collect())) == 1
+    collator.join_all()
+    assert collator.cancelled == 1
+    assert (collator.metrics.succeeded, collator.metrics.failed) == (2, 0)
+
+
+class SleepRemoteCommand(RemoteCommand):
+    """Sleeps for command seconds, cancelled or not."""
+
+    def _rexec(self, command):
+        time.sleep(float(command))
+        return (0, command)
+
+
+register_remote_command_plugin("sleep", SleepRemoteCommand)
+
+
+def test_late_result():
+    conf = ConfigBase()
+    conf.parse('set method="sleep"\ngroup g (kill_timeout="0.1") +a +b')
+    collator = RemoteCollator(conf, "g")
+    collator.procs = 2
+    collator.exec_all("1.5")
+    collator.cancel()
+    # gives up after 1.1 s
+    collator._drain()
+    collator.exec_all("1")
+    assert [r.output for r in collator.collect()] == ["1", "1"]
+    collator.join_all()
+
+
+def test_display_all_joins(capsys):
+    collator = RemoteCollator(make_conf("group g () +a +b"), "g")
+    collator.procs = 2
+    for _ in range(3):
+        collator.exec_all("uptime")
+        collator.display_all()
+        assert (collator._workers, collator._shards) == ([], [])
+    assert capsys.readouterr().out.count(": uptime\n") == 6
@@ -32,6 +32,8 @@ import tentakel
 from tentakel.config import ConfigBase
 from tentakel.shell import TentakelShell
 
+from .test_remote import make_conf
+
 CI = bool(os.environ.get("CI") or os.environ.get("TOX_ENV_NAME"))
 
 pytestmark = pytest.mark.skipif(CI, reason="Don't run on travis")
@@ -90,3 +92,48 @@ def test_shell_uptime(shell):
 #         # interactive mode: open shell
 #         sh = shell.TentakelShell(conf, groupName)
 #         sh.cmdloop(intro="interactive mode")
+
+
+def test_shell_use_keeps_collators():
+    conf = make_conf("group web () +a +shared\ngroup db () +b +shared\n")
+    sh = TentakelShell(conf, "web")
+    web = sh.dests
+    sh.do_use("db")
+    assert sh.collators["web"][0] is web
+    db_objects = {obj.destination: obj for obj in sh.dests.remote_objects}
+    web_objects = {obj.destination: obj for obj in web.remote_objects}
+    assert db_objects["shared"] is web_objects["shared"]
+    sh.do_use("web")
+    assert sh.dests is web
+
+    conf["settings"]["cache_hosts"] = "0"
+    sh.do_use("db")
+    assert not sh.collators
+    assert len(sh.pool) == 2
+
+
+def test_shell_select():
+    conf = make_conf("group web () +a{dc=fra} +b{dc=ams} +c{dc=fra}\n")
+    sh = TentakelShell(conf, "web")
+    sh.do_select("dc=fra")
+    assert sh.dests.get_destinations() == ["a", "c"]
+    assert not sh.dests.objects
+    sh.do_exclude("c*")
+    assert sh.dests.get_destinations() == ["a"]
+    sh.do_select("")
+    sh.do_only("b,c")
+    assert sh.dests.get_destinations() == ["b"]
+    sh.do_exclude("")
+    sh.do_only("")
+    assert len(sh.dests) == 3
+
+
+def test_use_keeps_settings():
+    conf = ConfigBase()
+    conf.parse('set method="local"\ngroup a () +h1\ngroup b () +h2\n')
+    sh = TentakelShell(conf, "a")
+    coordinator = object()
+    sh.dests.procs, sh.dests.first, sh.dests.where, sh.dests.coordinator = 4, 1, "load < 2", coordinator
+    sh.do_use("b")
+    assert (sh.dests.procs, sh.dests.first, sh.dests.where) == (4, 1, "load < 2")
+    assert sh.dests.coordinator is coordinator
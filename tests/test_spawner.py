@@ -0,0 +1,59 @@
+# Copyright (c) 2002, 2003, 2004, 2005 Sebastian Stark
+# Copyright (c) 2011, 2019-2021 Stefane Fermigier
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR SEBASTIAN STARK
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR
+# OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+import os
+import time
+
+from tentakel import spawner
+from tentakel.config import ConfigBase
+from tentakel.remote import RemoteCollator
+
+
+def test_spawn():
+    spawner.start()
+    try:
+        process = spawner.spawn("echo $GREETING; exit 3", env=dict(os.environ, GREETING="hello"))
+        assert process.pid != os.getpid()
+        assert process.communicate() == ("hello\n", None)
+        assert process.returncode == 3
+
+        conf = ConfigBase()
+        conf.parse('set method="local"\ngroup g (kill_timeout="0.3") ' + " ".join(f"+h{i}" for i in range(20)))
+        collator = RemoteCollator(conf, "g")
+        collator.exec_all("echo $TENTAKEL_HOST")
+        results = {r.destination: r for r in collator.collect()}
+        collator.join_all()
+        assert {d: (r.status, r.output) for d, r in results.items()} == {f"h{i}": (0, f"h{i}") for i in range(20)}
+
+        # processes of the helper can be cancelled too
+        collator.exec_all("sleep 10")
+        time.sleep(0.3)
+        start = time.monotonic()
+        collator.cancel("test")
+        collator._drain()
+        collator.join_all()
+        assert time.monotonic() - start < 2
+        assert collator.cancelled == 20
+    finally:
+        spawner.stop()
+    assert not spawner.running()